@@ -12,6 +12,7 @@ from torchnlp.datasets import imdb_dataset  # type: ignore
 from slp.data.collators import SequenceClassificationCollator
 from slp.data.transforms import SpacyTokenizer, ToTokenIds, ToTensor
 from slp.modules.classifier import Classifier
+from slp.modules.quantization import quantization_report, quantize_dynamic
 from slp.modules.rnn import WordRNN
 from slp.trainer import SequentialTrainer
 from slp.util.embeddings import EmbeddingsLoader
@@ -102,3 +103,8 @@ if __name__ == '__main__':
         trainer.overfit_single_batch(train_loader)
     else:
         trainer.fit(train_loader, dev_loader, epochs=10)
+        # int8 CPU inference
+        model = trainer.model.cpu()
+        quantization_report(
+            model, quantize_dynamic(model), dev_loader,
+            lambda m, batch: (m(batch[0], batch[2]), batch[1]))
@@ -9,6 +9,7 @@ from slp.config import SPECIAL_TOKENS
 from slp.data.datasets import LMDataset
 from slp.data.collators import TransformerCollator
 from slp.data.vocab import create_vocab
+from slp.modules.quantization import quantization_report, quantize_dynamic
 from slp.modules.transformer import Transformer
 from slp.data.transforms import ReplaceUnknownToken, ToTokenIds, ToTensor
 from slp.trainer import TransformerTrainer
@@ -80,3 +81,12 @@ if __name__ == "__main__":
         device=device)
 
     trainer.fit(train_loader, dev_loader, epochs=10)
+
+    # int8 CPU inference
+    def predict(m, batch):
+        inputs, targets, mask_inputs, mask_targets = batch
+        out = m(inputs, targets, mask_inputs, mask_targets)
+        return out.view(-1, out.size(-1)), targets.view(-1)
+
+    model = trainer.model.cpu()
+    quantization_report(model, quantize_dynamic(model), test_loader, predict)
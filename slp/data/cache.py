@@ -0,0 +1,177 @@
+import os
+import random
+
+import numpy as np
+import torch
+
+from tqdm import tqdm
+
+from slp.util import log
+from slp.util import system
+
+
+class CollatedBatchCache(object):
+    """Materializes the collated batches of a fixed dataset once and
+    replays them on every epoch, skipping __getitem__, the transforms and
+    the collator after the first pass.
+
+    Examples are bucketed by length before batching, so batches contain
+    sequences of similar size and shuffling happens at batch granularity.
+    Every field of the collated output is stored in a single contiguous
+    buffer, either in memory or in a file under cache_dir that is mapped
+    with numpy.memmap. Batches are collated and written one at a time, so
+    building a cache on disk holds only one batch in memory. To bucket,
+    a first pass fetches every example to compute its length, so the
+    examples are fetched twice.
+
+    Args:
+        dataset (torch.utils.data.Dataset): The dataset to cache
+        collate_fn (callable): The collator. Must return a tuple of tensors
+        batch_size (int): Number of examples per batch
+        shuffle (bool): Shuffle batch order on every epoch
+        bucket (bool): Sort examples by length before batching
+        sort_key (callable): Length of an example. Defaults to the length
+            of its first element
+        cache_dir (str): If set, store the batches as memmaps in this
+            directory. An existing cache in cache_dir is reused if it was
+            built with the same batch_size, bucket and dataset length,
+            otherwise it is rebuilt. Changes of the transforms, the
+            collator or sort_key are not detected
+    """
+    def __init__(self,
+                 dataset,
+                 collate_fn,
+                 batch_size=32,
+                 shuffle=True,
+                 bucket=True,
+                 sort_key=None,
+                 cache_dir=None):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket = bucket
+        self.sort_key = sort_key if sort_key is not None else (
+            lambda x: len(x[0]))
+        self.cache_dir = cache_dir
+        self.params = {'batch_size': batch_size,
+                       'bucket': bucket,
+                       'num_examples': len(dataset)}
+        self.buffers = []
+        # (offset, shape) of every field for every batch
+        self.index = []
+        if not (cache_dir is not None and self._load()):
+            self._build(dataset, collate_fn)
+        log.info(f'Cached {len(self)} batches in {self.nbytes} bytes '
+                 f'({"disk" if self.cache_dir is not None else "memory"})')
+
+    def _meta_file(self):
+        return os.path.join(self.cache_dir, 'meta.p')
+
+    def _field_file(self, i):
+        return os.path.join(self.cache_dir, f'field{i}.bin')
+
+    def _open_field(self, i, dtype, size):
+        if size == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(self._field_file(i), dtype=dtype, mode='c',
+                         shape=(size,))
+
+    def _batch_indices(self, dataset):
+        indices = list(range(len(dataset)))
+        if self.bucket:
+            # Only the lengths are kept. The examples are fetched again
+            # when their batch is collated
+            lengths = [self.sort_key(dataset[i]) for i in indices]
+            indices = sorted(indices, key=lambda i: lengths[i])
+        return [indices[i:i + self.batch_size]
+                for i in range(0, len(indices), self.batch_size)]
+
+    def _build(self, dataset, collate_fn):
+        files, chunks, dtypes, offsets = [], [], [], []
+        for idx in tqdm(self._batch_indices(dataset)):
+            batch = collate_fn([dataset[i] for i in idx])
+            for field in batch:
+                if not isinstance(field, torch.Tensor):
+                    raise ValueError(
+                        'CollatedBatchCache can only cache collators '
+                        f'that return tensors. Got {type(field)}')
+            batch = [field.cpu().numpy() for field in batch]
+            if not dtypes:
+                dtypes = [field.dtype for field in batch]
+                offsets = [0] * len(batch)
+                if self.cache_dir is not None:
+                    system.safe_mkdirs(self.cache_dir)
+                    # Written aside and renamed, so that caches that
+                    # still map the old files are not truncated
+                    files = [open(self._field_file(i) + '.tmp', 'wb')
+                             for i in range(len(batch))]
+                else:
+                    chunks = [[] for _ in batch]
+            entry = []
+            for i, field in enumerate(batch):
+                if self.cache_dir is not None:
+                    np.ascontiguousarray(field).tofile(files[i])
+                else:
+                    chunks[i].append(field.ravel())
+                entry.append((offsets[i], field.shape))
+                offsets[i] += field.size
+            self.index.append(entry)
+        if self.cache_dir is not None:
+            for i, f in enumerate(files):
+                f.close()
+                os.replace(f.name, self._field_file(i))
+            self.buffers = [self._open_field(i, dtype, size)
+                            for i, (dtype, size)
+                            in enumerate(zip(dtypes, offsets))]
+            system.pickle_dump(
+                {'params': self.params,
+                 'dtypes': [dtype.str for dtype in dtypes],
+                 'sizes': offsets,
+                 'index': self.index},
+                self._meta_file())
+        else:
+            self.buffers = [np.concatenate(c) for c in chunks]
+
+    def _load(self):
+        """Load the cache in cache_dir. Returns False if there is none or
+        it was built with different parameters
+        """
+        if not system.is_file(self._meta_file()):
+            return False
+        meta = system.pickle_load(self._meta_file())
+        if (not isinstance(meta, dict) or 'dtypes' not in meta or
+                meta['params'] != self.params):
+            log.info(f'Cache in {self.cache_dir} was built with different '
+                     'parameters. Rebuilding')
+            return False
+        self.index = meta['index']
+        self.buffers = [
+            self._open_field(i, np.dtype(dtype), size)
+            for i, (dtype, size)
+            in enumerate(zip(meta['dtypes'], meta['sizes']))]
+        return True
+
+    @property
+    def nbytes(self):
+        """Bytes used by the cached batches in memory or on disk"""
+        return sum(buf.nbytes for buf in self.buffers)
+
+    def _get_batch(self, i):
+        out = []
+        for buf, (offset, shape) in zip(self.buffers, self.index[i]):
+            size = int(np.prod(shape))
+            field = buf[offset:offset + size].reshape(shape)
+            out.append(torch.from_numpy(field))
+        return tuple(out)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        return self._get_batch(i)
+
+    def __iter__(self):
+        order = list(range(len(self)))
+        if self.shuffle:
+            random.shuffle(order)
+        for i in order:
+            yield self._get_batch(i)
@@ -53,6 +53,157 @@ class TransformerCollator(object):
         return inputs, targets, mask_inputs, mask_targets
 
 
+class PackedTransformerCollator(TransformerCollator):
+    """Packs several short (source, target) examples into each row, up to
+    max_length tokens per row, instead of padding every example to the
+    longest one in the batch. Rows are filled with first fit decreasing.
+
+    Along with the packed inputs and targets it returns block diagonal
+    attention masks, so that packed examples do not attend to each other,
+    per example positions for PositionalEncoding and the (B, Lt, Ls) mask
+    for the encoder decoder attention. Examples longer than max_length
+    raise a ValueError, truncate them first (e.g. with
+    slp.data.transforms.Truncate).
+
+    The ratio of real tokens to allocated positions is accumulated in
+    packing_efficiency.
+    """
+    def __init__(self, max_length, pad_indx=0, device='cpu'):
+        super(PackedTransformerCollator, self).__init__(
+            pad_indx=pad_indx, device=device)
+        self.max_length = max_length
+        self.num_tokens = 0
+        self.num_positions = 0
+
+    @property
+    def packing_efficiency(self):
+        if self.num_positions == 0:
+            return 0.
+        return self.num_tokens / self.num_positions
+
+    def pack(self, lengths):
+        """Assign examples to rows with first fit decreasing. lengths is
+        a list of (source length, target length)
+        """
+        longest = max((max(pair) for pair in lengths), default=0)
+        if longest > self.max_length:
+            raise ValueError(f'Cannot pack an example of length {longest} '
+                             f'in rows of max_length={self.max_length}')
+        order = sorted(range(len(lengths)),
+                       key=lambda i: max(lengths[i]), reverse=True)
+        rows, free = [], []
+        for i in order:
+            src_len, tgt_len = lengths[i]
+            for r, (src_free, tgt_free) in enumerate(free):
+                if src_len <= src_free and tgt_len <= tgt_free:
+                    rows[r].append(i)
+                    free[r] = (src_free - src_len, tgt_free - tgt_len)
+                    break
+            else:
+                rows.append([i])
+                free.append((self.max_length - src_len,
+                             self.max_length - tgt_len))
+        return rows
+
+    def concat_rows(self, tensors, rows):
+        """Concatenate the examples of each row. Returns padded tokens,
+        segment ids (0 for padding) and positions restarting from 0 for
+        every example.
+        """
+        tokens, segments, positions = [], [], []
+        for row in rows:
+            tokens.append(torch.cat([tensors[i] for i in row]))
+            segments.append(torch.cat([
+                torch.full((len(tensors[i]),), s + 1, dtype=torch.long)
+                for s, i in enumerate(row)]))
+            positions.append(torch.cat([
+                torch.arange(len(tensors[i])) for i in row]))
+        tokens = pad_sequence(tokens, batch_first=True,
+                              padding_value=self.pad_indx)
+        segments = pad_sequence(segments, batch_first=True)
+        positions = pad_sequence(positions, batch_first=True)
+        return tokens, segments, positions
+
+    @staticmethod
+    def segment_mask(segments, key_segments=None):
+        """(B, L) segment ids => (B, L, L) block diagonal mask.
+        With key_segments (B, Lk) => (B, L, Lk) mask for cross attention
+        """
+        if key_segments is None:
+            key_segments = segments
+        same = segments.unsqueeze(-1) == key_segments.unsqueeze(-2)
+        return (same & (key_segments != 0).unsqueeze(-2)).float()
+
+    def __call__(self, batch):
+        inputs, targets = self.get_inputs_and_targets(batch)
+        rows = self.pack([(len(s), len(t)) for s, t in zip(inputs, targets)])
+        inputs, seg_inputs, pos_inputs = self.concat_rows(inputs, rows)
+        targets, seg_targets, pos_targets = self.concat_rows(targets, rows)
+        mask_inputs = self.segment_mask(seg_inputs)
+        mask_targets = (self.segment_mask(seg_targets) *
+                        subsequent_mask(targets.size(1)))
+        mask_cross = self.segment_mask(seg_targets, seg_inputs)
+        self.num_tokens += int((seg_inputs != 0).sum())
+        self.num_positions += seg_inputs.numel()
+        return (inputs.to(self.device),
+                targets.to(self.device),
+                mask_inputs.to(self.device),
+                mask_targets.to(self.device),
+                pos_inputs.to(self.device),
+                pos_targets.to(self.device),
+                mask_cross.to(self.device))
+
+
+class MLMCollator(object):
+    """Pads a batch of token id sequences and applies BERT style masking
+    on the fly. Each maskable position is selected with probability
+    mlm_probability. Selected tokens are replaced by the mask token 80%
+    of the time, by a random token 10% of the time and left unchanged
+    otherwise. Targets hold the original token for selected positions and
+    ignore_index everywhere else. Padding and special_indices are never
+    selected.
+    """
+    def __init__(self, mask_indx, vocab_size, pad_indx=0,
+                 mlm_probability=.15, ignore_index=-100,
+                 special_indices=None, device='cpu'):
+        self.mask_indx = mask_indx
+        self.vocab_size = vocab_size
+        self.pad_indx = pad_indx
+        self.mlm_probability = mlm_probability
+        self.ignore_index = ignore_index
+        self.special_indices = (torch.tensor(special_indices)
+                                if special_indices is not None else None)
+        self.device = device
+
+    def mask_tokens(self, inputs, pad_m):
+        maskable = pad_m.bool()
+        if self.special_indices is not None:
+            special = (inputs.unsqueeze(-1) == self.special_indices).any(-1)
+            maskable = maskable & ~special
+        probs = torch.rand(inputs.shape)
+        selected = (probs < self.mlm_probability) & maskable
+        targets = inputs.masked_fill(~selected, self.ignore_index)
+        # Selected probs are uniform in [0, mlm_probability). Reuse them
+        # to pick 80% [MASK], 10% random token, 10% unchanged
+        action = probs / self.mlm_probability
+        inputs = inputs.masked_fill(selected & (action < .8), self.mask_indx)
+        randomize = selected & (action >= .8) & (action < .9)
+        random_tokens = torch.randint_like(inputs, self.vocab_size)
+        inputs = torch.where(randomize, random_tokens, inputs)
+        return inputs, targets
+
+    def __call__(self, batch):
+        lengths = torch.tensor([len(s) for s in batch])
+        inputs = pad_sequence(batch,
+                              batch_first=True,
+                              padding_value=self.pad_indx)
+        pad_m = pad_mask(lengths, max_length=inputs.size(1))
+        inputs, targets = self.mask_tokens(inputs, pad_m)
+        return (inputs.to(self.device),
+                targets.to(self.device),
+                pad_m.unsqueeze(-2).to(self.device))
+
+
 class PackedSequenceCollator(object):
     def __init__(self, pad_indx=0, device='cpu', batch_first=True):
         self.seq_collator = SequenceClassificationCollator(
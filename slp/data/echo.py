@@ -0,0 +1,105 @@
+import math
+import random
+import time
+
+
+class DataEcho(object):
+    """Data echoing for input bound training.
+    Link: https://arxiv.org/abs/1907.05550
+
+    Wraps a DataLoader and repeats every fetched batch echo_factor times,
+    so the train step does not sit idle while the loader prepares the next
+    batch. If echo_factor='auto' the factor is adapted after every fetch
+    from the time spent waiting for the loader. A wait of w steps means
+    the loader needed about w more steps than the ones run since the
+    previous fetch, so the factor grows by w rounded up. Waits of at most
+    tolerance steps are ignored, since fetching always costs a little.
+    After patience fetches without a wait the factor is decreased by one,
+    since a loader that keeps up may need fewer steps. The factor is
+    clipped to [1, max_echo]. The first fetch of every epoch includes the
+    worker startup and is not used.
+
+    With buffer_size > 1 the echoed batches are kept in a small buffer and
+    yielded in random order, so that repeats of a batch are not consecutive.
+
+    Args:
+        loader (Iterable): The upstream DataLoader
+        echo_factor (int, str): Times to repeat each batch or 'auto'
+        max_echo (int): Upper bound for the adaptive echo factor
+        buffer_size (int): Number of distinct batches to mix
+        momentum (float): Smoothing of the measured step time
+        tolerance (float): Wait per batch, in steps, that does not
+            increase the echo factor
+        patience (int): Fetches without a wait before the echo factor is
+            decreased
+    """
+    def __init__(self, loader, echo_factor='auto', max_echo=4,
+                 buffer_size=1, momentum=.9, tolerance=.1, patience=10):
+        self.loader = loader
+        self.adaptive = echo_factor == 'auto'
+        self.echo_factor = 1 if self.adaptive else int(echo_factor)
+        self.max_echo = max_echo
+        self.buffer_size = buffer_size
+        self.momentum = momentum
+        self.tolerance = tolerance
+        self.patience = patience
+        self.step_time = None
+        self.num_steps = 0
+        self.num_ready = 0
+
+    def _smooth(self, avg, value):
+        if avg is None:
+            return value
+        return self.momentum * avg + (1 - self.momentum) * value
+
+    def _update_echo_factor(self, wait):
+        if not self.adaptive or not self.step_time:
+            return
+        extra = math.ceil(wait / self.step_time - self.tolerance)
+        if extra > 0:
+            self.num_ready = 0
+            echo_factor = self.num_steps + extra
+        else:
+            self.num_ready += 1
+            if self.num_ready < self.patience:
+                return
+            self.num_ready = 0
+            echo_factor = self.echo_factor - 1
+        self.echo_factor = max(1, min(self.max_echo, echo_factor))
+
+    def _yield_from_buffer(self, buffer):
+        i = random.randrange(len(buffer))
+        batch, remaining = buffer[i]
+        if remaining == 1:
+            buffer.pop(i)
+        else:
+            buffer[i][1] = remaining - 1
+        start = time.time()
+        yield batch
+        self.num_steps += 1
+        self.step_time = self._smooth(self.step_time, time.time() - start)
+
+    def __len__(self):
+        return len(self.loader) * self.echo_factor
+
+    def __iter__(self):
+        upstream = iter(self.loader)
+        buffer = []
+        first = True
+        while True:
+            start = time.time()
+            try:
+                batch = next(upstream)
+            except StopIteration:
+                break
+            # Only the time blocked on the loader. The first fetch includes
+            # the startup of the workers
+            if not first:
+                self._update_echo_factor(time.time() - start)
+            first = False
+            self.num_steps = 0
+            buffer.append([batch, self.echo_factor])
+            while len(buffer) >= self.buffer_size:
+                yield from self._yield_from_buffer(buffer)
+        while buffer:
+            yield from self._yield_from_buffer(buffer)
@@ -143,3 +143,39 @@ class ToTensor(object):
 
     def __call__(self, x):
         return mktensor(x, device=self.device, dtype=self.dtype)
+
+
+class Truncate(object):
+    """Bound the length of a token sequence.
+
+    Args:
+        max_length (int): Maximum number of tokens to keep
+        mode (str): 'head' keeps the first max_length tokens, 'tail' the
+            last max_length and 'head+tail' keeps head_length tokens from
+            the start and the rest from the end of the sequence
+        head_length (int): Tokens kept from the start in 'head+tail' mode.
+            Defaults to max_length // 2
+    """
+    def __init__(self, max_length, mode='head', head_length=None):
+        if mode not in ('head', 'tail', 'head+tail'):
+            raise ValueError(f"Unknown truncation mode {mode}. "
+                             "Use one of 'head', 'tail', 'head+tail'")
+        self.max_length = max_length
+        self.mode = mode
+        if head_length is None:
+            head_length = max_length // 2
+        if mode == 'head':
+            head_length = max_length
+        elif mode == 'tail':
+            head_length = 0
+        self.head_length = min(head_length, max_length)
+        self.tail_length = max_length - self.head_length
+
+    def __call__(self, x):
+        if len(x) <= self.max_length:
+            return x
+        head = x[:self.head_length]
+        tail = x[len(x) - self.tail_length:]
+        if isinstance(x, torch.Tensor):
+            return torch.cat((head, tail))
+        return head + tail
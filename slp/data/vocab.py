@@ -2,7 +2,12 @@ import itertools
 from collections import Counter
 
 
-def create_vocab(corpus, vocab_size=5000, extra_tokens=None):
+def create_vocab(corpus, vocab_size=5000, extra_tokens=None,
+                 return_counts=False):
+    """Map the vocab_size most common words to ids. extra_tokens come
+    first and the rest of the words are in decreasing frequency order.
+    If return_counts the frequency of every id is also returned
+    """
     if isinstance(corpus[0], list):
         corpus = itertools.chain.from_iterable(corpus)
     freq = Counter(corpus)
@@ -10,9 +15,34 @@ def create_vocab(corpus, vocab_size=5000, extra_tokens=None):
         extra_tokens = []
     take = min(vocab_size, len(freq))
     common_words = list(map(lambda x: x[0], freq.most_common(take)))
-    common_words = list(set(common_words) - set(extra_tokens))
+    extra = set(extra_tokens)
+    common_words = [w for w in common_words if w not in extra]
     words = extra_tokens + common_words
     if len(words) > vocab_size:
         words = words[:vocab_size]
     vocab = dict(zip(words, itertools.count()))
+    if return_counts:
+        return vocab, [freq[w] for w in words]
     return vocab
+
+
+def frequency_cutoffs(counts, coverage=(.8, .95)):
+    """Cluster boundaries for adaptive softmax / input.
+    counts are the frequencies of the frequency ordered vocab ids, as
+    returned by create_vocab. The i-th cutoff is the first id at which
+    the most frequent words cover coverage[i] of the corpus tokens
+    """
+    total = sum(counts)
+    cutoffs = []
+    covered = 0
+    it = iter(coverage)
+    target = next(it, None)
+    for i, c in enumerate(counts):
+        if target is None:
+            break
+        covered += c
+        while target is not None and covered >= target * total:
+            if i + 1 < len(counts) and (not cutoffs or cutoffs[-1] < i + 1):
+                cutoffs.append(i + 1)
+            target = next(it, None)
+    return cutoffs
@@ -0,0 +1,186 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def band_dims(hidden_size, num_bands, div_value=4.):
+    """Dimension of every frequency band. Band i has hidden_size / div^i"""
+    return [max(1, int(hidden_size // (div_value ** i)))
+            for i in range(num_bands)]
+
+
+class AdaptiveSoftmax(nn.Module):
+    """Adaptive softmax. Link: https://arxiv.org/abs/1609.04309
+
+    Word ids must be in decreasing frequency order (see create_vocab).
+    cutoffs split the vocab in a head shortlist [0, cutoffs[0]) and tail
+    clusters [cutoffs[i], cutoffs[i + 1]). The head predicts the shortlist
+    words and one token per cluster. Cluster i projects the hidden state
+    to hidden_size / div_value^(i + 1) before its output layer, so rare
+    words cost less.
+
+    The head and tail weights are separate parameters, so that they can
+    be tied with AdaptiveInput.
+    """
+    def __init__(self, hidden_size, vocab_size, cutoffs, div_value=4.):
+        super(AdaptiveSoftmax, self).__init__()
+        cutoffs = list(cutoffs)
+        if (cutoffs != sorted(cutoffs) or len(set(cutoffs)) != len(cutoffs)
+                or cutoffs[0] <= 0 or cutoffs[-1] >= vocab_size):
+            raise ValueError('cutoffs should be increasing ids in '
+                             f'(0, vocab_size). Got {cutoffs}')
+        self.vocab_size = vocab_size
+        self.cutoffs = cutoffs + [vocab_size]
+        self.shortlist_size = cutoffs[0]
+        self.num_clusters = len(cutoffs)
+        self.head = nn.Linear(hidden_size, self.shortlist_size)
+        self.cluster = nn.Linear(hidden_size, self.num_clusters)
+        dims = band_dims(hidden_size, self.num_clusters + 1, div_value)
+        self.tail = nn.ModuleList([
+            nn.Sequential(
+                nn.Linear(hidden_size, dims[i + 1], bias=False),
+                nn.Linear(dims[i + 1],
+                          self.cutoffs[i + 1] - self.cutoffs[i],
+                          bias=False))
+            for i in range(self.num_clusters)])
+
+    def head_log_prob(self, x):
+        """x => (N, D) out => (N, shortlist_size + num_clusters)"""
+        return F.log_softmax(
+            torch.cat((self.head(x), self.cluster(x)), dim=-1), dim=-1)
+
+    def forward(self, x, targets):
+        """Log probability of the targets. Tail clusters are only computed
+        for the rows whose target is in them.
+
+        x => (N, D)
+        targets => (N,). Ids outside [0, vocab_size), e.g. ignore_index,
+            get a log probability of 0
+        out => (N,)
+        """
+        head_lp = self.head_log_prob(x)
+        out = x.new_zeros(targets.size(0))
+        in_shortlist = (targets >= 0) & (targets < self.shortlist_size)
+        shortlist_rows = in_shortlist.nonzero().squeeze(-1)
+        out[shortlist_rows] = head_lp[
+            shortlist_rows, targets[shortlist_rows]]
+        for i in range(self.num_clusters):
+            low, high = self.cutoffs[i], self.cutoffs[i + 1]
+            rows = ((targets >= low) & (targets < high)).nonzero().squeeze(-1)
+            if rows.numel() == 0:
+                continue
+            tail_lp = F.log_softmax(self.tail[i](x[rows]), dim=-1)
+            out[rows] = (head_lp[rows, self.shortlist_size + i] +
+                         tail_lp.gather(
+                             1, (targets[rows] - low).unsqueeze(-1))
+                         .squeeze(-1))
+        return out
+
+    def log_prob(self, x):
+        """Full log probabilities. x => (..., D) out => (..., V)"""
+        head_lp = self.head_log_prob(x)
+        out = [head_lp[..., :self.shortlist_size]]
+        for i in range(self.num_clusters):
+            cluster_lp = head_lp[..., self.shortlist_size + i].unsqueeze(-1)
+            out.append(cluster_lp +
+                       F.log_softmax(self.tail[i](x), dim=-1))
+        return torch.cat(out, dim=-1)
+
+    def topk(self, x, k=1):
+        """Exact top k words without the full log probabilities. A tail word
+        is never more likely than its cluster, so a cluster is only
+        expanded for rows where it beats the k-th best shortlist word.
+
+        x => (N, D)
+        out => (N, k) log probabilities and (N, k) word ids
+        """
+        head_lp = self.head_log_prob(x)
+        shortlist_lp = head_lp[:, :self.shortlist_size]
+        k_short = min(k, self.shortlist_size)
+        values, indices = shortlist_lp.topk(k_short, dim=-1)
+        candidates, candidate_ids = [values], [indices]
+        threshold = values[:, -1]
+        if k_short < k:
+            threshold = torch.full_like(threshold, float('-inf'))
+        for i in range(self.num_clusters):
+            low, high = self.cutoffs[i], self.cutoffs[i + 1]
+            k_tail = min(k, high - low)
+            cluster_lp = head_lp[:, self.shortlist_size + i]
+            values = x.new_full((x.size(0), k_tail), float('-inf'))
+            indices = torch.full_like(values, low, dtype=torch.long)
+            rows = (cluster_lp > threshold).nonzero().squeeze(-1)
+            if rows.numel() > 0:
+                tail_lp = F.log_softmax(self.tail[i](x[rows]), dim=-1)
+                top_lp, top_ids = tail_lp.topk(k_tail, dim=-1)
+                values[rows] = top_lp + cluster_lp[rows].unsqueeze(-1)
+                indices[rows] = top_ids + low
+            candidates.append(values)
+            candidate_ids.append(indices)
+        values, best = torch.cat(candidates, dim=-1).topk(k, dim=-1)
+        return values, torch.cat(candidate_ids, dim=-1).gather(1, best)
+
+    def predict(self, x):
+        """Most likely word id. x => (N, D) out => (N,)"""
+        return self.topk(x, k=1)[1].squeeze(-1)
+
+
+class AdaptiveInput(nn.Module):
+    """Adaptive input representations. Link: https://arxiv.org/abs/1809.10853
+
+    Word ids must be in decreasing frequency order (see create_vocab).
+    The vocab is split in bands by cutoffs like AdaptiveSoftmax. Band i
+    has embeddings of size hidden_size / div_value^i, projected up to
+    hidden_size, so rare words take less memory and gradient traffic.
+    Use tie_weights to share the weights with an AdaptiveSoftmax with the
+    same cutoffs.
+    """
+    def __init__(self,
+                 vocab_size,
+                 hidden_size,
+                 cutoffs,
+                 div_value=4.,
+                 dropout=.0,
+                 scale=1.):
+        super(AdaptiveInput, self).__init__()
+        self.hidden_size = hidden_size
+        self.cutoffs = list(cutoffs) + [vocab_size]
+        self.scale = scale
+        dims = band_dims(hidden_size, len(self.cutoffs), div_value)
+        self.embeddings = nn.ModuleList([
+            nn.Embedding(high - low, dim)
+            for low, high, dim in zip([0] + self.cutoffs[:-1],
+                                      self.cutoffs, dims)])
+        # (band dim, hidden_size) like the tail projections of
+        # AdaptiveSoftmax. The first band needs no projection
+        self.projections = nn.ParameterList([
+            nn.Parameter(torch.empty(dim, hidden_size))
+            for dim in dims[1:]])
+        for p in self.projections:
+            nn.init.xavier_uniform_(p)
+        self.dropout = nn.Dropout(dropout)
+
+    def tie_weights(self, adaptive_softmax, tie_projections=True):
+        """Share the embeddings (and projections) with adaptive_softmax"""
+        if adaptive_softmax.cutoffs != self.cutoffs:
+            raise ValueError('AdaptiveInput and AdaptiveSoftmax should have '
+                             'the same cutoffs')
+        self.embeddings[0].weight = adaptive_softmax.head.weight
+        for i, tail in enumerate(adaptive_softmax.tail):
+            self.embeddings[i + 1].weight = tail[1].weight
+            if tie_projections:
+                self.projections[i] = tail[0].weight
+
+    def forward(self, x):
+        """x => (B, L) word ids out => (B, L, hidden_size)"""
+        out = self.embeddings[0].weight.new_zeros(
+            x.size() + (self.hidden_size,))
+        for i, embedding in enumerate(self.embeddings):
+            low, high = ([0] + self.cutoffs)[i], self.cutoffs[i]
+            band = (x >= low) & (x < high)
+            if not band.any():
+                continue
+            embedded = embedding(x[band] - low)
+            if i > 0:
+                embedded = torch.matmul(embedded, self.projections[i - 1])
+            out[band] = embedded
+        return self.dropout(out) * self.scale
@@ -4,6 +4,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.utils.checkpoint import checkpoint
 
+from typing import Dict, Optional
+
 from slp.modules.feedforward import FF
 
 
@@ -13,29 +15,116 @@ def calc_scores(dk):
     return fn
 
 
+def _attend_chunk(attention_mask, dropout, chunk_size, dk):
+    def fn(q, k, v):
+        """Attention of a block of queries to all keys. Keys are processed
+        in chunks with an online softmax: the running max, normalizer and
+        weighted sum of values are rescaled whenever a larger score is seen
+        """
+        running_max = torch.full(q.size()[:-1] + (1,), -math.inf,
+                                 dtype=q.dtype, device=q.device)
+        normalizer = torch.zeros_like(running_max)
+        out = q.new_zeros(q.size()[:-1] + (v.size(-1),))
+        for j in range(0, k.size(-2), chunk_size):
+            scores = torch.matmul(
+                q, k[..., j:j + chunk_size, :].transpose(-1, -2))
+            scores = scores / math.sqrt(dk)
+            if attention_mask is not None:
+                mask = attention_mask[..., j:j + chunk_size]
+                scores = scores + ((1 - mask) * -1e5)
+            new_max = torch.max(running_max, scores.max(-1, keepdim=True)[0])
+            correction = torch.exp(running_max - new_max)
+            probs = torch.exp(scores - new_max)
+            normalizer = normalizer * correction + probs.sum(-1, keepdim=True)
+            # Dropout on unnormalized probs is the same as dropout on
+            # the softmax output, since it only scales each element
+            out = (out * correction +
+                   torch.matmul(dropout(probs), v[..., j:j + chunk_size, :]))
+            running_max = new_max
+        return out / normalizer
+    return fn
+
+
+def chunked_attention(q, k, v, dk, attention_mask=None, dropout=None,
+                      chunk_size=128):
+    """Memory efficient softmax(q k^T / sqrt(dk)) v
+
+    Queries are processed in chunks and for each chunk the keys are
+    processed in chunks with a numerically stable online softmax, so the
+    full (Lq, Lk) score matrix is never materialized. During training every
+    query chunk is recomputed in the backward pass, so activation memory is
+    O(L x chunk_size) as well.
+
+    Args:
+        q (torch.Tensor): (..., Lq, d) queries
+        k (torch.Tensor): (..., Lk, d) keys
+        v (torch.Tensor): (..., Lk, dv) values
+        dk (int): Scores are scaled by 1 / sqrt(dk)
+        attention_mask (torch.Tensor): 0/1 mask broadcastable to
+            (..., Lq, Lk)
+        dropout (nn.Module): Dropout applied on the attention weights
+        chunk_size (int): Queries and keys per chunk
+
+    Returns:
+        (torch.Tensor): (..., Lq, dv)
+    """
+    if dropout is None:
+        dropout = nn.Identity()
+    out = []
+    for i in range(0, q.size(-2), chunk_size):
+        mask = attention_mask
+        if mask is not None and mask.size(-2) > 1:
+            mask = mask[..., i:i + chunk_size, :]
+        fn = _attend_chunk(mask, dropout, chunk_size, dk)
+        q_chunk = q[..., i:i + chunk_size, :]
+        if torch.is_grad_enabled() and any(
+                t.requires_grad for t in (q_chunk, k, v)):
+            out.append(checkpoint(fn, q_chunk, k, v))
+        else:
+            out.append(fn(q_chunk, k, v))
+    return torch.cat(out, dim=-2)
+
+
+ATTENTION_BACKENDS = ['dense', 'chunked']
+
+
 class Attention(nn.Module):
     """Some Information about Attention"""
     def __init__(self,
                  attention_size=512,
                  input_size=None,
                  dropout=.1,
-                 grad_checkpoint=False):
+                 grad_checkpoint=False,
+                 attention_backend='dense',
+                 chunk_size=128):
         super(Attention, self).__init__()
         if input_size is None:
             input_size = attention_size
+        if attention_backend not in ATTENTION_BACKENDS:
+            raise ValueError(f'Unknown attention backend {attention_backend}.'
+                             f' Use one of {ATTENTION_BACKENDS}')
         self.dk = input_size
         self.grad_checkpoint = grad_checkpoint
+        self.attention_backend = attention_backend
+        self.chunk_size = chunk_size
         self.k = nn.Linear(input_size, attention_size, bias=False)
         self.q = nn.Linear(input_size, attention_size, bias=False)
         self.v = nn.Linear(input_size, attention_size, bias=False)
         self.drop = nn.Dropout(dropout)
         self._reset_parameters()
 
-    def forward(self, x, queries=None, values=None, attention_mask=None):
+    def forward(self,
+                x,
+                queries: Optional[torch.Tensor] = None,
+                values: Optional[torch.Tensor] = None,
+                attention_mask: Optional[torch.Tensor] = None,
+                return_weights: bool = False):
         '''
         x : (B, L, D)
         queries : (B, L, D)
         values : (B, L, D)
+        return_weights : Also return the (B, L, L) attention weights.
+            Not supported in TorchScript
         '''
         if queries is None:
             queries = x
@@ -45,8 +134,19 @@ class Attention(nn.Module):
         q = self.q(queries)  # (B, L, A)
         v = self.v(values)  # (B, L, A)
 
+        # Chunking and checkpointing only save training memory. Scripted
+        # modules compute the same attention densely
+        if (not torch.jit.is_scripting() and
+                self.attention_backend == 'chunked' and not return_weights):
+            if attention_mask is not None:
+                attention_mask = attention_mask.unsqueeze(1)
+            return chunked_attention(q, k, v, self.dk,
+                                     attention_mask=attention_mask,
+                                     dropout=self.drop,
+                                     chunk_size=self.chunk_size)
+
         # weights => (B, L, L)
-        if self.grad_checkpoint:
+        if not torch.jit.is_scripting() and self.grad_checkpoint:
             scores = checkpoint(calc_scores(self.dk), q, k)
         else:
             scores = torch.bmm(q, k.transpose(1, 2)) / math.sqrt(self.dk)
@@ -57,7 +157,9 @@ class Attention(nn.Module):
 
         # out => (B, L, A)
         out = torch.bmm(scores, v)
-        return out, scores
+        if not torch.jit.is_scripting() and return_weights:
+            return out, scores
+        return out
 
     def _reset_parameters(self):
         nn.init.xavier_uniform_(self.k.weight)
@@ -103,23 +205,44 @@ class MultiheadAttentionSerial(nn.Module):
 
 
 class MultiheadAttentionParallel(nn.Module):
+    """Multihead attention with all heads computed in parallel.
+
+    If fused_qkv is set the query, key and value projections are stored as
+    a single (D, 3A) linear layer (in q, k, v order), so self attention
+    needs one projection and one reshape into heads. Checkpoints with
+    separate k, q, v weights are converted when loaded.
+    """
+    __constants__ = ['fused_qkv']
+
     def __init__(self,
                  attention_size=512,
                  num_heads=8,
                  input_size=None,
                  dropout=.1,
-                 grad_checkpoint=False):
+                 grad_checkpoint=False,
+                 fused_qkv=False,
+                 attention_backend='dense',
+                 chunk_size=128):
         super(MultiheadAttentionParallel, self).__init__()
         if input_size is None:
             input_size = attention_size
+        if attention_backend not in ATTENTION_BACKENDS:
+            raise ValueError(f'Unknown attention backend {attention_backend}.'
+                             f' Use one of {ATTENTION_BACKENDS}')
+        self.attention_backend = attention_backend
+        self.chunk_size = chunk_size
         self.dk = input_size
         self.num_heads = num_heads
         self.head_size = int(attention_size / num_heads)
         self.attention_size = attention_size
         self.grad_checkpoint = grad_checkpoint
-        self.k = nn.Linear(input_size, attention_size, bias=False)
-        self.q = nn.Linear(input_size, attention_size, bias=False)
-        self.v = nn.Linear(input_size, attention_size, bias=False)
+        self.fused_qkv = fused_qkv
+        if fused_qkv:
+            self.qkv = nn.Linear(input_size, 3 * attention_size, bias=False)
+        else:
+            self.k = nn.Linear(input_size, attention_size, bias=False)
+            self.q = nn.Linear(input_size, attention_size, bias=False)
+            self.v = nn.Linear(input_size, attention_size, bias=False)
         self.output = FF(attention_size,
                          attention_size,
                          activation='none',
@@ -149,41 +272,535 @@ class MultiheadAttentionParallel(nn.Module):
         x = x.permute(0, 2, 1, 3).contiguous()
         return x.view(batch_size, max_length, -1)
 
-    def forward(self, x, queries=None, values=None, attention_mask=None):
+    def _project_fused(self, x):
+        """
+        x => (B, L, D)
+        out => 3 x (B, H, L, A/H) queries, keys, values
+        """
+        batch_size, max_length, _ = x.size()
+        qkv = (self.qkv(x)
+               .view(batch_size, max_length,
+                     3, self.num_heads, self.head_size)
+               .permute(2, 0, 3, 1, 4))
+        return qkv[0], qkv[1], qkv[2]
+
+    def _project_queries(self, queries):
+        if not self.fused_qkv:
+            return self._split_heads(self.q(queries))
+        if not torch.jit.is_scripting():
+            if type(self.qkv) is nn.Linear:
+                w_q = self.qkv.weight[:self.attention_size]
+                return self._split_heads(F.linear(queries, w_q))
+        # Other layers (e.g. quantized or factorized) have no weight to
+        # slice. Slice the output of the fused projection
+        q = self.qkv(queries)[..., :self.attention_size]
+        return self._split_heads(q)
+
+    def _project_keys_values(self, x, values):
+        if not self.fused_qkv:
+            return (self._split_heads(self.k(x)),
+                    self._split_heads(self.v(values)))
+        if not torch.jit.is_scripting():
+            if type(self.qkv) is nn.Linear:
+                # Cross attention with fused weights. Project with the
+                # slices
+                w_kv = self.qkv.weight[self.attention_size:]
+                if values is x:
+                    k, v = F.linear(x, w_kv).chunk(2, dim=-1)
+                    return self._split_heads(k), self._split_heads(v)
+                w_k, w_v = w_kv.chunk(2, dim=0)
+                return (self._split_heads(F.linear(x, w_k)),
+                        self._split_heads(F.linear(values, w_v)))
+        k = self.qkv(x)[..., self.attention_size:2 * self.attention_size]
+        v = self.qkv(values)[..., 2 * self.attention_size:]
+        return self._split_heads(k), self._split_heads(v)
+
+    def _project(self,
+                 x,
+                 queries,
+                 values,
+                 cache: Optional[Dict[str, torch.Tensor]] = None):
+        """Project to (B, H, L, A/H) queries, keys and values.
+
+        If cache is a dict it is used for incremental decoding. In self
+        attention the keys and values of the new positions are appended to
+        the cached ones. Otherwise keys and values are static (e.g. the
+        encoder output) and are computed once and reused.
+        """
+        self_attention = queries is x and values is x
+        if cache is not None and not self_attention and 'k' in cache:
+            return self._project_queries(queries), cache['k'], cache['v']
+        if self_attention and self.fused_qkv:
+            q, k, v = self._project_fused(x)
+        else:
+            q = self._project_queries(queries)
+            k, v = self._project_keys_values(x, values)
+        if cache is not None:
+            if self_attention and 'k' in cache:
+                k = torch.cat((cache['k'], k), dim=2)
+                v = torch.cat((cache['v'], v), dim=2)
+            cache['k'] = k
+            cache['v'] = v
+        return q, k, v
+
+    def _dense_attention(self,
+                         q,
+                         k,
+                         v,
+                         attention_mask: Optional[torch.Tensor] = None):
+        # scores => (B, H, L, L)
+        if not torch.jit.is_scripting() and self.grad_checkpoint:
+            scores = checkpoint(calc_scores(self.dk), q, k)
+        else:
+            scores = torch.matmul(q, k.transpose(-1, -2)) / math.sqrt(self.dk)
+        if attention_mask is not None:
+            scores = scores + ((1 - attention_mask) * -1e5)
+        scores = F.softmax(scores, dim=-1)
+        scores = self.drop(scores)
+        return torch.matmul(scores, v), scores
+
+    def forward(self,
+                x,
+                queries: Optional[torch.Tensor] = None,
+                values: Optional[torch.Tensor] = None,
+                attention_mask: Optional[torch.Tensor] = None,
+                return_weights: bool = False,
+                cache: Optional[Dict[str, torch.Tensor]] = None):
         """
         x : (B, L, D)
         queries : (B, L, D)
         values : (B, L, D)
+        return_weights : Also return the (B, H, L, L) attention weights.
+            Not supported in TorchScript
+        cache : dict with the keys and values of previous decoding steps
         """
         if queries is None:
             queries = x
         if values is None:
             values = x
-        k = self._split_heads(self.k(x))  # (B, H, L, A/H)
-        q = self._split_heads(self.q(queries))  # (B, H, L, A/H)
-        v = self._split_heads(self.v(values))  # (B, H, L, A/H)
+        # (B, H, L, A/H)
+        q, k, v = self._project(x, queries, values, cache=cache)
+        if attention_mask is not None:
+            attention_mask = attention_mask.unsqueeze(1)
 
-        # scores => (B, H, L, L)
-        if self.grad_checkpoint:
-            scores = checkpoint(calc_scores(self.dk), q, k)
+        if (not torch.jit.is_scripting() and
+                self.attention_backend == 'chunked' and not return_weights):
+            out = chunked_attention(q, k, v, self.dk,
+                                    attention_mask=attention_mask,
+                                    dropout=self.drop,
+                                    chunk_size=self.chunk_size)
         else:
-            scores = torch.matmul(q, k.transpose(-1, -2)) / math.sqrt(self.dk)
-        if attention_mask is not None:
-            scores = scores + ((1 - attention_mask.unsqueeze(1)) * -1e5)
-        scores = F.softmax(scores, dim=-1)
-        scores = self.drop(scores)
+            out, scores = self._dense_attention(
+                q, k, v, attention_mask=attention_mask)
 
         # out => (B, H, L, A/H)
-        out = self._merge_heads(torch.matmul(scores, v))
+        out = self._merge_heads(out)
         out = self.output(out)
+        if not torch.jit.is_scripting() and return_weights:
+            return out, scores
         return out
 
+    def reset_projections(self):
+        if not self.fused_qkv:
+            nn.init.xavier_uniform_(self.k.weight)
+            nn.init.xavier_uniform_(self.q.weight)
+            nn.init.xavier_uniform_(self.v.weight)
+            return
+        # Same init as three separate (D, A) projections
+        with torch.no_grad():
+            for w in self.qkv.weight.chunk(3, dim=0):
+                nn.init.xavier_uniform_(w)
+
+    @torch.no_grad()
+    def fuse_qkv_(self):
+        """Merge separate q, k, v projections into one fused_qkv layer in
+        place. Projections that are not plain nn.Linear (e.g. quantized or
+        factorized) are left separate. Returns self
+        """
+        if self.fused_qkv:
+            return self
+        if any(type(layer) is not nn.Linear
+               for layer in (self.q, self.k, self.v)):
+            return self
+        weights = [self.q.weight, self.k.weight, self.v.weight]
+        self.qkv = nn.Linear(self.q.in_features, 3 * self.attention_size,
+                             bias=False).to(weights[0])
+        self.qkv.weight.copy_(torch.cat(weights, dim=0))
+        self.qkv.weight.requires_grad_(weights[0].requires_grad)
+        del self.q, self.k, self.v
+        self.fused_qkv = True
+        return self
+
     def _reset_parameters(self):
-        nn.init.xavier_uniform_(self.k.weight)
-        nn.init.xavier_uniform_(self.q.weight)
-        nn.init.xavier_uniform_(self.v.weight)
+        self.reset_projections()
         nn.init.xavier_uniform_(self.output.fc.weight)
         nn.init.constant_(self.output.fc.bias, 0.)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        separate = [f'{prefix}{p}.weight' for p in ('q', 'k', 'v')]
+        if (self.fused_qkv and f'{prefix}qkv.weight' not in state_dict
+                and all(k in state_dict for k in separate)):
+            # Checkpoint saved with separate k, q, v projections
+            state_dict[f'{prefix}qkv.weight'] = torch.cat(
+                [state_dict.pop(k) for k in separate], dim=0)
+        super(MultiheadAttentionParallel, self)._load_from_state_dict(
+            state_dict, prefix, *args, **kwargs)
+
+
+class SlidingWindowAttention(MultiheadAttentionParallel):
+    """Local multihead self attention.
+
+    Every query attends to the keys in a window of window_size positions
+    on each side. The first num_global_tokens positions (e.g. [CLS]) are
+    global: they attend to every position and every position attends to
+    them. Windows are gathered with banded (strided) views of the keys and
+    values, so cost is O(L x window_size) instead of O(L^2).
+
+    Shares the projections and the output layer of
+    MultiheadAttentionParallel, so it is a drop in replacement for self
+    attention. For incremental decoding the new positions attend densely
+    to the cached keys, masked to the same windows.
+    """
+    def __init__(self,
+                 attention_size=512,
+                 num_heads=8,
+                 input_size=None,
+                 dropout=.1,
+                 window_size=64,
+                 num_global_tokens=0,
+                 fused_qkv=False):
+        super(SlidingWindowAttention, self).__init__(
+            attention_size=attention_size,
+            num_heads=num_heads,
+            input_size=input_size,
+            dropout=dropout,
+            fused_qkv=fused_qkv)
+        self.window_size = window_size
+        self.num_global_tokens = num_global_tokens
+
+    def _band(self, x):
+        """
+        x => (B, H, L, A/H)
+        out => (B, H, L, 2w+1, A/H) view with the window of every position
+        """
+        w = self.window_size
+        x = F.pad(x, [0, 0, w, w])
+        return x.unfold(2, 2 * w + 1, 1).transpose(-1, -2)
+
+    def _window_mask(self, attention_mask, max_length, device):
+        """
+        attention_mask => (B, 1, L) or (B, L, L)
+        out => (B or 1, 1, L, 2w+1). Out of range and global keys are masked,
+            since global keys are attended separately
+        """
+        w = self.window_size
+        idx = (torch.arange(max_length, device=device).unsqueeze(1) +
+               torch.arange(-w, w + 1, device=device).unsqueeze(0))
+        valid = ((idx >= self.num_global_tokens) &
+                 (idx < max_length)).float()
+        if attention_mask is None:
+            return valid.unsqueeze(0).unsqueeze(0)
+        batch_size = attention_mask.size(0)
+        idx = idx.clamp(0, max_length - 1)
+        mask = (attention_mask
+                .expand(batch_size, max_length, max_length)
+                .gather(-1, idx.unsqueeze(0).expand(batch_size, -1, -1)))
+        return (mask * valid).unsqueeze(1)
+
+    def _cached_attention(self, q, k, v, attention_mask=None):
+        """
+        q => (B, H, Lq, A/H) the last Lq of the Lk cached positions
+        k, v => (B, H, Lk, A/H)
+        attention_mask => (B, 1, Lk) or (B, Lq, Lk)
+        out => (B, H, Lq, A/H), (B, H, Lq, Lk)
+        """
+        max_length = k.size(2)
+        query_positions = torch.arange(
+            max_length - q.size(2), max_length, device=q.device).unsqueeze(1)
+        key_positions = torch.arange(
+            max_length, device=q.device).unsqueeze(0)
+        g = self.num_global_tokens
+        mask = (((key_positions - query_positions).abs() <= self.window_size)
+                | (key_positions < g) | (query_positions < g)).float()
+        if attention_mask is not None:
+            mask = mask * attention_mask
+        else:
+            mask = mask.unsqueeze(0)
+        return self._dense_attention(q, k, v, attention_mask=mask.unsqueeze(1))
+
+    def forward(self, x, queries=None, values=None, attention_mask=None,
+                return_weights=False, cache=None):
+        """
+        x : (B, L, D)
+        attention_mask : (B, 1, L) or (B, L, L)
+        return_weights : Also return the (B, H, L, g + 2w + 1) weights for
+            the global keys and the window of each query. With a cache the
+            (B, H, L, Lk) weights over all cached keys
+        cache : dict with the keys and values of previous decoding steps
+        """
+        if queries is None:
+            queries = x
+        if values is None:
+            values = x
+        if cache is not None:
+            q, k, v = self._project(x, queries, values, cache=cache)
+            out, scores = self._cached_attention(
+                q, k, v, attention_mask=attention_mask)
+            out = self.output(self._merge_heads(out))
+            if return_weights:
+                return out, scores
+            return out
+        # (B, H, L, A/H)
+        q, k, v = self._project(x, queries, values)
+        max_length = q.size(2)
+        g = self.num_global_tokens
+
+        # scores => (B, H, L, 2w+1)
+        scores = torch.matmul(
+            q.unsqueeze(-2), self._band(k).transpose(-1, -2)).squeeze(-2)
+        scores = scores / math.sqrt(self.dk)
+        window_mask = self._window_mask(attention_mask, max_length, q.device)
+        scores = scores + ((1 - window_mask) * -1e5)
+        if g > 0:
+            # Every query attends to the global keys => (B, H, L, g)
+            global_scores = (torch.matmul(q, k[:, :, :g].transpose(-1, -2)) /
+                             math.sqrt(self.dk))
+            if attention_mask is not None:
+                global_mask = attention_mask.unsqueeze(1)[..., :g]
+                global_scores = global_scores + ((1 - global_mask) * -1e5)
+            scores = torch.cat((global_scores, scores), dim=-1)
+        scores = F.softmax(scores, dim=-1)
+        scores = self.drop(scores)
+
+        # out => (B, H, L, A/H)
+        out = torch.matmul(
+            scores[..., g:].unsqueeze(-2), self._band(v)).squeeze(-2)
+        if g > 0:
+            out = out + torch.matmul(scores[..., :g], v[:, :, :g])
+            # Global queries attend to every key
+            mask = (attention_mask.unsqueeze(1)[..., :g, :]
+                    if attention_mask is not None else None)
+            if mask is not None and mask.size(-2) == 1:
+                mask = mask.expand(-1, -1, min(g, max_length), -1)
+            global_out, _ = self._dense_attention(
+                q[:, :, :g], k, v, attention_mask=mask)
+            out = torch.cat((global_out, out[:, :, g:]), dim=2)
+        out = self._merge_heads(out)
+        out = self.output(out)
+        if return_weights:
+            return out, scores
+        return out
+
+
+class LinearAttention(MultiheadAttentionParallel):
+    """Kernelized multihead attention with linear cost in sequence length.
+    Link: https://arxiv.org/abs/2006.16236
+
+    softmax(q k^T) v is replaced by phi(q) (phi(k)^T v) normalized by
+    phi(q) sum(phi(k)), so the (L, L) score matrix is never formed.
+    The causal variant uses prefix sums of phi(k)^T v over positions,
+    computed blockwise: a masked (chunk_size, chunk_size) product inside
+    each block and a running (F, A/H) state carried across blocks.
+
+    Feature maps:
+        elu: phi(x) = elu(x) + 1
+        favor: positive random features approximating the softmax kernel
+            (https://arxiv.org/abs/2009.14794) with num_features features
+
+    Masks are reduced to key padding masks (the last row of a (B, L, L)
+    mask). Other masks, e.g. the block diagonal masks of packed batches,
+    raise a ValueError. The check waits for the device, so only the first
+    (B, L, L) mask of a module is checked. Use causal=True for decoder
+    self attention. For incremental decoding the cache holds the running
+    sums instead of past keys.
+    """
+    def __init__(self,
+                 attention_size=512,
+                 num_heads=8,
+                 input_size=None,
+                 dropout=.1,
+                 feature_map='elu',
+                 num_features=None,
+                 causal=False,
+                 chunk_size=64,
+                 eps=1e-6,
+                 fused_qkv=False):
+        super(LinearAttention, self).__init__(
+            attention_size=attention_size,
+            num_heads=num_heads,
+            input_size=input_size,
+            dropout=dropout,
+            fused_qkv=fused_qkv)
+        if feature_map not in ('elu', 'favor'):
+            raise ValueError(f"Unknown feature map {feature_map}. "
+                             "Use one of 'elu', 'favor'")
+        self.feature_map = feature_map
+        self.causal = causal
+        self.chunk_size = chunk_size
+        self.eps = eps
+        self.mask_checked = False
+        if feature_map == 'favor':
+            if num_features is None:
+                num_features = self.head_size
+            self.register_buffer(
+                'projection', torch.randn(self.head_size, num_features))
+
+    def _features(self, x, is_query):
+        """
+        x => (B, H, L, A/H)
+        out => (B, H, L, F). The log features for favor causal keys, which
+            _causal_attention stabilizes blockwise
+        """
+        if self.feature_map == 'elu':
+            return F.elu(x) + 1
+        # Scale so that phi(q) phi(k) approximates exp(q k / sqrt(dk))
+        x = x / (self.dk ** .25)
+        proj = torch.matmul(x, self.projection)
+        proj = proj - (x ** 2).sum(-1, keepdim=True) / 2
+        # Stabilizers cancel out in the normalization. Keys share one
+        # stabilizer
+        if is_query:
+            proj = proj - proj.max(-1, keepdim=True)[0]
+        elif self.causal:
+            return proj
+        else:
+            proj = proj - (proj.max(-1, keepdim=True)[0]
+                           .max(-2, keepdim=True)[0])
+        return self._exp_features(proj)
+
+    def _exp_features(self, proj):
+        return torch.exp(proj) / math.sqrt(self.projection.size(-1))
+
+    def _causal_attention(self, q, k, v, key_mask=None, state=None,
+                          k_sum=None, k_max=None):
+        """
+        q => (B, H, L, F)
+        k => (B, H, L, F) features, or log features for favor
+        v => (B, H, L, A/H)
+        key_mask => (B, 1, L, 1)
+        state, k_sum => running sums of k^T v and k of previous positions
+        k_max => (B, H, 1, 1) stabilizer of the favor keys in the sums
+        out => (B, H, L, A/H), (B, H, L, 1) unnormalized output, normalizer
+            and the updated running sums and stabilizer
+        """
+        c = self.chunk_size
+        causal_mask = torch.ones(c, c, device=q.device).tril()
+        # Running sums of k^T v and k over the previous blocks
+        if state is None:
+            state = q.new_zeros(q.size()[:2] + (q.size(-1), v.size(-1)))
+            k_sum = q.new_zeros(q.size()[:2] + (1, q.size(-1)))
+        out, normalizer = [], []
+        for i in range(0, q.size(2), c):
+            q_b, k_b, v_b = (t[:, :, i:i + c] for t in (q, k, v))
+            if self.feature_map == 'favor':
+                # Running max of the key log features. The sums of the
+                # previous blocks are rescaled when it grows, as in an
+                # online softmax. Keys of a block share their stabilizer,
+                # so very large activations can underflow the features of
+                # the first positions of a block
+                block_max = (k_b.max(-1, keepdim=True)[0]
+                             .max(-2, keepdim=True)[0])
+                if k_max is None:
+                    k_max = block_max
+                else:
+                    new_max = torch.max(k_max, block_max)
+                    correction = torch.exp(k_max - new_max)
+                    state, k_sum = state * correction, k_sum * correction
+                    k_max = new_max
+                k_b = self._exp_features(k_b - k_max)
+            if key_mask is not None:
+                k_b = k_b * key_mask[:, :, i:i + c]
+            length = q_b.size(2)
+            scores = (torch.matmul(q_b, k_b.transpose(-1, -2)) *
+                      causal_mask[:length, :length])
+            out.append(torch.matmul(scores, v_b) + torch.matmul(q_b, state))
+            normalizer.append(scores.sum(-1, keepdim=True) +
+                              (q_b * k_sum).sum(-1, keepdim=True))
+            state = state + torch.matmul(k_b.transpose(-1, -2), v_b)
+            k_sum = k_sum + k_b.sum(2, keepdim=True)
+        return (torch.cat(out, dim=2), torch.cat(normalizer, dim=2),
+                state, k_sum, k_max)
+
+    def _check_padding_mask(self, attention_mask):
+        """attention_mask => (B, 1, Lk) or (B, Lq, Lk). Every row must be
+        the key padding mask, cut to the past positions if causal
+        """
+        if attention_mask.size(-2) == 1 or self.mask_checked:
+            return
+        num_queries, num_keys = attention_mask.size()[-2:]
+        expected = attention_mask[:, -1:].expand_as(attention_mask)
+        if self.causal:
+            expected = expected * torch.ones(
+                num_queries, num_keys, device=attention_mask.device).tril(
+                    num_keys - num_queries)
+        if not torch.equal(attention_mask, expected):
+            raise ValueError('LinearAttention only supports padding (and '
+                             'causal) masks, e.g. not packed sequences')
+        self.mask_checked = True
+
+    def forward(self, x, queries=None, values=None, attention_mask=None,
+                return_weights=False, cache=None):
+        """
+        x : (B, L, D)
+        queries : (B, L, D)
+        values : (B, L, D)
+        cache : dict with the running sums of previous decoding steps
+        """
+        if return_weights:
+            raise ValueError('LinearAttention does not compute '
+                             'attention weights')
+        if queries is None:
+            queries = x
+        if values is None:
+            values = x
+        if cache is not None and 'kv' in cache:
+            # Static keys and values, e.g. the encoder output
+            q = self._features(self._project_queries(queries), True)
+            kv, k_sum = cache['kv'], cache['k_sum']
+        else:
+            # (B, H, L, A/H)
+            q, k, v = self._project(x, queries, values)
+            q = self._features(q, True)
+            k = self._features(k, False)
+            key_mask = None
+            if attention_mask is not None:
+                self._check_padding_mask(attention_mask)
+                # (B, L) => (B, 1, L, 1)
+                key_mask = attention_mask[:, -1].unsqueeze(1).unsqueeze(-1)
+            if self.causal:
+                state, k_sum, k_max = None, None, None
+                if cache is not None and 'state' in cache:
+                    state, k_sum = cache['state'], cache['k_sum']
+                    k_max = cache.get('k_max')
+                out, normalizer, state, k_sum, k_max = (
+                    self._causal_attention(q, k, v, key_mask=key_mask,
+                                           state=state, k_sum=k_sum,
+                                           k_max=k_max))
+                if cache is not None:
+                    cache['state'], cache['k_sum'] = state, k_sum
+                    if k_max is not None:
+                        cache['k_max'] = k_max
+            else:
+                if key_mask is not None:
+                    k = k * key_mask
+                # (B, H, F, A/H), (B, H, 1, F)
+                kv = torch.matmul(k.transpose(-1, -2), v)
+                k_sum = k.sum(2, keepdim=True)
+                if cache is not None:
+                    cache['kv'], cache['k_sum'] = kv, k_sum
+        if not self.causal:
+            normalizer = torch.matmul(q, k_sum.transpose(-1, -2))
+            out = torch.matmul(q, kv)
+        out = out / (normalizer + self.eps)
+        out = self._merge_heads(out)
+        out = self.output(out)
+        return out
+
 
 MultiheadAttention = MultiheadAttentionParallel
+
+ATTENTION_TYPES = {
+    'full': MultiheadAttentionParallel,
+    'local': SlidingWindowAttention,
+    'linear': LinearAttention,
+}
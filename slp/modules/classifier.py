@@ -1,16 +1,38 @@
+import inspect
+
+import torch
 import torch.nn as nn
 
+from typing import Optional
+
 from slp.modules.feedforward import FF
 
 
 class Classifier(nn.Module):
+    __constants__ = ['takes_lengths']
+
     def __init__(self, encoder, encoded_features, num_classes):
         super(Classifier, self).__init__()
         self.encoder = encoder
+        # Scripted modules cannot check the encoder signature at call time
+        self.takes_lengths = (
+            'lengths' in inspect.signature(encoder.forward).parameters)
         self.clf = FF(encoded_features, num_classes,
                       activation='none', layer_norm=False,
                       dropout=0.)
 
-    def forward(self, *args, **kwargs):
-        x = self.encoder(*args, **kwargs)
+    def forward(self, x, lengths: Optional[torch.Tensor] = None):
+        """x => (B, L) lengths => (B,). The encoder gets lengths only if
+        given, e.g. encoder(x, lengths) or encoder(x) => (B, D)
+        """
+        if not torch.jit.is_scripting():
+            if lengths is None:
+                return self.clf(self.encoder(x))
+            return self.clf(self.encoder(x, lengths))
+        if self.takes_lengths:
+            if lengths is None:
+                raise ValueError('The encoder needs the lengths')
+            x = self.encoder(x, lengths)
+        else:
+            x = self.encoder(x)
         return self.clf(x)
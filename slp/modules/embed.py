@@ -1,6 +1,8 @@
 import torch
 import torch.nn as nn
 
+from typing import Optional
+
 from slp.modules.regularization import GaussianNoise
 from slp.util import log
 
@@ -11,6 +13,8 @@ class PositionalEncoding(nn.Module):
     PE(pos,2i)=sin(pos/10000^(2i/dmodel))
     PE(pos,2i+1)=cos(pos/10000^(2i/dmodel))
     """
+    pe: torch.Tensor
+
     def __init__(self, max_length, embedding_dim=512, device='cpu'):
         super(PositionalEncoding, self).__init__()
         self.max_length = max_length
@@ -31,10 +35,14 @@ class PositionalEncoding(nn.Module):
         pe = pe.unsqueeze(0)
         self.register_buffer('pe', pe)
 
-    def forward(self, x):
+    def forward(self, x, positions: Optional[torch.Tensor] = None):
         """
         x => (B, L, E) sequence of embedded tokens
+        positions => (B, L) optional position of each token, e.g. for
+            packed sequences where positions restart for every example
         """
+        if positions is not None:
+            return x + self.pe[0, positions]
         # (B, L, E)
         return x + self.pe[:, :x.size(1)]
 
@@ -47,7 +55,8 @@ class Embed(nn.Module):
                  noise=.0,
                  dropout=.0,
                  scale=1.,
-                 trainable=False):
+                 trainable=False,
+                 factorized_dim=None):
         """
         Define the layer of the model and perform the initializations
         of the layers (wherever it is necessary)
@@ -56,12 +65,19 @@ class Embed(nn.Module):
             noise (float):
             dropout (float):
             trainable (bool):
+            factorized_dim (int): If set, the embedding table has this size
+                and is projected to embedding_dim (ALBERT style)
         """
         super(Embed, self).__init__()
         self.scale = scale  # scale embeddings by value. Needed for transformer
         # define the embedding layer, with the corresponding dimensions
-        self.embedding = nn.Embedding(num_embeddings=num_embeddings,
-                                      embedding_dim=embedding_dim)
+        self.embedding = nn.Embedding(
+            num_embeddings=num_embeddings,
+            embedding_dim=factorized_dim or embedding_dim)
+        self.projection = None
+        if factorized_dim is not None:
+            self.projection = nn.Linear(
+                factorized_dim, embedding_dim, bias=False)
 
         if embeddings is not None:
             log.info("Initializing Embedding layer with pre-trained weights!")
@@ -87,6 +103,9 @@ class Embed(nn.Module):
         """
         embeddings = self.embedding(x)
 
+        if self.projection is not None:
+            embeddings = self.projection(embeddings)
+
         if self.noise.stddev > 0:
             embeddings = self.noise(embeddings)
 
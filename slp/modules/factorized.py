@@ -0,0 +1,122 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from slp.util import log
+
+
+class FactorizedLinear(nn.Module):
+    """Low rank drop in replacement for nn.Linear. W ≈ U V, where
+    U => (out_features, rank) and V => (rank, in_features), so the layer
+    costs rank * (in_features + out_features) instead of
+    in_features * out_features weights and multiply adds per token.
+
+    weight returns the dense product for code that slices the weight of
+    a Linear (e.g. fused_qkv cross attention).
+    """
+    def __init__(self, in_features, out_features, rank, bias=True):
+        super(FactorizedLinear, self).__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.rank = rank
+        self.v = nn.Parameter(torch.empty(rank, in_features))
+        self.u = nn.Parameter(torch.empty(out_features, rank))
+        if bias:
+            self.bias = nn.Parameter(torch.zeros(out_features))
+        else:
+            self.register_parameter('bias', None)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # U V has the variance of a xavier initialized (out, in) weight
+        std = (2. / (self.in_features + self.out_features)) ** .5
+        std = (std / self.rank ** .5) ** .5
+        nn.init.normal_(self.v, std=std)
+        nn.init.normal_(self.u, std=std)
+        if self.bias is not None:
+            nn.init.constant_(self.bias, 0.)
+
+    @property
+    def weight(self):
+        return torch.matmul(self.u, self.v)
+
+    def forward(self, x):
+        return F.linear(F.linear(x, self.v), self.u, self.bias)
+
+    @staticmethod
+    def rank_for_energy(singular_values, energy):
+        """Smallest rank that keeps energy of the squared singular values"""
+        if not 0 < energy <= 1:
+            raise ValueError(f'energy should be in (0, 1]. Got {energy}')
+        kept = singular_values.pow(2).cumsum(0)
+        kept = kept / kept[-1]
+        return int((kept < energy).sum().item()) + 1
+
+    @classmethod
+    def from_linear(cls, linear, rank=None, energy=None):
+        """Truncated SVD of a trained nn.Linear. Pass either a fixed rank
+        or the fraction of spectral energy to keep
+        """
+        if (rank is None) == (energy is None):
+            raise ValueError('Pass exactly one of rank and energy')
+        weight = linear.weight.detach()
+        u, s, v = torch.svd(weight.float())
+        if rank is None:
+            rank = cls.rank_for_energy(s, energy)
+        rank = min(rank, s.size(0))
+        layer = cls(linear.in_features, linear.out_features, rank,
+                    bias=linear.bias is not None)
+        # Split the singular values evenly between the two factors
+        root_s = s[:rank].sqrt()
+        with torch.no_grad():
+            layer.u.copy_(u[:, :rank] * root_s)
+            layer.v.copy_(root_s.unsqueeze(-1) * v[:, :rank].t())
+            if linear.bias is not None:
+                layer.bias.copy_(linear.bias)
+        return layer.to(device=weight.device, dtype=weight.dtype)
+
+    def to_linear(self):
+        """Merge the factors back into a dense nn.Linear"""
+        linear = nn.Linear(self.in_features, self.out_features,
+                           bias=self.bias is not None)
+        with torch.no_grad():
+            linear.weight.copy_(self.weight)
+            if self.bias is not None:
+                linear.bias.copy_(self.bias)
+        return linear.to(device=self.u.device, dtype=self.u.dtype)
+
+    def extra_repr(self):
+        return (f'in_features={self.in_features}, '
+                f'out_features={self.out_features}, rank={self.rank}, '
+                f'bias={self.bias is not None}')
+
+
+def factorize_linear(model, rank=None, energy=None, exclude=()):
+    """Replace the nn.Linear layers of a trained model with
+    FactorizedLinear in place, with a truncated SVD of their weights.
+    Layers whose name starts with one of exclude (e.g. the output layer
+    'predict') or that would not get smaller are kept dense.
+
+    The factors are regular parameters, so the model can be fine tuned
+    afterwards to recover accuracy, e.g. with a small learning rate.
+    Returns the {name: rank} of the replaced layers
+    """
+    replaced, factorized = {}, {}
+    for name, child in model.named_modules():
+        if type(child) is not nn.Linear:
+            continue
+        if any(name.startswith(e) for e in exclude):
+            continue
+        layer = FactorizedLinear.from_linear(child, rank=rank, energy=energy)
+        if layer.u.numel() + layer.v.numel() >= child.weight.numel():
+            continue
+        factorized[id(child)] = layer
+        replaced[name] = layer.rank
+    # A layer can be registered in more than one parent, e.g. ff2 and
+    # net.2 in PositionwiseFF. Replace every reference
+    for module in model.modules():
+        for child_name, child in list(module.named_children()):
+            if id(child) in factorized:
+                setattr(module, child_name, factorized[id(child)])
+    log.info(f'Factorized {len(replaced)} linear layers')
+    return replaced
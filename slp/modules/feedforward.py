@@ -1,5 +1,9 @@
 import itertools
+import math
+
+import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from slp.util import log
 from slp.modules.norm import LayerNorm
@@ -24,14 +28,16 @@ class FF(nn.Module):
             self.activation = self.activation()
         self.layer_norm = None
         if layer_norm:
-            self.layer_norm = LayerNorm(n_out)
+            self.layer_norm = LayerNorm(n_out, dropout=dropout)
         self.drop = nn.Dropout(dropout)
 
     def forward(self, x):
         out = self.fc(x)
-        out = self.drop(out)
         if self.layer_norm is not None:
+            # dropout is applied inside layer_norm
             out = self.layer_norm(out)
+        else:
+            out = self.drop(out)
         if self.activation is not None:
             out = self.activation(out)
         return out
@@ -73,3 +79,109 @@ class MultilayerFF(nn.Module):
 
     def forward(self, x):
         return self.net(x)
+
+
+class MoEPositionwiseFF(nn.Module):
+    """Mixture of experts PositionwiseFF.
+    Link: https://arxiv.org/abs/2101.03961
+
+    A router sends every token to its top_k experts. Each expert holds at
+    most capacity_factor * N * top_k / num_experts tokens, the rest are
+    dropped (their output is 0 and the residual passes them through).
+    Tokens are sorted by expert and scattered into a (E, C, D) buffer, so
+    all experts run in one batched matmul.
+
+    aux_loss holds the weighted load balancing loss
+    num_experts * sum_e(fraction of tokens to e * mean router prob of e).
+    It is summed over the forward calls until it is cleared with
+    slp.trainer.metrics.clear_aux_loss, so a layer applied several times,
+    e.g. with shared layer weights, trains all its routers. Trainer adds
+    it to the loss and clears it. It keeps its graph only in training mode
+    with gradients enabled, so checkpointed and reversible layers cannot
+    use MoE. It is not copied or pickled with the module.
+    """
+    def __init__(self, d_model, d_ff, num_experts=8, top_k=2,
+                 capacity_factor=1.25, aux_loss_weight=.01, dropout=.1):
+        super(MoEPositionwiseFF, self).__init__()
+        self.num_experts = num_experts
+        self.top_k = top_k
+        self.capacity_factor = capacity_factor
+        self.aux_loss_weight = aux_loss_weight
+        self.router = nn.Linear(d_model, num_experts, bias=False)
+        self.w1 = nn.Parameter(torch.empty(num_experts, d_model, d_ff))
+        self.b1 = nn.Parameter(torch.zeros(num_experts, 1, d_ff))
+        self.w2 = nn.Parameter(torch.empty(num_experts, d_ff, d_model))
+        self.b2 = nn.Parameter(torch.zeros(num_experts, 1, d_model))
+        self.drop = nn.Dropout(dropout)
+        self.aux_loss = None
+        self.reset_parameters()
+
+    def __getstate__(self):
+        # aux_loss can hold the autograd graph, which cannot be copied
+        state = self.__dict__.copy()
+        state['aux_loss'] = None
+        return state
+
+    def reset_parameters(self):
+        for w in (self.w1, self.w2):
+            for i in range(self.num_experts):
+                nn.init.xavier_uniform_(w.data[i])
+        # Zero like the biases of the dense layers
+        nn.init.zeros_(self.b1)
+        nn.init.zeros_(self.b2)
+
+    def capacity(self, num_tokens):
+        return int(math.ceil(self.capacity_factor * num_tokens *
+                             self.top_k / self.num_experts))
+
+    def forward(self, x):
+        """x => (..., D)"""
+        shape = x.size()
+        x = x.reshape(-1, shape[-1])
+        num_tokens, num_experts = x.size(0), self.num_experts
+        probs = F.softmax(self.router(x), dim=-1)
+        # (N, k)
+        gates, experts = probs.topk(self.top_k, dim=-1)
+        gates = gates / gates.sum(-1, keepdim=True)
+        top1 = F.one_hot(experts[:, 0], num_experts).to(probs.dtype)
+        aux_loss = self.aux_loss_weight * num_experts * (
+            top1.mean(0) * probs.mean(0)).sum()
+        if not (self.training and torch.is_grad_enabled()):
+            aux_loss = aux_loss.detach()
+        if self.aux_loss is not None:
+            aux_loss = self.aux_loss + aux_loss
+        self.aux_loss = aux_loss
+        # Flatten choice major, so that first choices get capacity first
+        experts = experts.t().reshape(-1)
+        gates = gates.t().reshape(-1)
+        tokens = torch.arange(num_tokens, device=x.device).repeat(
+            self.top_k)
+        # Stable sort by expert
+        order = (experts * experts.numel() +
+                 torch.arange(experts.numel(), device=x.device)).argsort()
+        experts, gates, tokens = experts[order], gates[order], tokens[order]
+        counts = torch.bincount(experts, minlength=num_experts)
+        starts = counts.cumsum(0) - counts
+        position = torch.arange(experts.numel(), device=x.device)
+        position = position - starts[experts]
+        capacity = self.capacity(num_tokens)
+        keep = position < capacity
+        slots = experts[keep] * capacity + position[keep]
+        tokens, gates = tokens[keep], gates[keep]
+        # (E * C, D) => (E, C, D)
+        dispatched = x.new_zeros(num_experts * capacity, shape[-1])
+        dispatched = dispatched.index_copy(0, slots, x[tokens])
+        dispatched = dispatched.view(num_experts, capacity, -1)
+        hidden = F.relu(torch.baddbmm(self.b1, dispatched, self.w1))
+        hidden = self.drop(hidden)
+        out = torch.baddbmm(self.b2, hidden, self.w2)
+        out = out.view(num_experts * capacity, -1)[slots]
+        combined = x.new_zeros(num_tokens, shape[-1]).index_add(
+            0, tokens, out * gates.unsqueeze(-1))
+        return combined.view(shape)
+
+
+FEEDFORWARD_TYPES = {
+    'dense': PositionwiseFF,
+    'moe': MoEPositionwiseFF,
+}
@@ -1,6 +1,6 @@
 import torch.nn as nn
 from torch.nn.utils.rnn import (
-    pack_padded_sequence, pad_packed_sequence)
+    PackedSequence, pack_padded_sequence, pad_packed_sequence)
 
 
 class PadPackedSequence(nn.Module):
@@ -9,11 +9,11 @@ class PadPackedSequence(nn.Module):
         super(PadPackedSequence, self).__init__()
         self.batch_first = batch_first
 
-    def forward(self, x, lengths):
-        max_length = lengths.max().item()
-        x, _ = pad_packed_sequence(
+    def forward(self, x: PackedSequence, lengths):
+        max_length = int(lengths.max())
+        out, _ = pad_packed_sequence(
             x, batch_first=self.batch_first, total_length=max_length)
-        return x
+        return out
 
 
 class PackSequence(nn.Module):
@@ -26,5 +26,6 @@ class PackSequence(nn.Module):
             x, lengths,
             batch_first=self.batch_first,
             enforce_sorted=False)
-        lengths = lengths[x.sorted_indices]
-        return x, lengths
+        sorted_indices = x.sorted_indices
+        assert sorted_indices is not None
+        return x, lengths[sorted_indices]
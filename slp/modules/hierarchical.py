@@ -0,0 +1,63 @@
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class HierarchicalEncoder(nn.Module):
+    """Encode long documents as a sequence of fixed size chunks.
+
+    The padded batch is split into chunks of chunk_size tokens. All
+    non empty chunks of all documents are encoded by the wrapped encoder
+    in a single batched pass and the chunk encodings of each document are
+    pooled into one vector. Compute per document then grows linearly with
+    its length and the sequence length seen by the encoder is bounded by
+    chunk_size.
+
+    Args:
+        encoder (nn.Module): Sequence encoder called as encoder(x, lengths)
+            that returns one (N, D) vector per sequence, e.g. WordRNN
+        chunk_size (int): Tokens per chunk
+        pooling (str): 'mean' or 'max' over the chunks of a document
+    """
+    def __init__(self, encoder, chunk_size=128, pooling='mean'):
+        super(HierarchicalEncoder, self).__init__()
+        if pooling not in ('mean', 'max'):
+            raise ValueError(f"Unknown pooling {pooling}. "
+                             "Use one of 'mean', 'max'")
+        self.encoder = encoder
+        self.chunk_size = chunk_size
+        self.pooling = pooling
+
+    def _pool(self, chunks, chunk_mask):
+        """
+        chunks => (B, C, D)
+        chunk_mask => (B, C)
+        out => (B, D)
+        """
+        mask = chunk_mask.unsqueeze(-1)
+        if self.pooling == 'max':
+            return chunks.masked_fill(~mask, -math.inf).max(1)[0]
+        return ((chunks * mask.type_as(chunks)).sum(1) /
+                mask.sum(1).type_as(chunks))
+
+    def forward(self, x, lengths):
+        """
+        x => (B, L) token ids
+        lengths => (B,)
+        """
+        batch_size, max_length = x.size()[:2]
+        num_chunks = int(math.ceil(max_length / self.chunk_size))
+        x = F.pad(x, [0, num_chunks * self.chunk_size - max_length])
+        # (B * C, chunk_size)
+        chunks = x.view(batch_size * num_chunks, self.chunk_size)
+        offsets = torch.arange(0, num_chunks, device=x.device)
+        chunk_lengths = ((lengths.unsqueeze(1) - offsets * self.chunk_size)
+                         .clamp(0, self.chunk_size)
+                         .view(-1))
+        valid = chunk_lengths > 0
+        encoded = self.encoder(chunks[valid], chunk_lengths[valid])
+        out = encoded.new_zeros(batch_size * num_chunks, encoded.size(-1))
+        out[valid] = encoded
+        out = out.view(batch_size, num_chunks, -1)
+        return self._pool(out, valid.view(batch_size, num_chunks))
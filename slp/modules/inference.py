@@ -0,0 +1,105 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+from slp.modules.adaptive import AdaptiveInput
+from slp.modules.attention import MultiheadAttentionParallel
+from slp.modules.embed import Embed, PositionalEncoding
+from slp.modules.norm import LayerNorm
+from slp.modules.regularization import GaussianNoise
+from slp.modules.transformer import Sublayer3
+
+
+@torch.no_grad()
+def _fold_embedding_scale(module):
+    """Multiply the last layer of the embedding with scale. New
+    parameters are created, so weights tied with the output layer keep
+    their values
+    """
+    if isinstance(module, Embed):
+        if module.scale == 1:
+            return
+        layer = (module.projection if module.projection is not None
+                 else module.embedding)
+        layer.weight = nn.Parameter(layer.weight * module.scale)
+        module.scale = 1.
+    elif isinstance(module, AdaptiveInput):
+        if module.scale == 1:
+            return
+        first = module.embeddings[0]
+        first.weight = nn.Parameter(first.weight * module.scale)
+        for i, p in enumerate(module.projections):
+            module.projections[i] = nn.Parameter(p * module.scale)
+        module.scale = 1.
+
+
+def _strip_regularization(model):
+    """Replace Dropout and GaussianNoise with nn.Identity and disable the
+    dropout of LayerNorm. Embed skips its dropout and noise when they are
+    disabled, so they are only switched off there
+    """
+    for module in model.modules():
+        if isinstance(module, LayerNorm):
+            module.dropout = 0.
+        if isinstance(module, Embed):
+            module.dropout.p = 0.
+            module.noise.stddev = 0.
+            continue
+        for name, child in list(module.named_children()):
+            if isinstance(child, (nn.Dropout, GaussianNoise)):
+                setattr(module, name, nn.Identity())
+
+
+def optimize_for_inference(model, max_length=None):
+    """Frozen copy of model for inference. Outputs match the eval mode
+    model up to float rounding.
+
+    - The Embed / AdaptiveInput scale is folded into the weights
+    - Dropout and GaussianNoise modules are removed
+    - PositionalEncoding tables are cut to max_length positions
+    - Separate self attention q, k, v projections are merged (fuse_qkv_)
+    - All parameters have requires_grad=False
+
+    The returned model cannot be trained or loaded from a training
+    checkpoint.
+    """
+    model = copy.deepcopy(model).eval()
+    # Cross attention projects queries and keys from different inputs, so
+    # fusing would only slice the weights again
+    cross_attention = {id(m.sublayer) for m in model.modules()
+                       if isinstance(m, Sublayer3)}
+    for module in list(model.modules()):
+        _fold_embedding_scale(module)
+        if (isinstance(module, MultiheadAttentionParallel) and
+                id(module) not in cross_attention):
+            module.fuse_qkv_()
+        if isinstance(module, PositionalEncoding) and max_length is not None:
+            module.pe = module.pe[:, :max_length].contiguous()
+            module.max_length = module.pe.size(1)
+    _strip_regularization(model)
+    for p in model.parameters():
+        p.requires_grad_(False)
+    return model
+
+
+def export_torchscript(model, path=None, optimize=True, max_length=None):
+    """TorchScript version of model for inference without the Python
+    interpreter, e.g. from C++ or from threads that do not hold the GIL.
+    With optimize the model first goes through optimize_for_inference.
+    The scripted module is saved to path if given and returned.
+
+    Gradient checkpointing and chunked attention are training memory
+    savings and scripted modules always compute dense attention.
+    Attention weights (return_weights) are not returned by scripted
+    modules. Incremental decoding caches are copied when passed from
+    Python, so decode loops with a cache should run in eager mode.
+    """
+    if optimize:
+        model = optimize_for_inference(model, max_length=max_length)
+    else:
+        model = copy.deepcopy(model).eval()
+    scripted = torch.jit.script(model)
+    if path is not None:
+        torch.jit.save(scripted, path)
+    return scripted
@@ -0,0 +1,112 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class AdaptiveSoftmaxLoss(nn.Module):
+    """Negative log likelihood for a model with an AdaptiveSoftmax head.
+    The model returns hidden states instead of logits, e.g.
+    Transformer(..., return_hidden=True)
+
+    hidden => (N, D)
+    targets => (N,)
+    """
+    uses_hidden = True
+
+    def __init__(self, adaptive_softmax, ignore_index=-100):
+        super(AdaptiveSoftmaxLoss, self).__init__()
+        self.adaptive_softmax = adaptive_softmax
+        self.ignore_index = ignore_index
+
+    def forward(self, hidden, targets):
+        keep = targets != self.ignore_index
+        log_probs = self.adaptive_softmax(hidden[keep], targets[keep])
+        return -log_probs.mean()
+
+
+class _LinearCrossEntropy(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, hidden, weight, bias, targets, chunk_size, ignore_index):
+        """hidden => (N, D), weight => (V, D), bias => (V,), targets => (N,)
+        out => mean cross entropy of the non ignored targets
+        """
+        keep = targets != ignore_index
+        safe_targets = targets.masked_fill(~keep, 0)
+        lse = hidden.new_empty(hidden.size(0))
+        loss = hidden.new_zeros(())
+        for start in range(0, hidden.size(0), chunk_size):
+            end = start + chunk_size
+            logits = F.linear(hidden[start:end], weight, bias)
+            lse[start:end] = logits.logsumexp(-1)
+            target_logits = logits.gather(
+                1, safe_targets[start:end].unsqueeze(-1)).squeeze(-1)
+            loss += ((lse[start:end] - target_logits) *
+                     keep[start:end].to(logits.dtype)).sum()
+        num_targets = keep.sum()
+        ctx.save_for_backward(hidden, weight, bias, safe_targets, keep, lse,
+                              num_targets)
+        ctx.chunk_size = chunk_size
+        return loss / num_targets.to(loss.dtype)
+
+    @staticmethod
+    def backward(ctx, grad):
+        hidden, weight, bias, targets, keep, lse, num_targets = (
+            ctx.saved_tensors)
+        scale = grad / num_targets.to(grad.dtype)
+        grad_hidden = torch.zeros_like(hidden)
+        grad_weight = torch.zeros_like(weight)
+        grad_bias = torch.zeros_like(bias) if bias is not None else None
+        for start in range(0, hidden.size(0), ctx.chunk_size):
+            end = start + ctx.chunk_size
+            # Recompute the logits of the chunk. d loss / d logits is
+            # softmax - one_hot(target)
+            logits = F.linear(hidden[start:end], weight, bias)
+            d_logits = torch.exp(logits - lse[start:end].unsqueeze(-1))
+            d_logits.scatter_add_(
+                1, targets[start:end].unsqueeze(-1),
+                -torch.ones_like(d_logits[:, :1]))
+            d_logits *= (keep[start:end].to(d_logits.dtype) *
+                         scale).unsqueeze(-1)
+            grad_hidden[start:end] = d_logits.matmul(weight)
+            grad_weight += d_logits.t().matmul(hidden[start:end])
+            if grad_bias is not None:
+                grad_bias += d_logits.sum(0)
+        return grad_hidden, grad_weight, grad_bias, None, None, None
+
+
+def linear_cross_entropy(hidden, weight, bias, targets, chunk_size=1024,
+                         ignore_index=-100):
+    """cross_entropy(F.linear(hidden, weight, bias), targets) that never
+    holds more than chunk_size x V logits. The backward pass recomputes the
+    logits chunk by chunk instead of storing them.
+
+    hidden => (N, D)
+    weight => (V, D)
+    bias => (V,) or None
+    targets => (N,)
+    """
+    return _LinearCrossEntropy.apply(hidden, weight, bias, targets,
+                                     chunk_size, ignore_index)
+
+
+class LinearCrossEntropyLoss(nn.Module):
+    """Cross entropy for the output nn.Linear of a model that returns
+    hidden states, e.g. Transformer(..., return_hidden=True), computed in
+    chunks of tokens with linear_cross_entropy.
+
+    hidden => (N, D)
+    targets => (N,)
+    """
+    uses_hidden = True
+
+    def __init__(self, linear, chunk_size=1024, ignore_index=-100):
+        super(LinearCrossEntropyLoss, self).__init__()
+        self.linear = linear
+        self.chunk_size = chunk_size
+        self.ignore_index = ignore_index
+
+    def forward(self, hidden, targets):
+        return linear_cross_entropy(hidden, self.linear.weight,
+                                    self.linear.bias, targets,
+                                    chunk_size=self.chunk_size,
+                                    ignore_index=self.ignore_index)
@@ -1,19 +1,34 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+
+from typing import Optional
 
 
 class LayerNorm(nn.Module):
-    def __init__(self, hidden_size, eps=1e-12):
+    def __init__(self, hidden_size, eps=1e-12, dropout=0.):
         """Construct a layernorm module in the TF style (epsilon inside the square root).
         Link: https://github.com/huggingface/pytorch-pretrained-BERT/blob/master/pytorch_pretrained_bert/modeling.py#L234  # noqa: E501
+
+        The forward pass optionally applies dropout to the input and adds a
+        residual before normalizing, using the F.layer_norm kernel instead of
+        separate elementwise ops.
         """
         super(LayerNorm, self).__init__()
         self.weight = nn.Parameter(torch.ones(hidden_size))
         self.bias = nn.Parameter(torch.zeros(hidden_size))
         self.variance_epsilon = eps
+        self.dropout = dropout
 
-    def forward(self, x):
-        u = x.mean(-1, keepdim=True)
-        s = (x - u).pow(2).mean(-1, keepdim=True)
-        x = (x - u) / torch.sqrt(s + self.variance_epsilon)
-        return self.weight * x + self.bias
+    def forward(self, x, residual: Optional[torch.Tensor] = None):
+        """
+        x => (..., D)
+        residual => (..., D) optional, added to the dropped out x
+        out => layer_norm(residual + dropout(x))
+        """
+        if self.dropout > 0:
+            x = F.dropout(x, p=self.dropout, training=self.training)
+        if residual is not None:
+            x = residual + x
+        return F.layer_norm(x, self.weight.shape, self.weight, self.bias,
+                            self.variance_epsilon)
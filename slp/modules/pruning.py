@@ -0,0 +1,339 @@
+import torch
+import torch.nn as nn
+
+from slp.modules.attention import MultiheadAttentionParallel
+from slp.modules.factorized import FactorizedLinear
+from slp.util import log
+
+
+def magnitude_masks(weights, sparsity, scope='global'):
+    """Masks that zero the sparsity fraction of weights with the smallest
+    magnitude. weights is a {name: tensor} dict. With scope='global' the
+    threshold is shared by all tensors, with scope='layer' every tensor is
+    pruned to sparsity on its own
+    """
+    if scope not in ('global', 'layer'):
+        raise ValueError(f'scope should be "global" or "layer". Got {scope}')
+
+    def threshold(values):
+        k = int(sparsity * values.numel())
+        if k == 0:
+            return -1.
+        return values.view(-1).kthvalue(k)[0].item()
+
+    if scope == 'global':
+        t = threshold(torch.cat([w.detach().abs().view(-1)
+                                 for w in weights.values()]))
+        return {name: (w.detach().abs() > t).to(w.dtype)
+                for name, w in weights.items()}
+    return {name: (w.detach().abs() > threshold(w.detach().abs()))
+            .to(w.dtype) for name, w in weights.items()}
+
+
+def _attention_modules(model):
+    return [(name, m) for name, m in model.named_modules()
+            if isinstance(m, MultiheadAttentionParallel)]
+
+
+def _out_weight(layer):
+    """Weight whose rows are the output features of a linear layer"""
+    return layer.u if isinstance(layer, FactorizedLinear) else layer.weight
+
+
+def _in_weight(layer):
+    """Weight whose columns are the input features of a linear layer"""
+    return layer.v if isinstance(layer, FactorizedLinear) else layer.weight
+
+
+def _head_views(attention):
+    """(H, ...) views of the weights of every head: its rows of the query,
+    key and value projections and its columns of the output layer
+    """
+    num_heads, size = attention.num_heads, attention.attention_size
+    if attention.fused_qkv:
+        w = _out_weight(attention.qkv)
+        rows = [w[i * size:(i + 1) * size] for i in range(3)]
+    else:
+        rows = [_out_weight(layer)
+                for layer in (attention.q, attention.k, attention.v)]
+    views = [r.view(num_heads, attention.head_size, -1) for r in rows]
+    cols = _in_weight(attention.output.fc)
+    views.append(cols.view(-1, num_heads, attention.head_size)
+                 .transpose(0, 1))
+    return views
+
+
+def head_norms(attention):
+    """(num_heads,) L2 norm of the weights of every head"""
+    return sum(v.detach().pow(2).flatten(1).sum(1)
+               for v in _head_views(attention)).sqrt()
+
+
+@torch.no_grad()
+def mask_heads(attention, mask):
+    """Zero the weights of the heads where the (num_heads,) mask is 0"""
+    for v in _head_views(attention):
+        v.mul_(mask.view(-1, *[1] * (v.dim() - 1)).to(v))
+
+
+class MagnitudePruner(object):
+    """Gradual magnitude pruning. Link: https://arxiv.org/abs/1710.01878
+
+    The weights of the nn.Linear layers of model (except the ones whose
+    name starts with one of exclude) are pruned from initial_sparsity to
+    sparsity between start_step and end_step with the cubic schedule
+    s_t = s + (s_i - s) * (1 - (t - start_step) / (end_step - start_step))^3
+    The masks are recomputed every frequency steps and applied after every
+    step, so that pruned weights stay zero while the optimizer updates the
+    rest. Call step from the training loop, or attach it to the trainer
+    with slp.trainer.handlers.PruningHandler. end_step=0 prunes once.
+
+    Zeroed weights only save compute in sparse kernels. With
+    structure='head' whole attention heads of MultiheadAttentionParallel
+    are pruned instead, ranked by the L2 norm of their weights, and
+    sparsity is the fraction of pruned heads. compact then removes them
+    from the layers, which makes CPU inference faster.
+
+    Args:
+        model (nn.Module): The model to prune
+        sparsity (float): Final fraction of zero weights or heads
+        scope (str): 'global' or 'layer' magnitude threshold
+        initial_sparsity (float): Sparsity at start_step
+        start_step (int): First pruning step
+        end_step (int): Step where sparsity is reached
+        frequency (int): Steps between mask updates
+        exclude (tuple): Module name prefixes to keep dense
+        structure (str): 'weight' or 'head'
+    """
+    def __init__(self, model, sparsity, scope='global', initial_sparsity=0.,
+                 start_step=0, end_step=0, frequency=100, exclude=(),
+                 structure='weight'):
+        if not 0 <= sparsity < 1:
+            raise ValueError(f'sparsity should be in [0, 1). Got {sparsity}')
+        if structure not in ('weight', 'head'):
+            raise ValueError('structure should be "weight" or "head". '
+                             f'Got {structure}')
+        self.sparsity = sparsity
+        self.scope = scope
+        self.initial_sparsity = initial_sparsity
+        self.start_step = start_step
+        self.end_step = max(end_step, start_step)
+        self.frequency = frequency
+        self.structure = structure
+        if structure == 'head':
+            modules = _attention_modules(model)
+        else:
+            modules = [(name, m) for name, m in model.named_modules()
+                       if type(m) is nn.Linear]
+        self.modules = {
+            name: m for name, m in modules
+            if not any(name.startswith(e) for e in exclude)}
+        self.masks = None
+
+    @property
+    def weights(self):
+        """{name: tensor} of the pruned weights, or head norms"""
+        if self.structure == 'head':
+            return {name: head_norms(m) for name, m in self.modules.items()}
+        return {f'{name}.weight': m.weight
+                for name, m in self.modules.items()}
+
+    def target_sparsity(self, step):
+        if step < self.start_step:
+            return 0.
+        if step >= self.end_step:
+            return self.sparsity
+        progress = (step - self.start_step) / (self.end_step - self.start_step)
+        return (self.sparsity + (self.initial_sparsity - self.sparsity) *
+                (1 - progress) ** 3)
+
+    def prune(self, sparsity):
+        self.masks = magnitude_masks(self.weights, sparsity, scope=self.scope)
+        self.apply_masks()
+
+    @torch.no_grad()
+    def apply_masks(self):
+        if self.masks is None:
+            return
+        if self.structure == 'head':
+            for name, m in self.modules.items():
+                mask_heads(m, self.masks[name])
+            return
+        for name, w in self.weights.items():
+            w.mul_(self.masks[name])
+
+    def _masks_match(self):
+        return all(mask.shape == w.shape
+                   for mask, w in zip(self.masks.values(),
+                                      self.weights.values()))
+
+    def step(self, step):
+        """Update the masks if step is a pruning step and apply them.
+        Masks are recomputed if the weights changed shape, e.g. after
+        prune_heads
+        """
+        if step < self.start_step:
+            return
+        if (self.masks is None or not self._masks_match() or
+                step == self.end_step or
+                step < self.end_step and
+                (step - self.start_step) % self.frequency == 0):
+            self.prune(self.target_sparsity(step))
+        else:
+            self.apply_masks()
+
+    def current_sparsity(self):
+        """Fraction of pruned weights or heads"""
+        weights = self.weights
+        zeros = sum(int((w == 0).sum()) for w in weights.values())
+        return zeros / sum(w.numel() for w in weights.values())
+
+
+def head_importance(model, batches, loss_fn):
+    """Importance of every attention head.
+    Link: https://arxiv.org/abs/1905.10650
+
+    The importance of a head is the absolute gradient of the loss with
+    respect to a gate multiplying its output, summed over examples.
+    loss_fn(model, batch) returns the loss of a batch. Scores are
+    normalized per layer. Returns {module name: (num_heads,) scores}
+    """
+    scores, handles = {}, []
+
+    def gate_hook(name, attention):
+        def hook(module, inputs):
+            # inputs[0] => (B, L, A) merged head outputs
+            out = inputs[0]
+            if not out.requires_grad:
+                return
+
+            def accumulate(grad):
+                # (B, H) gate gradient of every example
+                gate_grad = (out * grad).view(
+                    out.size(0), -1, attention.num_heads,
+                    attention.head_size).sum((1, 3))
+                scores[name] += gate_grad.abs().sum(0).detach().cpu()
+            out.register_hook(accumulate)
+        return hook
+
+    for name, m in _attention_modules(model):
+        scores[name] = torch.zeros(m.num_heads)
+        handles.append(
+            m.output.register_forward_pre_hook(gate_hook(name, m)))
+    try:
+        for batch in batches:
+            model.zero_grad()
+            loss_fn(model, batch).backward()
+    finally:
+        for h in handles:
+            h.remove()
+        model.zero_grad()
+    return {name: s / s.norm().clamp(min=1e-12) for name, s in scores.items()}
+
+
+def _select_(param, index, dim):
+    """Keep the slices of param in index along dim. The Parameter object
+    is kept, so references to it, e.g. in an optimizer, stay valid
+    """
+    with torch.no_grad():
+        param.data = param.index_select(dim, index)
+    param.grad = None
+
+
+def _select(layer, index, dim):
+    """Keep the output (dim=0) or input (dim=1) features in index"""
+    index = index.to(next(layer.parameters()).device)
+    if dim == 0:
+        _select_(_out_weight(layer), index, 0)
+        if layer.bias is not None:
+            _select_(layer.bias, index, 0)
+        layer.out_features = index.numel()
+    else:
+        _select_(_in_weight(layer), index, 1)
+        layer.in_features = index.numel()
+
+
+def prune_heads(attention, heads):
+    """Remove heads from a MultiheadAttentionParallel. The query, key and
+    value projections and the inputs of the output layer shrink, so the
+    pruned heads cost nothing at inference. The weights are resized in
+    place, so MagnitudePruner and the optimizer keep working on them, but
+    optimizer state such as Adam moments has the old shapes. Create the
+    optimizer after pruning heads or clear its state
+    """
+    heads = set(heads)
+    keep = [h for h in range(attention.num_heads) if h not in heads]
+    if not keep:
+        raise ValueError('Cannot prune all the heads of a layer')
+    if len(keep) == attention.num_heads:
+        return
+    head_size = attention.head_size
+    index = torch.cat([torch.arange(h * head_size, (h + 1) * head_size)
+                       for h in keep])
+    if attention.fused_qkv:
+        # Same rows from each of the q, k, v blocks
+        _select(attention.qkv,
+                torch.cat([index + i * attention.attention_size
+                           for i in range(3)]), 0)
+    else:
+        for layer in (attention.q, attention.k, attention.v):
+            _select(layer, index, 0)
+    _select(attention.output.fc, index, 1)
+    attention.num_heads = len(keep)
+    attention.attention_size = len(keep) * head_size
+
+
+def prune_heads_by_importance(model, importance, amount):
+    """Prune the amount fraction of heads with the lowest importance
+    (see head_importance) over all layers. Every layer keeps at least one
+    head. Returns {module name: pruned heads}
+    """
+    candidates = sorted(
+        (score.item(), name, h) for name, scores in importance.items()
+        for h, score in enumerate(scores))
+    remaining = {name: len(scores) for name, scores in importance.items()}
+    pruned = {name: [] for name in importance}
+    num_prune = int(amount * len(candidates))
+    for _, name, h in candidates:
+        if num_prune == 0:
+            break
+        if remaining[name] == 1:
+            continue
+        pruned[name].append(h)
+        remaining[name] -= 1
+        num_prune -= 1
+    modules = dict(_attention_modules(model))
+    for name, heads in pruned.items():
+        prune_heads(modules[name], heads)
+    log.info(f'Pruned {sum(len(h) for h in pruned.values())} heads')
+    return pruned
+
+
+def compact(model):
+    """Physically remove the attention heads that pruning left with no
+    effect on the output, i.e. all zero value projection or all zero
+    output columns, e.g. after MagnitudePruner with structure='head'.
+    Unstructured weight pruning rarely zeroes a whole head, so it does not
+    shrink the layers. Run after pruning is finished, since it changes
+    the weight shapes. Returns {module name: removed heads}
+    """
+    removed = {}
+    for name, m in _attention_modules(model):
+        if m.fused_qkv:
+            w_v = m.qkv.weight[2 * m.attention_size:]
+        else:
+            w_v = m.v.weight
+        w_v = w_v.detach().view(m.num_heads, m.head_size, -1)
+        w_out = m.output.fc.weight.detach().view(
+            -1, m.num_heads, m.head_size)
+        dead = ((w_v == 0).flatten(1).all(1) |
+                (w_out == 0).transpose(0, 1).flatten(1).all(1))
+        heads = dead.nonzero().view(-1).tolist()
+        if len(heads) == m.num_heads:
+            # Keep one head, the layer output is only the bias
+            heads = heads[1:]
+        if heads:
+            prune_heads(m, heads)
+            removed[name] = heads
+    log.info(f'Compacted {sum(len(h) for h in removed.values())} heads')
+    return removed
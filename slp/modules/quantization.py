@@ -0,0 +1,115 @@
+import copy
+import io
+import time
+
+import torch
+import torch.nn as nn
+
+from slp.util import log
+
+DYNAMIC_MODULES = (nn.Linear, nn.LSTM, nn.GRU)
+
+
+def quantize_dynamic(model, modules=DYNAMIC_MODULES, dtype=torch.qint8):
+    """Copy of model for CPU inference with int8 weights for the modules
+    of type in modules. Activations are quantized on the fly, so no
+    calibration is needed. Custom modules (LayerNorm, FF, attention) keep
+    working, since only their nn.Linear children are swapped and the
+    quantized layers take and return float tensors.
+    Module types without a quantized version in the installed torch stay
+    in float.
+    """
+    model = copy.deepcopy(model).eval()
+    return torch.quantization.quantize_dynamic(
+        model, qconfig_spec=set(modules), dtype=dtype)
+
+
+class _StaticQuantLinear(nn.Module):
+    """nn.Linear that quantizes its input with a calibrated scale and
+    dequantizes its output, so it can sit between float modules
+    """
+    def __init__(self, linear):
+        super(_StaticQuantLinear, self).__init__()
+        self.quant = torch.quantization.QuantStub()
+        self.linear = linear
+        self.dequant = torch.quantization.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.linear(self.quant(x)))
+
+
+def quantize_static(model, dataloader, forward_fn, num_batches=None,
+                    backend='fbgemm'):
+    """Copy of model with statically quantized nn.Linear layers.
+
+    Every nn.Linear gets its own quantize / dequantize pair, so the
+    custom LayerNorm, softmax attention and the rest of the model run in
+    float. The activation ranges are calibrated with forward_fn(model,
+    batch) on the first num_batches of dataloader. LSTM and GRU layers have
+    no static version and are quantized dynamically.
+    """
+    model = copy.deepcopy(model).eval()
+    torch.backends.quantized.engine = backend
+    wrapped = {}
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if type(child) is not nn.Linear:
+                continue
+            # Shared references (e.g. PositionwiseFF.ff2 and net.2) get
+            # the same wrapper
+            if id(child) not in wrapped:
+                wrapped[id(child)] = _StaticQuantLinear(child)
+                wrapped[id(child)].qconfig = (
+                    torch.quantization.get_default_qconfig(backend))
+            setattr(module, name, wrapped[id(child)])
+    torch.quantization.prepare(model, inplace=True)
+    with torch.no_grad():
+        for i, batch in enumerate(dataloader):
+            if num_batches is not None and i >= num_batches:
+                break
+            forward_fn(model, batch)
+    torch.quantization.convert(model, inplace=True)
+    return quantize_dynamic(model, modules=(nn.LSTM, nn.GRU))
+
+
+def model_size(model):
+    """Size of the serialized state dict in bytes"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def _accuracy(predictions, targets):
+    return (predictions.argmax(-1) == targets).float().mean().item()
+
+
+def quantization_report(model, quantized, dataloader, forward_fn,
+                        metric_fn=_accuracy):
+    """Compare a float model with its quantized copy on dataloader.
+    forward_fn(model, batch) returns (predictions, targets) and
+    metric_fn(predictions, targets) a float, accuracy by default.
+    Returns and logs the latency per batch, the size and the metric of
+    both models
+    """
+    report = {}
+    for name, m in (('float', model), ('int8', quantized)):
+        m.eval()
+        elapsed, metric, num_batches = 0., 0., 0
+        with torch.no_grad():
+            for batch in dataloader:
+                start = time.perf_counter()
+                predictions, targets = forward_fn(m, batch)
+                elapsed += time.perf_counter() - start
+                metric += metric_fn(predictions, targets)
+                num_batches += 1
+        report[name] = {
+            'latency': elapsed / num_batches * 1000,
+            'size': model_size(m) / 2 ** 20,
+            'metric': metric / num_batches}
+    log.info(
+        'Quantization report\n'
+        f'\t{"":>6} {"latency":>10} {"size":>10} {"metric":>8}\n' +
+        '\n'.join(f'\t{name:>6} {r["latency"]:>8.2f}ms '
+                  f'{r["size"]:>8.2f}MB {r["metric"]:>8.4f}'
+                  for name, r in report.items()))
+    return report
@@ -1,5 +1,6 @@
+import torch
+
 from torch import nn
-from torch.autograd import Variable
 
 
 class GaussianNoise(nn.Module):
@@ -16,9 +17,7 @@ class GaussianNoise(nn.Module):
 
     def forward(self, x):
         if self.training:
-            noise = Variable(x.data.new(x.size()).normal_(self.mean,
-                                                          self.stddev))
-            return x + noise
+            return x + torch.randn_like(x) * self.stddev + self.mean
         return x
 
     def __repr__(self):
@@ -9,6 +9,8 @@ from slp.modules.util import pad_mask
 
 
 class RNN(nn.Module):
+    __constants__ = ['packed_sequence']
+
     def __init__(self, input_size, hidden_size, batch_first=True,
                  layers=1, bidirectional=False, merge_bi='cat', dropout=0,
                  rnn_type='lstm', packed_sequence=True, device='cpu'):
@@ -66,12 +68,16 @@ class RNN(nn.Module):
         return self._merge_bi(last_forward_out, last_backward_out)
 
     def forward(self, x, lengths):
-        self.rnn.flatten_parameters()
-        if self.packed_sequence:
-            x, lengths = self.pack(x, lengths)
-        out, hidden = self.rnn(x)
+        if not torch.jit.is_scripting():
+            # Dynamically quantized RNNs have no flat weights
+            if isinstance(self.rnn, nn.RNNBase):
+                self.rnn.flatten_parameters()
         if self.packed_sequence:
-            out = self.unpack(out, lengths)
+            packed, lengths = self.pack(x, lengths)
+            packed_out, hidden = self.rnn(packed)
+            out = self.unpack(packed_out, lengths)
+        else:
+            out, hidden = self.rnn(x)
         out = self.drop(out)
 
         last_timestep = self._final_output(out, lengths)
@@ -107,8 +113,8 @@ class WordRNN(nn.Module):
         x = self.embed(x)
         out, last_hidden, _ = self.rnn(x, lengths)
         if self.attention is not None:
-            out, _ = self.attention(
-                out, attention_mask=pad_mask(lengths, device=self.device))
+            out = self.attention(
+                out, attention_mask=pad_mask(lengths).to(out.device))
             out = out.sum(1)
         else:
             out = last_hidden
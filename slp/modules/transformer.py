@@ -1,50 +1,81 @@
 import math
+from typing import Dict, List, Optional
 
+import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
-from slp.modules.attention import MultiheadAttention
+from slp.modules.adaptive import AdaptiveInput, AdaptiveSoftmax
+from slp.modules.attention import ATTENTION_TYPES, MultiheadAttention
 from slp.modules.embed import PositionalEncoding, Embed
-from slp.modules.feedforward import PositionwiseFF
+from slp.modules.feedforward import FEEDFORWARD_TYPES, MoEPositionwiseFF
 from slp.modules.norm import LayerNorm
-from slp.modules.util import repeat_layer
+from slp.modules.util import repeat_layer, run_layers
 
 
 class Sublayer1(nn.Module):
-    def __init__(self, hidden_size=512, num_heads=8, dropout=.1):
+    def __init__(self, hidden_size=512, num_heads=8, dropout=.1,
+                 attention_type='full', attention_kwargs=None):
         super(Sublayer1, self).__init__()
+        if attention_kwargs is None:
+            attention_kwargs = {}
         self.lnorm = LayerNorm(hidden_size)
-        self.sublayer = MultiheadAttention(
+        self.sublayer = ATTENTION_TYPES[attention_type](
             attention_size=hidden_size,
             num_heads=num_heads,
-            dropout=dropout)
+            dropout=dropout,
+            fused_qkv=True,
+            **attention_kwargs)
 
-    def forward(self, x, attention_mask=None):
-        return self.lnorm(x + self.sublayer(x, attention_mask=attention_mask))
+    def forward(self,
+                x,
+                attention_mask: Optional[torch.Tensor] = None,
+                cache: Optional[Dict[str, torch.Tensor]] = None):
+        return self.lnorm(
+            self.sublayer(x, attention_mask=attention_mask, cache=cache),
+            residual=x)
 
 
 class Sublayer2(nn.Module):
-    def __init__(self, hidden_size=512, inner_size=2048, dropout=.1):
+    def __init__(self, hidden_size=512, inner_size=2048, dropout=.1,
+                 feedforward_type='dense', feedforward_kwargs=None):
         super(Sublayer2, self).__init__()
+        if feedforward_kwargs is None:
+            feedforward_kwargs = {}
         self.lnorm = LayerNorm(hidden_size)
-        self.sublayer = PositionwiseFF(
-            hidden_size, inner_size, dropout=dropout)
+        self.sublayer = FEEDFORWARD_TYPES[feedforward_type](
+            hidden_size, inner_size, dropout=dropout, **feedforward_kwargs)
 
     def forward(self, x):
-        return self.lnorm(x + self.sublayer(x))
+        return self.lnorm(self.sublayer(x), residual=x)
 
 
 class Sublayer3(nn.Module):
-    def __init__(self, hidden_size=512, num_heads=8, dropout=.1):
+    def __init__(self, hidden_size=512, num_heads=8, dropout=.1,
+                 attention_type='full', attention_kwargs=None):
         super(Sublayer3, self).__init__()
+        if attention_kwargs is None:
+            attention_kwargs = {}
         self.lnorm = LayerNorm(hidden_size)
-        self.sublayer = MultiheadAttention(
+        self.sublayer = ATTENTION_TYPES[attention_type](
             attention_size=hidden_size,
             num_heads=num_heads,
-            dropout=dropout)
+            dropout=dropout,
+            **attention_kwargs)
 
-    def forward(self, x, y, attention_mask=None):
+    def forward(self,
+                x,
+                y,
+                attention_mask: Optional[torch.Tensor] = None,
+                cache: Optional[Dict[str, torch.Tensor]] = None):
+        """
+        x : (B, Ls, D) encoded source, used as keys and values
+        y : (B, Lt, D) decoder stream, used as queries
+        """
         return self.lnorm(
-            x + self.sublayer(x, values=y, attention_mask=attention_mask))
+            self.sublayer(x, queries=y, values=x,
+                          attention_mask=attention_mask, cache=cache),
+            residual=y)
 
 
 class EncoderLayer(nn.Module):
@@ -52,16 +83,24 @@ class EncoderLayer(nn.Module):
                  hidden_size=512,
                  num_heads=8,
                  inner_size=2048,
-                 dropout=.1):
+                 dropout=.1,
+                 attention_type='full',
+                 attention_kwargs=None,
+                 feedforward_type='dense',
+                 feedforward_kwargs=None):
         super(EncoderLayer, self).__init__()
         self.l1 = Sublayer1(hidden_size=hidden_size,
                             num_heads=num_heads,
-                            dropout=dropout)
+                            dropout=dropout,
+                            attention_type=attention_type,
+                            attention_kwargs=attention_kwargs)
         self.l2 = Sublayer2(hidden_size=hidden_size,
                             inner_size=inner_size,
-                            dropout=dropout)
+                            dropout=dropout,
+                            feedforward_type=feedforward_type,
+                            feedforward_kwargs=feedforward_kwargs)
 
-    def forward(self, x, attention_mask=None):
+    def forward(self, x, attention_mask: Optional[torch.Tensor] = None):
         out = self.l1(x, attention_mask=attention_mask)
         out = self.l2(out)
         return out
@@ -73,21 +112,210 @@ class Encoder(nn.Module):
                  hidden_size=512,
                  num_heads=8,
                  inner_size=2048,
-                 dropout=.1):
+                 dropout=.1,
+                 attention_type='full',
+                 attention_kwargs=None,
+                 feedforward_type='dense',
+                 feedforward_kwargs=None,
+                 checkpoint_every=None,
+                 shared_layers=False):
         super(Encoder, self).__init__()
+        if feedforward_type == 'moe' and checkpoint_every is not None:
+            raise ValueError('The MoE load balancing loss gets no gradient '
+                             'in checkpointed layers')
+        self.checkpoint_every = checkpoint_every
         self.encoder = nn.ModuleList(
             repeat_layer(
                 EncoderLayer(
                     hidden_size=hidden_size,
                     num_heads=num_heads,
                     inner_size=inner_size,
-                    dropout=dropout),
-                num_layers))
+                    dropout=dropout,
+                    attention_type=attention_type,
+                    attention_kwargs=attention_kwargs,
+                    feedforward_type=feedforward_type,
+                    feedforward_kwargs=feedforward_kwargs),
+                num_layers,
+                shared=shared_layers))
+
+    def forward(self, x, attention_mask: Optional[torch.Tensor] = None):
+        if torch.jit.is_scripting():
+            for layer in self.encoder:
+                x = layer(x, attention_mask=attention_mask)
+            return x
+        return run_layers(self.encoder, x, attention_mask,
+                          checkpoint_every=self.checkpoint_every)
+
+
+class ReversibleEncoderLayer(nn.Module):
+    """Reversible encoder layer. Link: https://arxiv.org/abs/2001.04451
+
+    y1 = x1 + Attention(LayerNorm(x2))
+    y2 = x2 + FF(LayerNorm(y1))
+
+    The inputs can be recomputed from the outputs, so activations need
+    not be stored for backward. The sublayers are pre-norm, since the
+    residual stream has to stay invertible.
+    """
+    def __init__(self,
+                 hidden_size=512,
+                 num_heads=8,
+                 inner_size=2048,
+                 dropout=.1,
+                 attention_type='full',
+                 attention_kwargs=None,
+                 feedforward_type='dense',
+                 feedforward_kwargs=None):
+        super(ReversibleEncoderLayer, self).__init__()
+        if attention_kwargs is None:
+            attention_kwargs = {}
+        self.lnorm1 = LayerNorm(hidden_size)
+        self.attention = ATTENTION_TYPES[attention_type](
+            attention_size=hidden_size,
+            num_heads=num_heads,
+            dropout=dropout,
+            fused_qkv=True,
+            **attention_kwargs)
+        self.lnorm2 = LayerNorm(hidden_size)
+        if feedforward_kwargs is None:
+            feedforward_kwargs = {}
+        self.ff = FEEDFORWARD_TYPES[feedforward_type](
+            hidden_size, inner_size, dropout=dropout, **feedforward_kwargs)
+
+    @staticmethod
+    def _get_rng(x):
+        if x.is_cuda:
+            return torch.get_rng_state(), torch.cuda.get_rng_state(x.device)
+        return torch.get_rng_state(), None
+
+    @staticmethod
+    def _run_with_rng(fn, rng, *args):
+        """Replay fn with the RNG state of the forward pass, so that
+        dropout masks are the same
+        """
+        cpu_state, cuda_state = rng
+        devices = [args[0].device] if cuda_state is not None else []
+        with torch.random.fork_rng(devices=devices):
+            torch.set_rng_state(cpu_state)
+            if cuda_state is not None:
+                torch.cuda.set_rng_state(cuda_state, args[0].device)
+            return fn(*args)
+
+    def f(self, x, attention_mask=None):
+        return self.attention(self.lnorm1(x), attention_mask=attention_mask)
+
+    def g(self, x):
+        return self.ff(self.lnorm2(x))
+
+    def forward(self, x1, x2, attention_mask=None, rng=None):
+        """rng : optional list. The RNG states before f and g are appended.
+        They are kept outside the layer, so that it can be shared
+        """
+        if rng is not None:
+            rng.append(self._get_rng(x2))
+        y1 = x1 + self.f(x2, attention_mask=attention_mask)
+        if rng is not None:
+            rng.append(self._get_rng(y1))
+        y2 = x2 + self.g(y1)
+        return y1, y2
+
+    def backward_pass(self, y1, y2, dy1, dy2, rng, attention_mask=None):
+        """Recompute the inputs from the outputs and backpropagate.
+        Parameter gradients are accumulated in .grad
+        """
+        f_rng, g_rng = rng
+        with torch.enable_grad():
+            y1 = y1.detach().requires_grad_()
+            gy1 = self._run_with_rng(self.g, g_rng, y1)
+            torch.autograd.backward(gy1, dy2)
+        with torch.no_grad():
+            x2 = y2 - gy1
+            dx1 = dy1 + y1.grad
+            del y2, gy1
+        with torch.enable_grad():
+            x2 = x2.detach().requires_grad_()
+            fx2 = self._run_with_rng(self.f, f_rng, x2, attention_mask)
+            torch.autograd.backward(fx2, dx1)
+        with torch.no_grad():
+            x1 = y1 - fx2
+            dx2 = dy2 + x2.grad
+        return x1.detach(), x2.detach(), dx1, dx2
+
+
+class _ReversibleFunction(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, attention_mask, layers):
+        """x => (B, L, 2D) the two residual streams"""
+        x1, x2 = x.chunk(2, dim=-1)
+        ctx.rng = []
+        for layer in layers:
+            rng = []
+            x1, x2 = layer(x1, x2, attention_mask=attention_mask, rng=rng)
+            ctx.rng.append(rng)
+        out = torch.cat((x1, x2), dim=-1)
+        # Only the output is kept. Everything else is recomputed
+        ctx.save_for_backward(out)
+        ctx.attention_mask = attention_mask
+        ctx.layers = layers
+        return out
+
+    @staticmethod
+    def backward(ctx, grad):
+        y1, y2 = ctx.saved_tensors[0].chunk(2, dim=-1)
+        dy1, dy2 = grad.chunk(2, dim=-1)
+        for layer, rng in zip(reversed(ctx.layers), reversed(ctx.rng)):
+            y1, y2, dy1, dy2 = layer.backward_pass(
+                y1, y2, dy1, dy2, rng, attention_mask=ctx.attention_mask)
+        return torch.cat((dy1, dy2), dim=-1), None, None
+
+
+class ReversibleEncoder(nn.Module):
+    """Encoder with ReversibleEncoderLayer. The input is duplicated in two
+    residual streams and the output is their mean, followed by LayerNorm.
+    Activation memory does not grow with num_layers. Backward runs the
+    layers again, so a training step costs about one extra forward pass.
+    The reversible backward is used when x requires grad
+    """
+    def __init__(self,
+                 num_layers=6,
+                 hidden_size=512,
+                 num_heads=8,
+                 inner_size=2048,
+                 dropout=.1,
+                 attention_type='full',
+                 attention_kwargs=None,
+                 feedforward_type='dense',
+                 feedforward_kwargs=None,
+                 shared_layers=False):
+        super(ReversibleEncoder, self).__init__()
+        if feedforward_type == 'moe':
+            raise ValueError('The MoE load balancing loss gets no gradient '
+                             'in reversible layers')
+        self.encoder = nn.ModuleList(
+            repeat_layer(
+                ReversibleEncoderLayer(
+                    hidden_size=hidden_size,
+                    num_heads=num_heads,
+                    inner_size=inner_size,
+                    dropout=dropout,
+                    attention_type=attention_type,
+                    attention_kwargs=attention_kwargs,
+                    feedforward_type=feedforward_type,
+                    feedforward_kwargs=feedforward_kwargs),
+                num_layers,
+                shared=shared_layers))
+        self.lnorm = LayerNorm(hidden_size)
 
     def forward(self, x, attention_mask=None):
-        for layer in self.encoder:
-            x = layer(x, attention_mask=attention_mask)
-        return x
+        if torch.is_grad_enabled() and x.requires_grad:
+            out = _ReversibleFunction.apply(
+                torch.cat((x, x), dim=-1), attention_mask, self.encoder)
+            x1, x2 = out.chunk(2, dim=-1)
+        else:
+            x1, x2 = x, x
+            for layer in self.encoder:
+                x1, x2 = layer(x1, x2, attention_mask=attention_mask)
+        return self.lnorm((x1 + x2) / 2)
 
 
 class DecoderLayer(nn.Module):
@@ -95,21 +323,65 @@ class DecoderLayer(nn.Module):
                  hidden_size=512,
                  num_heads=8,
                  inner_size=2048,
-                 dropout=.1):
+                 dropout=.1,
+                 attention_type='full',
+                 attention_kwargs=None,
+                 feedforward_type='dense',
+                 feedforward_kwargs=None):
         super(DecoderLayer, self).__init__()
+        self_attention_kwargs = dict(attention_kwargs or {})
+        if attention_type == 'linear':
+            # Masks are reduced to padding in linear attention
+            self_attention_kwargs['causal'] = True
         self.in_layer = Sublayer1(hidden_size=hidden_size,
                                   num_heads=num_heads,
-                                  dropout=dropout)
+                                  dropout=dropout,
+                                  attention_type=attention_type,
+                                  attention_kwargs=self_attention_kwargs)
+        cross_attention_type = attention_type
+        cross_attention_kwargs = attention_kwargs
+        if attention_type == 'local':
+            # Windows need queries and keys from the same sequence. The
+            # decoder attends to the whole encoder output
+            cross_attention_type, cross_attention_kwargs = 'full', None
         self.fuse_layer = Sublayer3(hidden_size=hidden_size,
                                     num_heads=num_heads,
-                                    dropout=dropout)
+                                    dropout=dropout,
+                                    attention_type=cross_attention_type,
+                                    attention_kwargs=cross_attention_kwargs)
         self.out_layer = Sublayer2(hidden_size=hidden_size,
                                    inner_size=inner_size,
-                                   dropout=dropout)
+                                   dropout=dropout,
+                                   feedforward_type=feedforward_type,
+                                   feedforward_kwargs=feedforward_kwargs)
+
+    @staticmethod
+    def init_cache():
+        return {'self': {}, 'cross': {}}
 
-    def forward(self, x, encoded, source_mask=None, target_mask=None):
-        out = self.in_layer(x, attention_mask=target_mask)
-        out = self.fuse_layer(encoded, out, attention_mask=source_mask)
+    def forward(self,
+                x,
+                encoded,
+                source_mask: Optional[torch.Tensor] = None,
+                target_mask: Optional[torch.Tensor] = None,
+                cross_mask: Optional[torch.Tensor] = None,
+                cache: Optional[Dict[str, Dict[str, torch.Tensor]]] = None):
+        """
+        cross_mask : (B, Lt, Ls) mask for the encoder decoder attention.
+            Defaults to source_mask
+        cache : dict from init_cache() for incremental decoding. x holds
+            only the new positions and target_mask can be None
+        """
+        if cross_mask is None:
+            cross_mask = source_mask
+        self_cache: Optional[Dict[str, torch.Tensor]] = None
+        cross_cache: Optional[Dict[str, torch.Tensor]] = None
+        if cache is not None:
+            self_cache = cache['self']
+            cross_cache = cache['cross']
+        out = self.in_layer(x, attention_mask=target_mask, cache=self_cache)
+        out = self.fuse_layer(encoded, out, attention_mask=cross_mask,
+                              cache=cross_cache)
         out = self.out_layer(out)
         return out
 
@@ -120,27 +392,64 @@ class Decoder(nn.Module):
                  hidden_size=512,
                  num_heads=8,
                  inner_size=2048,
-                 dropout=.1):
+                 dropout=.1,
+                 attention_type='full',
+                 attention_kwargs=None,
+                 feedforward_type='dense',
+                 feedforward_kwargs=None,
+                 checkpoint_every=None,
+                 shared_layers=False):
         super(Decoder, self).__init__()
+        if feedforward_type == 'moe' and checkpoint_every is not None:
+            raise ValueError('The MoE load balancing loss gets no gradient '
+                             'in checkpointed layers')
+        self.checkpoint_every = checkpoint_every
         self.decoder = nn.ModuleList(
             repeat_layer(
                 DecoderLayer(
                     hidden_size=hidden_size,
                     num_heads=num_heads,
                     inner_size=inner_size,
-                    dropout=dropout),
-                num_layers))
+                    dropout=dropout,
+                    attention_type=attention_type,
+                    attention_kwargs=attention_kwargs,
+                    feedforward_type=feedforward_type,
+                    feedforward_kwargs=feedforward_kwargs),
+                num_layers,
+                shared=shared_layers))
+
+    def init_cache(self):
+        """Empty key / value caches, one per layer"""
+        return [layer.init_cache() for layer in self.decoder]
+
+    @staticmethod
+    def reorder_cache(cache, indices):
+        """Select the self attention caches of the surviving beams.
+        Cross attention caches are shared by the beams of a batch item
+        """
+        for layer_cache in cache:
+            self_cache = layer_cache['self']
+            for key in self_cache:
+                self_cache[key] = self_cache[key].index_select(0, indices)
 
     def forward(self,
                 target,
                 encoded,
-                source_mask=None,
-                target_mask=None):
-
-        for l in self.decoder:
+                source_mask: Optional[torch.Tensor] = None,
+                target_mask: Optional[torch.Tensor] = None,
+                cross_mask: Optional[torch.Tensor] = None,
+                cache: Optional[
+                    List[Dict[str, Dict[str, torch.Tensor]]]] = None):
+        if not torch.jit.is_scripting() and cache is None:
+            return run_layers(self.decoder, target, encoded,
+                              source_mask, target_mask, cross_mask,
+                              checkpoint_every=self.checkpoint_every)
+        for i, l in enumerate(self.decoder):
             target = l(target, encoded,
                        source_mask=source_mask,
-                       target_mask=target_mask)
+                       target_mask=target_mask,
+                       cross_mask=cross_mask,
+                       cache=cache[i] if cache is not None else None)
         return target
 
 
@@ -150,33 +459,69 @@ class EncoderDecoder(nn.Module):
                  hidden_size=512,
                  num_heads=8,
                  inner_size=2048,
-                 dropout=.1):
+                 dropout=.1,
+                 attention_type='full',
+                 attention_kwargs=None,
+                 feedforward_type='dense',
+                 feedforward_kwargs=None,
+                 checkpoint_every=None,
+                 reversible=False,
+                 shared_layers=False):
         super(EncoderDecoder, self).__init__()
-        self.encoder = Encoder(num_layers=num_layers,
-                               hidden_size=hidden_size,
-                               num_heads=num_heads,
-                               inner_size=inner_size,
-                               dropout=dropout)
+        if reversible:
+            self.encoder = ReversibleEncoder(
+                num_layers=num_layers,
+                hidden_size=hidden_size,
+                num_heads=num_heads,
+                inner_size=inner_size,
+                dropout=dropout,
+                attention_type=attention_type,
+                attention_kwargs=attention_kwargs,
+                feedforward_type=feedforward_type,
+                feedforward_kwargs=feedforward_kwargs,
+                shared_layers=shared_layers)
+        else:
+            self.encoder = Encoder(num_layers=num_layers,
+                                   hidden_size=hidden_size,
+                                   num_heads=num_heads,
+                                   inner_size=inner_size,
+                                   dropout=dropout,
+                                   attention_type=attention_type,
+                                   attention_kwargs=attention_kwargs,
+                                   feedforward_type=feedforward_type,
+                                   feedforward_kwargs=feedforward_kwargs,
+                                   checkpoint_every=checkpoint_every,
+                                   shared_layers=shared_layers)
         self.decoder = Decoder(num_layers=num_layers,
                                hidden_size=hidden_size,
                                num_heads=num_heads,
                                inner_size=inner_size,
-                               dropout=dropout)
+                               dropout=dropout,
+                               attention_type=attention_type,
+                               attention_kwargs=attention_kwargs,
+                               feedforward_type=feedforward_type,
+                               feedforward_kwargs=feedforward_kwargs,
+                               checkpoint_every=checkpoint_every,
+                               shared_layers=shared_layers)
 
     def forward(self,
                 source,
                 target,
-                source_mask=None,
-                target_mask=None):
+                source_mask: Optional[torch.Tensor] = None,
+                target_mask: Optional[torch.Tensor] = None,
+                cross_mask: Optional[torch.Tensor] = None):
         encoded = self.encoder(source, attention_mask=source_mask)
         decoded = self.decoder(target,
                                encoded,
                                source_mask=source_mask,
-                               target_mask=target_mask)
+                               target_mask=target_mask,
+                               cross_mask=cross_mask)
         return decoded
 
 
 class Transformer(nn.Module):
+    __constants__ = ['adaptive']
+
     def __init__(self,
                  vocab_size=30000,
                  max_length=256,
@@ -185,13 +530,38 @@ class Transformer(nn.Module):
                  num_heads=8,
                  inner_size=2048,
                  dropout=0.1,
+                 attention_type='full',
+                 attention_kwargs=None,
+                 feedforward_type='dense',
+                 feedforward_kwargs=None,
+                 checkpoint_every=None,
+                 reversible=False,
+                 shared_layers=False,
+                 embedding_size=None,
+                 adaptive_cutoffs=None,
+                 adaptive_div_value=4.,
+                 adaptive_input=False,
+                 tie_adaptive_weights=False,
                  device='cpu'):
         super(Transformer, self).__init__()
-        self.embed = Embed(vocab_size,
-                           hidden_size,
-                           scale=math.sqrt(hidden_size),
-                           dropout=dropout,
-                           trainable=True)
+        if (adaptive_input or tie_adaptive_weights) and (
+                adaptive_cutoffs is None):
+            raise ValueError('adaptive_input and tie_adaptive_weights '
+                             'need adaptive_cutoffs')
+        if adaptive_input:
+            self.embed = AdaptiveInput(vocab_size,
+                                       hidden_size,
+                                       adaptive_cutoffs,
+                                       div_value=adaptive_div_value,
+                                       dropout=dropout,
+                                       scale=math.sqrt(hidden_size))
+        else:
+            self.embed = Embed(vocab_size,
+                               hidden_size,
+                               scale=math.sqrt(hidden_size),
+                               dropout=dropout,
+                               trainable=True,
+                               factorized_dim=embedding_size)
         self.pe = PositionalEncoding(
             max_length,
             embedding_dim=hidden_size,
@@ -201,35 +571,260 @@ class Transformer(nn.Module):
             hidden_size=hidden_size,
             num_heads=num_heads,
             inner_size=inner_size,
-            dropout=dropout)
+            dropout=dropout,
+            attention_type=attention_type,
+            attention_kwargs=attention_kwargs,
+            feedforward_type=feedforward_type,
+            feedforward_kwargs=feedforward_kwargs,
+            checkpoint_every=checkpoint_every,
+            reversible=reversible,
+            shared_layers=shared_layers)
         self.drop = nn.Dropout(dropout)
-        self.predict = nn.Linear(hidden_size, vocab_size)
+        # With adaptive_cutoffs predict is an AdaptiveSoftmax and the
+        # outputs are log probabilities instead of logits
+        self.adaptive = adaptive_cutoffs is not None
+        if self.adaptive:
+            self.predict = AdaptiveSoftmax(hidden_size,
+                                           vocab_size,
+                                           adaptive_cutoffs,
+                                           div_value=adaptive_div_value)
+        else:
+            self.predict = nn.Linear(hidden_size, vocab_size)
         self._reset_parameters()
+        if tie_adaptive_weights:
+            self.embed.tie_weights(self.predict)
 
-    def forward(self,
-                source,
-                target,
-                source_mask=None,
-                target_mask=None):
+    def encode(self,
+               source,
+               source_mask: Optional[torch.Tensor] = None,
+               source_positions: Optional[torch.Tensor] = None):
         source = self.embed(source)
-        target = self.embed(target)
         # Adding embeddings + pos embeddings
         # is done in PositionalEncoding class
-        source = self.pe(source)
-        target = self.pe(target)
-        out = self.transformer_block(
-            source, target,
+        source = self.pe(source, positions=source_positions)
+        return self.transformer_block.encoder(
+            source, attention_mask=source_mask)
+
+    def decode(self,
+               target,
+               encoded,
+               source_mask: Optional[torch.Tensor] = None,
+               target_mask: Optional[torch.Tensor] = None,
+               cross_mask: Optional[torch.Tensor] = None,
+               target_positions: Optional[torch.Tensor] = None,
+               cache: Optional[
+                   List[Dict[str, Dict[str, torch.Tensor]]]] = None,
+               return_hidden: bool = False,
+               output_mask: Optional[torch.Tensor] = None):
+        target = self.embed(target)
+        target = self.pe(target, positions=target_positions)
+        out = self.transformer_block.decoder(
+            target, encoded,
             source_mask=source_mask,
-            target_mask=target_mask)
+            target_mask=target_mask,
+            cross_mask=cross_mask,
+            cache=cache)
         out = self.drop(out)
-        out = self.predict(out)
-        return out
+        if output_mask is not None:
+            # Project only the selected, e.g. non pad, positions
+            out = out[output_mask != 0]
+        if return_hidden:
+            return out
+        if self.adaptive:
+            return self.predict.log_prob(out)
+        return self.predict(out)
+
+    def forward(self,
+                source,
+                target,
+                source_mask: Optional[torch.Tensor] = None,
+                target_mask: Optional[torch.Tensor] = None,
+                source_positions: Optional[torch.Tensor] = None,
+                target_positions: Optional[torch.Tensor] = None,
+                cross_mask: Optional[torch.Tensor] = None,
+                return_hidden: bool = False,
+                output_mask: Optional[torch.Tensor] = None):
+        """return_hidden : Return the (B, L, D) inputs of the output layer,
+            e.g. for AdaptiveSoftmaxLoss
+        output_mask : (B, L) If set, only the positions where it is non
+            zero are returned, flattened to (N, V) (or (N, D))
+        """
+        encoded = self.encode(source, source_mask=source_mask,
+                              source_positions=source_positions)
+        return self.decode(target, encoded,
+                           source_mask=source_mask,
+                           target_mask=target_mask,
+                           cross_mask=cross_mask,
+                           target_positions=target_positions,
+                           return_hidden=return_hidden,
+                           output_mask=output_mask)
+
+    @torch.no_grad()
+    def generate(self,
+                 source,
+                 bos_indx,
+                 eos_indx,
+                 source_mask=None,
+                 pad_indx=0,
+                 max_length=None,
+                 source_positions=None):
+        """Batched greedy decoding. The source is encoded once and every
+        step feeds only the last token, reusing the cached keys and values
+        of the previous steps and of the encoder output. Call model.eval()
+        first.
+
+        source => (B, Ls) source token ids
+        source_mask => (B, 1, Ls) source padding mask
+        out => (B, L) generated token ids without [BOS]. Rows that emitted
+            [EOS] are padded with pad_indx. Stops early when all rows are done
+        """
+        if max_length is None or max_length > self.pe.max_length:
+            max_length = self.pe.max_length
+        encoded = self.encode(source, source_mask=source_mask,
+                              source_positions=source_positions)
+        cache = self.transformer_block.decoder.init_cache()
+        batch_size = source.size(0)
+        token = source.new_full((batch_size, 1), bos_indx)
+        finished = torch.zeros(batch_size, dtype=torch.bool,
+                               device=source.device)
+        out = []
+        for step in range(max_length):
+            positions = source.new_full((batch_size, 1), step)
+            hidden = self.decode(token, encoded,
+                                 source_mask=source_mask,
+                                 target_positions=positions,
+                                 cache=cache,
+                                 return_hidden=True)[:, -1]
+            if self.adaptive:
+                token = self.predict.predict(hidden).unsqueeze(-1)
+            else:
+                token = self.predict(hidden).argmax(-1).unsqueeze(-1)
+            token = token.masked_fill(finished.unsqueeze(-1), pad_indx)
+            out.append(token)
+            finished = finished | (token.squeeze(-1) == eos_indx)
+            if finished.all():
+                break
+        return torch.cat(out, dim=1)
+
+    @staticmethod
+    def _length_penalty(lengths, alpha):
+        """GNMT length normalization ((5 + |Y|) / 6) ^ alpha"""
+        return ((5. + lengths) / 6.) ** alpha
+
+    @torch.no_grad()
+    def beam_search(self,
+                    source,
+                    bos_indx,
+                    eos_indx,
+                    source_mask=None,
+                    pad_indx=0,
+                    beam_size=4,
+                    n_best=1,
+                    max_length=None,
+                    length_penalty=.6,
+                    source_positions=None):
+        """Batched beam search. The beams of all batch items are decoded
+        as one (B * K) batch with key / value caches. Hypotheses are ranked
+        by their log probability divided by the length penalty. Finished
+        hypotheses are extended with pad_indx at no cost. Hypotheses that
+        reach max_length are finished too. A batch item stops once none of
+        its alive hypotheses can beat its n_best-th finished one.
+        Call model.eval() first.
+
+        source => (B, Ls) source token ids
+        source_mask => (B, 1, Ls) source padding mask
+        out => (B, n_best, L) token ids without [BOS], padded after [EOS]
+            and (B, n_best) normalized scores, best first
+        """
+        if n_best > beam_size:
+            raise ValueError('n_best should not be larger than beam_size')
+        if max_length is None or max_length > self.pe.max_length:
+            max_length = self.pe.max_length
+        batch_size, k = source.size(0), beam_size
+        encoded = self.encode(source, source_mask=source_mask,
+                              source_positions=source_positions)
+        encoded = encoded.repeat_interleave(k, dim=0)
+        if source_mask is not None:
+            source_mask = source_mask.repeat_interleave(k, dim=0)
+        cache = self.transformer_block.decoder.init_cache()
+        # Position of the first beam of each batch item in (B * K)
+        offsets = torch.arange(
+            batch_size, device=source.device).unsqueeze(-1) * k
+        # Start from a single hypothesis per batch item
+        scores = torch.full((batch_size, k), float('-inf'),
+                            device=source.device)
+        scores[:, 0] = 0
+        lengths = torch.zeros(batch_size, k, device=source.device)
+        finished = torch.zeros(batch_size, k, dtype=torch.bool,
+                               device=source.device)
+        max_penalty = self._length_penalty(float(max_length), length_penalty)
+        tokens = source.new_full((batch_size * k, 1), bos_indx)
+        out = source.new_empty((batch_size, k, 0))
+        for step in range(max_length):
+            positions = source.new_full((batch_size * k, 1), step)
+            logits = self.decode(tokens, encoded,
+                                 source_mask=source_mask,
+                                 target_positions=positions,
+                                 cache=cache)
+            # (B, K, V)
+            log_probs = F.log_softmax(logits[:, -1].float(), dim=-1)
+            log_probs = log_probs.view(batch_size, k, -1)
+            vocab_size = log_probs.size(-1)
+            ended = torch.full_like(log_probs[0, 0], float('-inf'))
+            ended[pad_indx] = 0
+            log_probs = torch.where(finished.unsqueeze(-1), ended, log_probs)
+            candidates = scores.unsqueeze(-1) + log_probs
+            candidate_lengths = lengths + (~finished).float()
+            normalized = candidates / self._length_penalty(
+                candidate_lengths, length_penalty).unsqueeze(-1)
+            # (B, K) best of the K * V extensions
+            best = normalized.view(batch_size, -1).topk(k, dim=-1)[1]
+            beams, words = best // vocab_size, best % vocab_size
+            scores = candidates.view(batch_size, -1).gather(1, best)
+            lengths = candidate_lengths.gather(1, beams)
+            finished = finished.gather(1, beams) | (words == eos_indx)
+            out = torch.cat(
+                (out.gather(1, beams.unsqueeze(-1).expand_as(out)),
+                 words.unsqueeze(-1)), dim=-1)
+            self.transformer_block.decoder.reorder_cache(
+                cache, (beams + offsets).view(-1))
+            tokens = words.view(-1, 1)
+            # Hypotheses that reach max_length are complete
+            finished = finished | (lengths >= max_length)
+            # Scores only decrease, so an alive hypothesis can at best
+            # reach its current score normalized at max_length
+            inf = torch.full_like(scores, float('-inf'))
+            nth_finished = torch.where(
+                finished,
+                scores / self._length_penalty(lengths, length_penalty),
+                inf).topk(n_best, dim=-1)[0][:, -1]
+            best_alive = torch.where(
+                finished, inf, scores / max_penalty).max(-1)[0]
+            done = (nth_finished >= best_alive).unsqueeze(-1)
+            # Prune the alive hypotheses of finished batch items
+            scores = scores.masked_fill(done & ~finished, float('-inf'))
+            finished = finished | done
+            if finished.all():
+                break
+        normalized = scores / self._length_penalty(lengths, length_penalty)
+        normalized, order = normalized.sort(-1, descending=True)
+        out = out.gather(1, order.unsqueeze(-1).expand_as(out))
+        out = out.masked_fill(
+            torch.isinf(normalized).unsqueeze(-1), pad_indx)
+        return out[:, :n_best], normalized[:, :n_best]
 
     def _reset_parameters(self):
         """Initiate parameters in the transformer model."""
         for p in self.parameters():
             if p.dim() > 1:
                 nn.init.xavier_uniform_(p)
+        for m in self.modules():
+            if isinstance(m, MultiheadAttention):
+                m.reset_projections()
+            if isinstance(m, MoEPositionwiseFF):
+                # xavier treats (E, D, F) expert weights as conv kernels
+                # and initializes the (E, 1, F) expert biases
+                m.reset_parameters()
 
 # IDEA: Instead of flat encoder / decoder create
 # hierarchical encoding / decoding layers
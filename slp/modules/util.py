@@ -1,23 +1,89 @@
 import copy
 import torch
 
-from typing import cast, Callable, Optional, Tuple
+from torch.utils.checkpoint import checkpoint
+from typing import (cast, Any, Callable, Dict, Optional, Sequence, Tuple,
+                    Union)
 
 
-def repeat_layer(l: torch.nn.Module, times: int):
+def repeat_layer(l: torch.nn.Module, times: int, shared: bool = False):
+    """Repeat l times. If shared all repeats are the same module
+    (ALBERT style cross layer parameter sharing)
+    """
+    if shared:
+        return [l] * times
     return [l] + [copy.deepcopy(l) for _ in range(times - 1)]
 
 
+def share_layer_weights(state_dict: Dict[str, torch.Tensor],
+                        prefix: str,
+                        mode: Union[str, int] = 'mean'
+                        ) -> Dict[str, torch.Tensor]:
+    """Convert a checkpoint with separate layers to a shared layer one.
+    The layers are the keys under prefix followed by the layer index,
+    e.g. prefix='transformer_block.encoder.encoder.'. Every layer gets the
+    average of all layers (mode='mean') or a copy of layer mode (int)
+    """
+    if mode != 'mean' and not isinstance(mode, int):
+        raise ValueError(f'mode should be "mean" or a layer index. '
+                         f'Got {mode}')
+    layers: Dict[str, Dict[int, torch.Tensor]] = {}
+    for key, value in state_dict.items():
+        if not key.startswith(prefix):
+            continue
+        index, name = key[len(prefix):].split('.', 1)
+        layers.setdefault(name, {})[int(index)] = value
+    out = dict(state_dict)
+    for name, values in layers.items():
+        if mode == 'mean':
+            shared = torch.stack(list(values.values())).float().mean(0)
+            shared = shared.to(next(iter(values.values())).dtype)
+        else:
+            shared = values[cast(int, mode)]
+        for layer in values:
+            out[f'{prefix}{layer}.{name}'] = shared
+    return out
+
+
+def run_layers(layers: Sequence[torch.nn.Module],
+               x: torch.Tensor,
+               *args: Any,
+               checkpoint_every: Optional[int] = None) -> torch.Tensor:
+    """Run x through layers, passing args to every layer.
+    With checkpoint_every=k the layers are split in segments of k and
+    only the input of each segment is kept for the backward pass. The
+    activations inside a segment are recomputed during backward.
+    torch.utils.checkpoint restores the RNG state, so dropout masks are
+    the same in the recomputation. Checkpointing is skipped when no
+    gradients are computed or x does not require grad
+    """
+    def segment(start: int, end: int) -> Callable[..., torch.Tensor]:
+        def run(x: torch.Tensor, *args: Any) -> torch.Tensor:
+            for layer in layers[start:end]:
+                x = layer(x, *args)
+            return x
+        return run
+
+    if (checkpoint_every is None or not torch.is_grad_enabled() or
+            not x.requires_grad):
+        return segment(0, len(layers))(x, *args)
+    for start in range(0, len(layers), checkpoint_every):
+        x = checkpoint(segment(start, start + checkpoint_every), x, *args)
+    return x
+
+
 def pad_mask(lengths: torch.Tensor,
              max_length: Optional[int] = None,
-             device='cpu'):
-    """lengths is a torch tensor
+             device: Optional[str] = None):
+    """lengths is a torch tensor. The mask is moved to device if given,
+    otherwise it is on the device of lengths
     """
     if max_length is None:
-        max_length = cast(int, torch.max(lengths).item())
-    max_length = cast(int, max_length)
-    idx = torch.arange(0, max_length).unsqueeze(0).to(device)
+        max_length = int(torch.max(lengths))
+    idx = torch.arange(0, max_length, device=lengths.device).unsqueeze(0)
     mask = (idx < lengths.unsqueeze(1)).float()
+    if device is not None:
+        mask = mask.to(device)
     return mask
 
 
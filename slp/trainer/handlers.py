@@ -7,6 +7,7 @@ from torch.utils.data import DataLoader
 
 from typing import Optional
 
+from slp.modules.pruning import MagnitudePruner
 from slp.util import system
 from slp.util import types
 
@@ -68,3 +69,25 @@ class EvaluationHandler(object):
             Events.EPOCH_COMPLETED,
             self, evaluator, dataloader,
             validation=validation)
+
+
+class PruningHandler(object):
+    """Drives a slp.modules.pruning.MagnitudePruner from the trainer.
+    The masks are updated and applied after every iteration and the
+    sparsity is logged at the end of every epoch
+    """
+    def __init__(self, pruner: MagnitudePruner,
+                 pbar: Optional[ProgressBar] = None):
+        self.pruner = pruner
+        self.print_fn = pbar.log_message if pbar is not None else print
+
+    def __call__(self, engine: Engine) -> None:
+        self.pruner.step(engine.state.iteration)
+
+    def log_sparsity(self, engine: Engine) -> None:
+        self.print_fn('{:<15} {:<15.4f}'.format(
+            'sparsity', self.pruner.current_sparsity()))
+
+    def attach(self, trainer: Engine) -> None:
+        trainer.add_event_handler(Events.ITERATION_COMPLETED, self)
+        trainer.add_event_handler(Events.EPOCH_COMPLETED, self.log_sparsity)
@@ -0,0 +1,60 @@
+import torch
+import torch.nn as nn
+
+from ignite.exceptions import NotComputableError
+from ignite.metrics import Metric
+
+from typing import Any, Optional
+
+
+def aux_loss(model: nn.Module) -> Optional[torch.Tensor]:
+    """Sum of the aux_loss of all modules that have one, e.g. the load
+    balancing loss of MoEPositionwiseFF. None if there is none
+    """
+    losses = [m.aux_loss for m in model.modules()
+              if getattr(m, 'aux_loss', None) is not None]
+    if not losses:
+        return None
+    return sum(losses)  # type: ignore
+
+
+def clear_aux_loss(model: nn.Module) -> None:
+    """Drop the stored auxiliary losses, so that they do not keep the
+    graph of the last step alive
+    """
+    for m in model.modules():
+        if getattr(m, 'aux_loss', None) is not None:
+            setattr(m, 'aux_loss', None)
+
+
+def has_aux_loss(model: nn.Module) -> bool:
+    return any(hasattr(m, 'aux_loss') for m in model.modules())
+
+
+class AuxiliaryLoss(Metric):
+    """Average of the auxiliary losses of model over an epoch. The losses
+    are read from the model and cleared after every forward of the
+    evaluator
+    """
+    def __init__(self, model: nn.Module) -> None:
+        self.model = model
+        super(AuxiliaryLoss, self).__init__()
+
+    def reset(self) -> None:
+        self._sum = 0.
+        self._num_examples = 0
+
+    def update(self, output: Any) -> None:
+        loss = aux_loss(self.model)
+        if loss is None:
+            return
+        clear_aux_loss(self.model)
+        self._sum += loss.item()
+        self._num_examples += 1
+
+    def compute(self) -> float:
+        if self._num_examples == 0:
+            raise NotComputableError(
+                'AuxiliaryLoss must have at least one example '
+                'before it can be computed.')
+        return self._sum / self._num_examples
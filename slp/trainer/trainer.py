@@ -12,11 +12,15 @@ from torch.optim.optimizer import Optimizer
 from torch.nn.modules.loss import _Loss
 from torch.utils.data import DataLoader
 
-from typing import cast, List, Optional, Tuple, TypeVar
+from typing import cast, Any, Dict, List, Optional, Tuple, TypeVar
 from slp.util import types
 from slp.util.parallel import DataParallelModel, DataParallelCriterion
 
+from slp.data.echo import DataEcho
+from slp.modules.transformer import Transformer
 from slp.trainer.handlers import CheckpointHandler, EvaluationHandler
+from slp.trainer.metrics import (
+    AuxiliaryLoss, aux_loss, clear_aux_loss, has_aux_loss)
 from slp.util import from_checkpoint, to_device
 from slp.util import log
 from slp.util import system
@@ -74,6 +78,8 @@ class Trainer(object):
                     lambda x, y: self.loss_fn(x, y).mean())  # type: ignore
             else:
                 metrics['loss'] = Loss(self.loss_fn)
+        if 'aux_loss' not in metrics and has_aux_loss(self.model):
+            metrics['aux_loss'] = AuxiliaryLoss(self.model)
         self.trainer = Engine(self.train_step)
         self.train_evaluator = Engine(self.eval_step)
         self.valid_evaluator = Engine(self.eval_step)
@@ -158,6 +164,11 @@ class Trainer(object):
         loss = self.loss_fn(y_pred, targets)  # type: ignore
         if self.parallel:
             loss = loss.mean()
+        aux = aux_loss(self.model)
+        if aux is not None:
+            # e.g. load balancing of mixture of experts layers
+            loss = loss + aux
+            clear_aux_loss(self.model)
         loss = loss / self.accumulation_steps
         loss.backward(retain_graph=self.retain_graph)
         if (self.trainer.state.iteration + 1) % self.accumulation_steps == 0:
@@ -181,12 +192,14 @@ class Trainer(object):
     def fit(self: TrainerType,
             train_loader: DataLoader,
             val_loader: DataLoader,
-            epochs: int = 50) -> State:
+            epochs: int = 50,
+            echo_factor: Optional[Union[int, str]] = None) -> State:
         log.info(
             'Trainer will run for\n'
             f'model: {self.model}\n'
             f'optimizer: {self.optimizer}\n'
-            f'loss: {self.loss_fn}')
+            f'loss: {self.loss_fn}\n'
+            f'data echoing: {echo_factor}')
         self.val_handler.attach(self.trainer,
                                 self.train_evaluator,
                                 train_loader,
@@ -196,6 +209,9 @@ class Trainer(object):
                                 val_loader,
                                 validation=True)
         self.model.zero_grad()
+        if echo_factor is not None:
+            train_loader = cast(DataLoader, DataEcho(
+                train_loader, echo_factor=echo_factor))
         self.trainer.run(train_loader, max_epochs=epochs)
 
     def overfit_single_batch(self: TrainerType,
@@ -304,6 +320,17 @@ class Seq2seqTrainer(SequentialTrainer):
 
 
 class TransformerTrainer(Trainer):
+    def __init__(self,
+                 *args: Any,
+                 pad_indx: Optional[int] = None,
+                 **kwargs: Any) -> None:
+        """pad_indx: If set, the output layer and the loss only run on
+            target positions that are not pad_indx. Equivalent to a loss
+            with ignore_index=pad_indx
+        """
+        self.pad_indx = pad_indx
+        super(TransformerTrainer, self).__init__(*args, **kwargs)
+
     def parse_batch(
             self,
             batch: List[torch.Tensor]) -> Tuple[torch.Tensor, ...]:
@@ -319,17 +346,86 @@ class TransformerTrainer(Trainer):
         mask_targets = to_device(batch[3],
                                  device=self.device,
                                  non_blocking=self.non_blocking)
-        return inputs, targets, mask_inputs, mask_targets
+        if len(batch) < 7:
+            return inputs, targets, mask_inputs, mask_targets
+        # Packed batches also carry the positions of each token
+        # and the encoder decoder attention mask
+        pos_inputs = to_device(batch[4],
+                               device=self.device,
+                               non_blocking=self.non_blocking)
+        pos_targets = to_device(batch[5],
+                                device=self.device,
+                                non_blocking=self.non_blocking)
+        mask_cross = to_device(batch[6],
+                               device=self.device,
+                               non_blocking=self.non_blocking)
+        return (inputs, targets, mask_inputs, mask_targets,
+                pos_inputs, pos_targets, mask_cross)
 
     def get_predictions_and_targets(
             self,
             batch: List[torch.Tensor]) -> Tuple[torch.Tensor, ...]:
-        inputs, targets, mask_inputs, mask_targets = self.parse_batch(batch)
+        parsed = self.parse_batch(batch)
+        inputs, targets, mask_inputs, mask_targets = parsed[:4]
+        kwargs: Dict[str, Any] = {}
+        if len(parsed) == 7:
+            kwargs = {'source_positions': parsed[4],
+                      'target_positions': parsed[5],
+                      'cross_mask': parsed[6]}
+        model = self.model.module if self.parallel else self.model
+        loss_fn = self.loss_fn.module if self.parallel else self.loss_fn
+        if (getattr(model, 'adaptive', False) or
+                getattr(loss_fn, 'uses_hidden', False)):
+            # The loss is computed from the hidden states, e.g. with
+            # AdaptiveSoftmaxLoss or LinearCrossEntropyLoss
+            kwargs['return_hidden'] = True
+        if self.pad_indx is not None:
+            kwargs['output_mask'] = targets != self.pad_indx
         y_pred = self.model(inputs,
                             targets,
                             source_mask=mask_inputs,
-                            target_mask=mask_targets)
+                            target_mask=mask_targets,
+                            **kwargs)
+        if self.pad_indx is not None:
+            return y_pred, targets[kwargs['output_mask']]
         targets = targets.view(-1)
         y_pred = y_pred.view(targets.size(0), -1)
-        # TODO: BEAMSEARCH!!
         return y_pred, targets
+
+    def beam_search(
+            self,
+            dataloader: DataLoader,
+            bos_indx: int,
+            eos_indx: int,
+            pad_indx: int = 0,
+            beam_size: int = 4,
+            n_best: int = 1,
+            max_length: Optional[int] = None,
+            length_penalty: float = .6) -> Tuple[List[torch.Tensor], ...]:
+        """Decode every batch of dataloader with beam search
+
+        Returns:
+            (list, list): (B, n_best, L) hypotheses and (B, n_best) scores
+                for every batch
+        """
+        model = cast(Transformer,
+                     self.model.module if self.parallel else self.model)
+        model.eval()
+        hypotheses, scores = [], []
+        for batch in dataloader:
+            parsed = self.parse_batch(batch)
+            if len(parsed) == 7:
+                raise ValueError('Cannot decode packed batches')
+            inputs, _, mask_inputs, _ = parsed
+            out, score = model.beam_search(inputs,
+                                           bos_indx,
+                                           eos_indx,
+                                           source_mask=mask_inputs,
+                                           pad_indx=pad_indx,
+                                           beam_size=beam_size,
+                                           n_best=n_best,
+                                           max_length=max_length,
+                                           length_penalty=length_penalty)
+            hypotheses.append(out)
+            scores.append(score)
+        return hypotheses, scores
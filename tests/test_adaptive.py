@@ -0,0 +1,37 @@
+import torch
+
+from slp.modules.adaptive import AdaptiveInput, AdaptiveSoftmax
+from slp.modules.loss import AdaptiveSoftmaxLoss
+
+
+def test_adaptive_softmax_matches_full_log_prob():
+    torch.manual_seed(0)
+    softmax = AdaptiveSoftmax(32, 100, cutoffs=[10, 40])
+    x = torch.randn(50, 32) * 3
+    targets = torch.randint(100, (50,))
+    log_probs = softmax.log_prob(x)
+    assert torch.allclose(log_probs.logsumexp(-1), torch.zeros(50),
+                          atol=1e-5)
+    expected = log_probs.gather(1, targets.unsqueeze(-1)).squeeze(-1)
+    assert torch.allclose(softmax(x, targets), expected, atol=1e-5)
+    values, indices = softmax.topk(x, k=5)
+    expected_values, expected_indices = log_probs.topk(5, dim=-1)
+    assert torch.allclose(values, expected_values, atol=1e-5)
+    assert torch.all(indices == expected_indices)
+    targets[:5] = -100
+    loss = AdaptiveSoftmaxLoss(softmax)(x, targets)
+    assert torch.allclose(loss, -expected[5:].mean(), atol=1e-5)
+
+
+def test_adaptive_input_tied_with_adaptive_softmax():
+    torch.manual_seed(0)
+    softmax = AdaptiveSoftmax(32, 100, cutoffs=[10, 40])
+    embed = AdaptiveInput(100, 32, cutoffs=[10, 40])
+    embed.tie_weights(softmax)
+    assert embed.embeddings[2].weight is softmax.tail[1][1].weight
+    x = torch.tensor([[3, 15, 70]])
+    out = embed(x)
+    assert out.size() == (1, 3, 32)
+    assert torch.allclose(out[0, 0], softmax.head.weight[3])
+    expected = softmax.tail[1][1].weight[30] @ softmax.tail[1][0].weight
+    assert torch.allclose(out[0, 2], expected)
@@ -0,0 +1,124 @@
+import pytest
+import torch
+
+from slp.data.collators import PackedTransformerCollator
+from slp.modules.attention import (
+    LinearAttention, MultiheadAttentionParallel, SlidingWindowAttention)
+from slp.modules.transformer import Transformer
+from slp.modules.util import subsequent_mask
+
+
+def test_chunked_attention_matches_dense():
+    torch.manual_seed(0)
+    dense = MultiheadAttentionParallel(32, 4, dropout=0.)
+    chunked = MultiheadAttentionParallel(
+        32, 4, dropout=0., attention_backend='chunked', chunk_size=5)
+    chunked.load_state_dict(dense.state_dict())
+    x = torch.randn(2, 13, 32)
+    mask = torch.ones(2, 1, 13)
+    mask[1, :, 9:] = 0
+    mask = mask * torch.ones(13, 13).triu().t().unsqueeze(0)
+    out_dense = dense(x, attention_mask=mask)
+    out_chunked = chunked(x, attention_mask=mask)
+    assert torch.allclose(out_dense, out_chunked, atol=1e-5)
+    out_dense.sum().backward()
+    out_chunked.sum().backward()
+    for p1, p2 in zip(dense.parameters(), chunked.parameters()):
+        assert torch.allclose(p1.grad, p2.grad, atol=1e-4)
+
+
+def test_sliding_window_attention_matches_banded_dense():
+    torch.manual_seed(0)
+    length, window, num_global = 11, 2, 1
+    dense = MultiheadAttentionParallel(16, 2, dropout=0., fused_qkv=True)
+    local = SlidingWindowAttention(16, 2, dropout=0., window_size=window,
+                                   num_global_tokens=num_global,
+                                   fused_qkv=True)
+    local.load_state_dict(dense.state_dict())
+    idx = torch.arange(length)
+    band = (idx.unsqueeze(1) - idx.unsqueeze(0)).abs() <= window
+    band[:num_global] = True
+    band[:, :num_global] = True
+    x = torch.randn(2, length, 16)
+    mask = torch.ones(2, 1, length)
+    mask[1, :, 8:] = 0
+    expected = dense(x, attention_mask=mask * band.float())
+    out = local(x, attention_mask=mask)
+    assert torch.allclose(expected[0], out[0], atol=1e-5)
+    assert torch.allclose(expected[1, :8], out[1, :8], atol=1e-5)
+
+
+def test_causal_linear_attention_ignores_future():
+    torch.manual_seed(0)
+    attention = LinearAttention(16, 2, dropout=0., causal=True, chunk_size=4)
+    x = torch.randn(2, 10, 16)
+    assert torch.allclose(attention(x)[:, :7], attention(x[:, :7]),
+                          atol=1e-5)
+
+
+def test_causal_favor_attention_is_stable():
+    torch.manual_seed(0)
+    causal = LinearAttention(16, 2, dropout=0., feature_map='favor',
+                             causal=True, chunk_size=4).eval()
+    full = LinearAttention(16, 2, dropout=0., feature_map='favor').eval()
+    full.load_state_dict(causal.state_dict())
+    for scale in (1., 30.):
+        x = torch.randn(2, 10, 16) * scale
+        out = causal(x)
+        assert torch.isfinite(out).all()
+        # The last position attends to every key in both
+        assert torch.allclose(out[:, -1], full(x)[:, -1], atol=1e-4)
+    # Incremental decoding rescales the running sums
+    cache = {}
+    steps = [causal(x[:, i:i + 1] / 30, cache=cache) for i in range(10)]
+    assert torch.allclose(torch.cat(steps, dim=1), causal(x / 30),
+                          atol=1e-4)
+
+
+def test_linear_attention_rejects_packed_masks():
+    attention = LinearAttention(16, 2, dropout=0., causal=True)
+    x = torch.randn(2, 6, 16)
+    padding = torch.ones(2, 1, 6)
+    padding[1, :, 4:] = 0
+    segments = torch.tensor([[1, 1, 1, 2, 2, 2], [1, 1, 2, 2, 0, 0]])
+    packed = PackedTransformerCollator.segment_mask(segments)
+    with pytest.raises(ValueError):
+        attention(x, attention_mask=packed * subsequent_mask(6))
+    attention(x, attention_mask=padding * subsequent_mask(6))
+    # Only the first valid mask is checked, to avoid a device sync on
+    # every forward
+    assert attention.mask_checked
+    attention(x, attention_mask=packed * subsequent_mask(6))
+
+
+def test_fused_qkv_loads_separate_projections():
+    torch.manual_seed(0)
+    separate = MultiheadAttentionParallel(16, 4, dropout=0.).eval()
+    fused = MultiheadAttentionParallel(16, 4, dropout=0.,
+                                       fused_qkv=True).eval()
+    fused.load_state_dict(separate.state_dict(), strict=True)
+    x, queries = torch.randn(2, 5, 16), torch.randn(2, 3, 16)
+    assert torch.allclose(fused(x), separate(x), atol=1e-6)
+    assert torch.allclose(fused(x, queries=queries),
+                          separate(x, queries=queries), atol=1e-6)
+
+
+def test_transformer_loads_checkpoint_without_fused_qkv():
+    torch.manual_seed(0)
+    kwargs = dict(vocab_size=50, max_length=16, num_layers=2,
+                  hidden_size=16, num_heads=4, inner_size=32)
+    model = Transformer(**kwargs).eval()
+    # Checkpoints saved before fused_qkv have separate q, k, v weights
+    state_dict = {}
+    for key, value in model.state_dict().items():
+        if key.endswith('qkv.weight'):
+            for name, w in zip('qkv', value.chunk(3, dim=0)):
+                state_dict[key.replace('qkv', name)] = w
+        else:
+            state_dict[key] = value
+    loaded = Transformer(**kwargs).eval()
+    loaded.load_state_dict(state_dict, strict=True)
+    source = torch.randint(1, 50, (2, 7))
+    target = torch.randint(1, 50, (2, 5))
+    assert torch.allclose(loaded(source, target), model(source, target),
+                          atol=1e-6)
@@ -0,0 +1,67 @@
+import torch
+
+from torch.utils.data import Dataset
+
+from slp.data.cache import CollatedBatchCache
+from slp.data.collators import SequenceClassificationCollator
+
+collate_fn = SequenceClassificationCollator(device='cpu')
+
+
+class CountingDataset(Dataset):
+    def __init__(self, lengths):
+        self.lengths = lengths
+        self.calls = 0
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, i):
+        self.calls += 1
+        return torch.arange(1, self.lengths[i] + 1), i
+
+
+def test_cache_buckets_and_replays_batches():
+    dataset = CountingDataset([5, 1, 4, 2, 3])
+    cache = CollatedBatchCache(dataset, collate_fn, batch_size=2,
+                               shuffle=False)
+    # Once for the lengths and once for the batches
+    assert dataset.calls == 2 * len(dataset)
+    assert len(cache) == 3
+    batches = list(cache)
+    assert [b[2].tolist() for b in batches] == [[1, 2], [3, 4], [5]]
+    assert sorted(sum((b[1].tolist() for b in batches), [])) == [
+        0, 1, 2, 3, 4]
+    assert torch.equal(batches[1][0], torch.tensor([[1, 2, 3, 0],
+                                                    [1, 2, 3, 4]]))
+
+
+def test_cache_dir_is_rebuilt_when_parameters_change(tmp_path):
+    dataset = CountingDataset([5, 1, 4, 2, 3])
+    cache_dir = str(tmp_path / 'cache')
+    cache = CollatedBatchCache(dataset, collate_fn, batch_size=2,
+                               shuffle=False, cache_dir=cache_dir)
+    expected = list(cache)
+    reused = CollatedBatchCache(dataset, collate_fn, batch_size=2,
+                                shuffle=False, cache_dir=cache_dir)
+    assert dataset.calls == 2 * len(dataset)
+    assert all(torch.equal(a, b)
+               for x, y in zip(expected, reused) for a, b in zip(x, y))
+    rebuilt = CollatedBatchCache(dataset, collate_fn, batch_size=3,
+                                 shuffle=False, cache_dir=cache_dir)
+    assert dataset.calls == 4 * len(dataset)
+    assert len(rebuilt) == 2
+    unbucketed = CollatedBatchCache(dataset, collate_fn, batch_size=2,
+                                    shuffle=False, bucket=False,
+                                    cache_dir=cache_dir)
+    assert dataset.calls == 5 * len(dataset)
+    assert [b[1].tolist() for b in unbucketed] == [[0, 1], [2, 3], [4]]
+
+
+def test_cache_empty_dataset(tmp_path):
+    cache = CollatedBatchCache(CountingDataset([]), collate_fn,
+                               cache_dir=str(tmp_path))
+    assert len(cache) == 0
+    assert list(cache) == []
+    assert len(CollatedBatchCache(CountingDataset([]), collate_fn,
+                                  cache_dir=str(tmp_path))) == 0
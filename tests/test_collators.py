@@ -0,0 +1,46 @@
+import pytest
+import torch
+
+from slp.data.collators import MLMCollator, PackedTransformerCollator
+
+
+def test_mlm_collator_never_masks_padding_or_specials():
+    torch.manual_seed(0)
+    collate_fn = MLMCollator(mask_indx=1, vocab_size=100, pad_indx=0,
+                             mlm_probability=.5, special_indices=[2])
+    batch = [torch.randint(3, 100, (n,)) for n in (5, 17, 9, 30)]
+    batch[0][0] = 2
+    inputs, targets, mask = collate_fn(batch)
+    assert inputs.size() == targets.size() == (4, 30)
+    assert mask.size() == (4, 1, 30)
+    selected = targets != -100
+    pad = mask.squeeze(1) == 0
+    assert not (selected & pad).any()
+    assert torch.all(inputs[pad] == 0)
+    assert targets[0, 0] == -100
+    padded = torch.nn.utils.rnn.pad_sequence(batch, batch_first=True)
+    assert torch.all(targets[selected] == padded[selected])
+    assert torch.all(inputs[~selected] == padded[~selected])
+
+
+def test_packed_collator_masks_segments():
+    batch = [(torch.arange(1, n + 1), torch.arange(2, n + 2))
+             for n in (3, 5, 2, 6)]
+    collate_fn = PackedTransformerCollator(max_length=8)
+    inputs, targets, m_in, m_tgt, pos_in, pos_tgt, m_x = collate_fn(batch)
+    assert inputs.size() == (2, 8)
+    assert collate_fn.packing_efficiency == 16 / 16
+    # first row holds the examples of length 6 and 2
+    assert torch.all(pos_in[0] == torch.tensor([0, 1, 2, 3, 4, 5, 0, 1]))
+    assert m_in[0, 0, 5] == 1 and m_in[0, 0, 6] == 0
+    assert m_in[0, 7, 6] == 1 and m_in[0, 7, 5] == 0
+    assert m_tgt[0, 6, 7] == 0 and m_tgt[0, 7, 6] == 1
+    assert m_tgt[0, 6, 5] == 0
+    assert m_x[0, 6, 6] == 1 and m_x[0, 6, 5] == 0
+
+
+def test_packed_collator_rejects_long_examples():
+    batch = [(torch.arange(1, 10), torch.arange(2, 11))]
+    collate_fn = PackedTransformerCollator(max_length=8)
+    with pytest.raises(ValueError):
+        collate_fn(batch)
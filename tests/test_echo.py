@@ -0,0 +1,88 @@
+import slp.data.echo
+
+from slp.data.echo import DataEcho
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.
+
+    def time(self):
+        return self.now
+
+
+class PrefetchingLoader(object):
+    """Produces a batch every produce_time in the background and keeps up
+    to depth batches ready, like a DataLoader with workers. The first batch
+    also waits for the startup of the workers
+    """
+    def __init__(self, clock, num_batches, produce_time, depth=2,
+                 startup_time=0.):
+        self.clock = clock
+        self.num_batches = num_batches
+        self.produce_time = produce_time
+        self.depth = depth
+        self.startup_time = startup_time
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        done, taken = [], []
+        for i in range(self.num_batches):
+            start = done[-1] if done else self.startup_time
+            if i >= self.depth:
+                start = max(start, taken[i - self.depth])
+            done.append(start + self.produce_time)
+            self.clock.now = max(self.clock.now, done[-1])
+            taken.append(self.clock.now)
+            yield i
+
+
+def test_fixed_echo_factor_repeats_every_batch():
+    echo = DataEcho(list(range(5)), echo_factor=3, buffer_size=2)
+    out = list(echo)
+    assert len(echo) == len(out) == 15
+    assert sorted(out) == sorted(list(range(5)) * 3)
+
+
+def test_auto_echo_factor_matches_producer_to_step_ratio(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(slp.data.echo, 'time', clock)
+    loader = PrefetchingLoader(clock, num_batches=100, produce_time=.03)
+    echo = DataEcho(loader, echo_factor='auto', max_echo=8)
+    factors = []
+    for _ in echo:
+        clock.now += .01
+        factors.append(echo.echo_factor)
+    factors = factors[len(factors) // 2:]
+    # The factor is decreased now and then to probe the loader
+    assert all(f in (2, 3) for f in factors)
+    assert sum(f == 3 for f in factors) > .8 * len(factors)
+
+
+def test_auto_echo_factor_ignores_slow_startup(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(slp.data.echo, 'time', clock)
+    loader = PrefetchingLoader(clock, num_batches=100, produce_time=.005,
+                               startup_time=1.)
+    echo = DataEcho(loader, echo_factor='auto', max_echo=4)
+    factors = []
+    for _ in echo:
+        clock.now += .01
+        factors.append(echo.echo_factor)
+    assert len(factors) == 100
+    assert all(f == 1 for f in factors)
+
+
+def test_auto_echo_factor_decreases(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(slp.data.echo, 'time', clock)
+    loader = PrefetchingLoader(clock, num_batches=100, produce_time=.005)
+    echo = DataEcho(loader, echo_factor='auto', max_echo=4)
+    echo.echo_factor = 4
+    factors = []
+    for _ in echo:
+        clock.now += .01
+        factors.append(echo.echo_factor)
+    assert factors[-1] == 1
@@ -0,0 +1,23 @@
+import torch
+import torch.nn as nn
+
+from slp.modules.factorized import FactorizedLinear, factorize_linear
+from slp.modules.feedforward import PositionwiseFF
+
+
+def test_full_rank_svd_is_exact():
+    torch.manual_seed(0)
+    linear = nn.Linear(16, 24)
+    factorized = FactorizedLinear.from_linear(linear, energy=1.)
+    x = torch.randn(5, 16)
+    assert factorized.rank == 16
+    assert torch.allclose(factorized(x), linear(x), atol=1e-5)
+    assert torch.allclose(factorized.to_linear()(x), linear(x), atol=1e-5)
+
+
+def test_factorize_linear_replaces_shared_references():
+    ff = PositionwiseFF(32, 128, dropout=0.).eval()
+    replaced = factorize_linear(ff, rank=8)
+    assert set(replaced) == {'ff1.fc', 'ff2'}
+    assert ff.net[2] is ff.ff2
+    assert not any(type(m) is nn.Linear for m in ff.modules())
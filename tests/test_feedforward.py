@@ -0,0 +1,79 @@
+import copy
+
+import pytest
+import torch
+
+from slp.modules.feedforward import MoEPositionwiseFF
+from slp.modules.transformer import Encoder, Transformer
+from slp.trainer.metrics import clear_aux_loss
+
+
+def test_moe_matches_per_token_experts():
+    torch.manual_seed(0)
+    moe = MoEPositionwiseFF(16, 32, num_experts=4, top_k=2,
+                            capacity_factor=4., dropout=0.)
+    x = torch.randn(3, 5, 16)
+    out = moe(x).view(-1, 16)
+    x = x.view(-1, 16)
+    gates, experts = torch.softmax(moe.router(x), -1).topk(2, dim=-1)
+    gates = gates / gates.sum(-1, keepdim=True)
+    for n in range(x.size(0)):
+        expected = torch.zeros(16)
+        for g, e in zip(gates[n], experts[n]):
+            h = torch.relu(x[n] @ moe.w1[e] + moe.b1[e, 0])
+            expected += g * (h @ moe.w2[e] + moe.b2[e, 0])
+        assert torch.allclose(out[n], expected, atol=1e-5)
+    assert moe.aux_loss > 0
+    # Tokens over capacity are dropped
+    moe.capacity_factor = .25
+    out = moe(x)
+    assert moe.capacity(x.size(0)) == 2
+    assert (out.abs().sum(-1) == 0).any()
+
+
+def test_moe_aux_loss_does_not_keep_graph():
+    moe = MoEPositionwiseFF(16, 32, num_experts=4)
+    x = torch.randn(3, 5, 16)
+    moe(x)
+    assert moe.aux_loss.requires_grad
+    # The graph is dropped when copying
+    assert copy.deepcopy(moe).aux_loss is None
+    clear_aux_loss(moe)
+    moe.eval()
+    moe(x)
+    assert not moe.aux_loss.requires_grad
+
+
+def test_moe_aux_loss_sums_shared_layer_calls():
+    torch.manual_seed(0)
+    encoder = Encoder(num_layers=2, hidden_size=16, num_heads=2,
+                      inner_size=32, feedforward_type='moe',
+                      shared_layers=True).eval()
+    moe = encoder.encoder[0].l2.sublayer
+    x = torch.randn(3, 5, 16)
+    losses = []
+    hidden = x
+    for layer in encoder.encoder:
+        clear_aux_loss(encoder)
+        hidden = layer(hidden)
+        losses.append(moe.aux_loss)
+    clear_aux_loss(encoder)
+    encoder(x)
+    assert torch.allclose(moe.aux_loss, sum(losses))
+    with pytest.raises(ValueError):
+        Encoder(num_layers=2, hidden_size=16, num_heads=2, inner_size=32,
+                feedforward_type='moe', checkpoint_every=1)
+    with pytest.raises(ValueError):
+        Transformer(vocab_size=10, max_length=8, num_layers=1,
+                    hidden_size=16, num_heads=2, inner_size=32,
+                    feedforward_type='moe', reversible=True)
+
+
+def test_moe_biases_start_at_zero():
+    model = Transformer(vocab_size=10, max_length=8, num_layers=1,
+                        hidden_size=16, num_heads=2, inner_size=32,
+                        feedforward_type='moe')
+    moes = [m for m in model.modules() if isinstance(m, MoEPositionwiseFF)]
+    assert len(moes) == 2
+    for m in moes:
+        assert not m.b1.any() and not m.b2.any()
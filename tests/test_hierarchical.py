@@ -0,0 +1,41 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+from slp.modules.hierarchical import HierarchicalEncoder
+from slp.modules.rnn import WordRNN
+
+
+class SumEncoder(nn.Module):
+    """Encodes a chunk as (sum of token ids, length)"""
+    def __init__(self):
+        super(SumEncoder, self).__init__()
+        self.max_length = 0
+
+    def forward(self, x, lengths):
+        self.max_length = max(self.max_length, x.size(1))
+        assert (lengths > 0).all()
+        return torch.stack((x.sum(1).float(), lengths.float()), dim=-1)
+
+
+def test_hierarchical_encoder_pools_chunks():
+    x = torch.zeros(2, 10, dtype=torch.long)
+    x[0] = torch.arange(1, 11)
+    x[1, :3] = torch.arange(1, 4)
+    lengths = torch.tensor([10, 3])
+    encoder = SumEncoder()
+    out = HierarchicalEncoder(encoder, chunk_size=4)(x, lengths)
+    assert encoder.max_length == 4
+    # Chunks [1..4], [5..8], [9, 10] and [1, 2, 3]
+    assert torch.allclose(out, torch.tensor([[55 / 3, 10 / 3], [6., 3.]]))
+    out = HierarchicalEncoder(encoder, chunk_size=4, pooling='max')(
+        x, lengths)
+    assert torch.allclose(out, torch.tensor([[26., 4.], [6., 3.]]))
+
+
+def test_hierarchical_encoder_with_word_rnn():
+    embeddings = np.random.randn(50, 8).astype('float32')
+    model = HierarchicalEncoder(WordRNN(16, embeddings), chunk_size=5)
+    x = torch.randint(1, 50, (3, 12))
+    out = model(x, torch.tensor([12, 7, 2]))
+    assert out.size() == (3, 16)
@@ -0,0 +1,106 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+from slp.modules.attention import MultiheadAttentionParallel
+from slp.modules.classifier import Classifier
+from slp.modules.factorized import FactorizedLinear, factorize_linear
+from slp.modules.inference import export_torchscript, optimize_for_inference
+from slp.modules.quantization import quantize_dynamic
+from slp.modules.rnn import WordRNN
+from slp.modules.transformer import Transformer
+from slp.modules.util import subsequent_mask
+
+
+def test_optimize_for_inference_matches_eval():
+    torch.manual_seed(0)
+    model = Transformer(vocab_size=100, max_length=32, num_layers=2,
+                        hidden_size=32, num_heads=4, inner_size=64,
+                        embedding_size=16).eval()
+    optimized = optimize_for_inference(model, max_length=8)
+    source = torch.randint(1, 100, (2, 8))
+    target = torch.randint(1, 100, (2, 6))
+    args = (source, target, torch.ones(2, 1, 8),
+            subsequent_mask(6).expand(2, -1, -1))
+    assert torch.allclose(optimized(*args), model(*args), atol=1e-5)
+    assert optimized.embed.scale == 1
+    assert optimized.pe.pe.size(1) == 8
+    assert not any(p.requires_grad for p in optimized.parameters())
+    assert not any(isinstance(m, nn.Dropout) and m.p > 0
+                   for m in optimized.modules())
+    for layer in optimized.transformer_block.decoder.decoder:
+        assert layer.in_layer.sublayer.fused_qkv
+        assert not layer.fuse_layer.sublayer.fused_qkv
+
+
+def test_optimize_for_inference_with_quantized_and_factorized_layers():
+    torch.manual_seed(0)
+    model = Transformer(vocab_size=100, max_length=32, num_layers=2,
+                        hidden_size=32, num_heads=4, inner_size=64).eval()
+    source = torch.randint(1, 100, (2, 8))
+    target = torch.randint(1, 100, (2, 6))
+    args = (source, target, torch.ones(2, 1, 8),
+            subsequent_mask(6).expand(2, -1, -1))
+    expected = model(*args)
+    for optimized in (quantize_dynamic(optimize_for_inference(model)),
+                      optimize_for_inference(quantize_dynamic(model))):
+        assert optimized(*args).size() == expected.size()
+    factorize_linear(model, rank=4, exclude=('predict',))
+    num_params = sum(p.numel() for p in model.parameters())
+    optimized = optimize_for_inference(model)
+    assert sum(p.numel() for p in optimized.parameters()) == num_params
+    assert torch.allclose(optimized(*args), model(*args), atol=1e-5)
+
+
+def test_fused_cross_attention_without_linear_weights():
+    torch.manual_seed(0)
+    attention = MultiheadAttentionParallel(16, 4, dropout=0.,
+                                           fused_qkv=True).eval()
+    x, queries = torch.randn(2, 7, 16), torch.randn(2, 5, 16)
+    expected = attention(x, queries=queries)
+    attention.qkv = FactorizedLinear.from_linear(attention.qkv, rank=16)
+    assert torch.allclose(attention(x, queries=queries), expected, atol=1e-5)
+
+
+def test_scripted_classifier_matches_eager(tmp_path):
+    torch.manual_seed(0)
+    embeddings = np.random.randn(100, 16).astype('float32')
+    model = Classifier(WordRNN(32, embeddings, bidirectional=True,
+                               packed_sequence=True, attention=True),
+                       64, 3).eval()
+    path = str(tmp_path / 'classifier.pt')
+    export_torchscript(model, path=path)
+    scripted = torch.jit.load(path)
+    x = torch.randint(1, 100, (4, 10))
+    lengths = torch.tensor([10, 7, 5, 2])
+    assert torch.allclose(scripted(x, lengths), model(x, lengths), atol=1e-5)
+
+
+class MeanEncoder(nn.Module):
+    def __init__(self):
+        super(MeanEncoder, self).__init__()
+        self.embed = nn.Embedding(100, 16)
+
+    def forward(self, x):
+        return self.embed(x).mean(1)
+
+
+def test_classifier_with_encoder_without_lengths():
+    torch.manual_seed(0)
+    model = Classifier(MeanEncoder(), 16, 3).eval()
+    x = torch.randint(1, 100, (4, 10))
+    expected = model.clf(model.encoder(x))
+    assert torch.allclose(model(x), expected)
+    assert torch.allclose(export_torchscript(model)(x), expected, atol=1e-5)
+
+
+def test_scripted_transformer_matches_eager():
+    torch.manual_seed(0)
+    model = Transformer(vocab_size=100, max_length=32, num_layers=2,
+                        hidden_size=32, num_heads=4, inner_size=64).eval()
+    scripted = export_torchscript(model, optimize=False)
+    source = torch.randint(1, 100, (2, 8))
+    target = torch.randint(1, 100, (2, 6))
+    args = (source, target, torch.ones(2, 1, 8),
+            subsequent_mask(6).expand(2, -1, -1))
+    assert torch.allclose(scripted(*args), model(*args), atol=1e-5)
@@ -0,0 +1,20 @@
+import torch
+import torch.nn.functional as F
+
+from slp.modules.loss import linear_cross_entropy
+
+
+def test_linear_cross_entropy_matches_dense():
+    torch.manual_seed(0)
+    hidden = torch.randn(37, 16, requires_grad=True)
+    weight = torch.randn(50, 16, requires_grad=True)
+    bias = torch.randn(50, requires_grad=True)
+    targets = torch.randint(50, (37,))
+    targets[:4] = -100
+    loss = linear_cross_entropy(hidden, weight, bias, targets, chunk_size=8)
+    grads = torch.autograd.grad(loss, (hidden, weight, bias))
+    expected = F.cross_entropy(F.linear(hidden, weight, bias), targets)
+    expected_grads = torch.autograd.grad(expected, (hidden, weight, bias))
+    assert torch.allclose(loss, expected, atol=1e-5)
+    for g, e in zip(grads, expected_grads):
+        assert torch.allclose(g, e, atol=1e-5)
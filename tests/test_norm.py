@@ -0,0 +1,17 @@
+import torch
+
+from slp.modules.norm import LayerNorm
+
+
+def test_layer_norm_matches_tf_style_layer_norm():
+    torch.manual_seed(0)
+    ln = LayerNorm(16)
+    ln.weight.data.uniform_()
+    ln.bias.data.uniform_()
+    x = torch.randn(4, 8, 16) * 5
+    residual = torch.randn(4, 8, 16)
+    y = residual + x
+    u = y.mean(-1, keepdim=True)
+    s = (y - u).pow(2).mean(-1, keepdim=True)
+    expected = ln.weight * (y - u) / torch.sqrt(s + 1e-12) + ln.bias
+    assert torch.allclose(ln(x, residual=residual), expected, atol=1e-5)
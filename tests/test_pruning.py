@@ -0,0 +1,126 @@
+import torch
+
+from ignite.engine import Engine, Events
+
+from slp.modules.attention import MultiheadAttentionParallel
+from slp.modules.feedforward import PositionwiseFF
+from slp.modules.pruning import (
+    MagnitudePruner, compact, head_importance, prune_heads,
+    prune_heads_by_importance)
+from slp.modules.transformer import Transformer
+from slp.trainer.handlers import PruningHandler
+
+
+def test_gradual_magnitude_pruning():
+    ff = PositionwiseFF(32, 64)
+    pruner = MagnitudePruner(ff, .75, start_step=1, end_step=9, frequency=2)
+    for step in range(1, 10):
+        pruner.step(step)
+    assert abs(pruner.current_sparsity() - .75) < 1e-3
+    with torch.no_grad():
+        ff.ff2.weight.add_(1.)
+    pruner.step(10)
+    assert abs(pruner.current_sparsity() - .75) < 1e-3
+
+
+def test_compact_removes_dead_heads():
+    torch.manual_seed(0)
+    for fused in (False, True):
+        attention = MultiheadAttentionParallel(
+            32, num_heads=4, dropout=0., fused_qkv=fused).eval()
+        prune_heads(attention, [0])
+        # Head 1 (was 2) gets a zero value projection
+        with torch.no_grad():
+            w_v = (attention.qkv.weight[2 * 24:] if fused
+                   else attention.v.weight)
+            w_v[8:16] = 0
+        x = torch.randn(2, 5, 32)
+        expected = attention(x)
+        assert compact(attention) == {'': [1]}
+        assert attention.num_heads == 2
+        assert attention.output.fc.in_features == 16
+        assert torch.allclose(attention(x), expected, atol=1e-5)
+
+
+def test_head_magnitude_pruning_is_compacted():
+    torch.manual_seed(0)
+    model = Transformer(vocab_size=20, max_length=8, num_layers=2,
+                        hidden_size=32, num_heads=4, inner_size=64,
+                        device='cpu').eval()
+    pruner = MagnitudePruner(model, .5, structure='head')
+    pruner.step(0)
+    assert pruner.current_sparsity() == .5
+    source = torch.randint(1, 20, (2, 6))
+    target = torch.randint(1, 20, (2, 5))
+    expected = model(source, target)
+    removed = compact(model)
+    # 6 attention layers with 4 heads
+    assert sum(len(h) for h in removed.values()) == 12
+    assert torch.allclose(model(source, target), expected, atol=1e-5)
+
+
+def test_layer_scope_prunes_every_layer():
+    ff = PositionwiseFF(32, 64)
+    pruner = MagnitudePruner(ff, .5, scope='layer')
+    pruner.step(0)
+    for w in pruner.weights.values():
+        assert int((w == 0).sum()) == w.numel() // 2
+
+
+def test_head_importance_is_summed_per_example():
+    torch.manual_seed(0)
+    attention = MultiheadAttentionParallel(32, num_heads=4, dropout=0.)
+    x, w = torch.randn(2, 5, 32), torch.randn(2, 5, 32)
+
+    def loss_fn(model, batch):
+        return (model(batch[0]) * batch[1]).sum()
+
+    batched = head_importance(attention, [(x, w)], loss_fn)
+    single = head_importance(attention, [(x[:1], w[:1]), (x[1:], w[1:])],
+                             loss_fn)
+    assert torch.allclose(batched[''], single[''], atol=1e-5)
+    assert batched[''].size() == (4,)
+
+
+def test_prune_heads_by_importance_keeps_parameters():
+    torch.manual_seed(0)
+    model = Transformer(vocab_size=20, max_length=8, num_layers=1,
+                        hidden_size=32, num_heads=4, inner_size=64,
+                        device='cpu')
+    pruner = MagnitudePruner(model, .5)
+    pruner.step(0)
+    parameters = list(model.parameters())
+    optimizer = torch.optim.SGD(model.parameters(), lr=.1)
+    importance = {name: torch.tensor([.1, .4, .3, .2]) for name in
+                  ('transformer_block.encoder.encoder.0.l1.sublayer',
+                   'transformer_block.decoder.decoder.0.in_layer.sublayer')}
+    importance['transformer_block.decoder.decoder.0.fuse_layer.sublayer'] = (
+        torch.zeros(4))
+    pruned = prune_heads_by_importance(model, importance, .5)
+    # The 6 lowest scores, and the last layer keeps one head
+    assert pruned['transformer_block.encoder.encoder.0.l1.sublayer'] == [0]
+    assert len(pruned[
+        'transformer_block.decoder.decoder.0.fuse_layer.sublayer']) == 3
+    assert sum(len(h) for h in pruned.values()) == 6
+    assert all(a is b for a, b in zip(parameters, model.parameters()))
+    source = torch.randint(1, 20, (2, 6))
+    target = torch.randint(1, 20, (2, 5))
+    model(source, target).sum().backward()
+    optimizer.step()
+    pruner.step(1)
+    assert abs(pruner.current_sparsity() - .5) < 1e-3
+
+
+def test_pruning_handler_follows_the_trainer():
+    ff = PositionwiseFF(32, 64)
+    pruner = MagnitudePruner(ff, .5, start_step=2, end_step=6, frequency=2)
+    trainer = Engine(lambda engine, batch: None)
+    PruningHandler(pruner).attach(trainer)
+    sparsity = []
+    trainer.add_event_handler(
+        Events.ITERATION_COMPLETED,
+        lambda engine: sparsity.append(pruner.current_sparsity()))
+    trainer.run(range(4), max_epochs=2)
+    assert sparsity[0] == 0
+    assert all(a <= b for a, b in zip(sparsity, sparsity[1:]))
+    assert abs(sparsity[-1] - .5) < 1e-3
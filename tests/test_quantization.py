@@ -0,0 +1,45 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+from slp.modules.classifier import Classifier
+from slp.modules.feedforward import PositionwiseFF
+from slp.modules.quantization import quantize_dynamic, quantize_static
+from slp.modules.rnn import WordRNN
+
+
+def test_quantize_dynamic_word_rnn():
+    torch.manual_seed(0)
+    embeddings = np.random.randn(100, 16).astype('float32')
+    model = Classifier(
+        WordRNN(32, embeddings, bidirectional=True, merge_bi='cat',
+                packed_sequence=True, attention=True),
+        64, 3).eval()
+    quantized = quantize_dynamic(model)
+    assert not any(type(m) in (nn.Linear, nn.LSTM)
+                   for m in quantized.modules())
+    inputs = torch.randint(1, 100, (4, 10))
+    lengths = torch.tensor([10, 7, 5, 2])
+    assert torch.allclose(quantized(inputs, lengths), model(inputs, lengths),
+                          atol=.1)
+
+
+def test_word_rnn_masks_follow_the_inputs():
+    torch.manual_seed(0)
+    embeddings = np.random.randn(100, 16).astype('float32')
+    # e.g. trained on cuda and moved to the cpu for int8 inference
+    model = Classifier(
+        WordRNN(32, embeddings, attention=True, device='cuda'), 32, 3).eval()
+    inputs = torch.randint(1, 100, (4, 10))
+    lengths = torch.tensor([10, 7, 5, 2])
+    assert quantize_dynamic(model)(inputs, lengths).size() == (4, 3)
+
+
+def test_quantize_static_calibrates_linear_layers():
+    torch.manual_seed(0)
+    ff = PositionwiseFF(16, 64, dropout=0.).eval()
+    batches = [torch.randn(4, 10, 16) for _ in range(3)]
+    quantized = quantize_static(ff, batches, lambda m, x: m(x))
+    assert quantized.net[2] is quantized.ff2
+    assert not any(type(m) is nn.Linear for m in quantized.modules())
+    assert torch.allclose(quantized(batches[0]), ff(batches[0]), atol=.1)
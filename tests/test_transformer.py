@@ -10,9 +10,12 @@ from torch.utils.data import DataLoader, Dataset
 from slp.config import SPECIAL_TOKENS
 from slp.data.collators import TransformerCollator
 from slp.data.vocab import create_vocab
-from slp.modules.transformer import Transformer
+from slp.modules.loss import LinearCrossEntropyLoss
+from slp.modules.transformer import ReversibleEncoder, Transformer
+from slp.modules.util import share_layer_weights, subsequent_mask
 from slp.data.transforms import ToTokenIds, ToTensor
 from slp.trainer import TransformerTrainer
+from slp.util.parallel import DataParallelCriterion, DataParallelModel
 
 collate_fn = TransformerCollator(device='cpu')
 
@@ -146,3 +149,221 @@ def test_model_overfits_single_batch():
     print(f'Targets={targets}')
     print(f'Predicted={pred_tokens}')
     assert torch.all(torch.eq(targets, pred_tokens))
+
+
+def test_parallel_loss_gets_hidden_states():
+    model = create_model(hidden_size=32)
+    trainer = TransformerTrainer(
+        model,
+        optim.SGD(model.parameters(), lr=.1),
+        checkpoint_dir=None,
+        loss_fn=LinearCrossEntropyLoss(model.predict),
+        device='cpu')
+    # As set up by parallel=True, which needs cuda devices
+    trainer.parallel = True
+    trainer.model = DataParallelModel(model)
+    trainer.loss_fn = DataParallelCriterion(trainer.loss_fn)
+    y_pred, targets = trainer.get_predictions_and_targets(
+        next(iter(train_loader)))
+    assert y_pred.size() == (targets.size(0), 32)
+
+
+def test_incremental_decoding_matches_forward():
+    for attention_type, attention_kwargs in (
+            ('full', None), ('linear', None),
+            ('local', {'window_size': 2, 'num_global_tokens': 1})):
+        model = Transformer(vocab_size=len(vocab),
+                            max_length=len(sentence) - 1,
+                            num_layers=2,
+                            hidden_size=32,
+                            num_heads=4,
+                            inner_size=128,
+                            attention_type=attention_type,
+                            attention_kwargs=attention_kwargs,
+                            device='cpu')
+        model.eval()
+        inputs, targets, m1, m2 = next(iter(train_loader))
+        preds = model(inputs, targets, source_mask=m1, target_mask=m2)
+        encoded = model.encode(inputs, source_mask=m1)
+        cache = model.transformer_block.decoder.init_cache()
+        for step in range(targets.size(1)):
+            logits = model.decode(
+                targets[:, step:step + 1], encoded,
+                source_mask=m1,
+                target_positions=torch.tensor([[step]]),
+                cache=cache)
+            assert torch.allclose(logits[:, -1], preds[:, step], atol=1e-5)
+        out = model.generate(inputs, bos_indx=0, eos_indx=1, source_mask=m1)
+        assert out.size(1) <= len(sentence) - 1
+
+
+def test_local_attention_with_different_source_target_lengths():
+    torch.manual_seed(0)
+    model = Transformer(vocab_size=len(vocab),
+                        max_length=16,
+                        num_layers=2,
+                        hidden_size=32,
+                        num_heads=4,
+                        inner_size=64,
+                        attention_type='local',
+                        attention_kwargs={'window_size': 2})
+    model.eval()
+    source = torch.randint(1, len(vocab), (2, 8))
+    target = torch.randint(1, len(vocab), (2, 6))
+    out = model(source, target, source_mask=torch.ones(2, 1, 8),
+                target_mask=subsequent_mask(6).expand(2, -1, -1))
+    assert out.size() == (2, 6, len(vocab))
+    out, _ = model.beam_search(source, bos_indx=0, eos_indx=1, beam_size=2,
+                               max_length=5)
+    assert out.size() == (2, 1, 5)
+
+
+def test_beam_search_with_single_beam_is_greedy():
+    model = create_model(hidden_size=32)
+    model.eval()
+    inputs, targets, m1, m2 = next(iter(train_loader))
+    greedy = model.generate(inputs, bos_indx=0, eos_indx=1, source_mask=m1)
+    out, scores = model.beam_search(inputs, bos_indx=0, eos_indx=1,
+                                    source_mask=m1, beam_size=1)
+    assert torch.all(out[:, 0, :greedy.size(1)] == greedy)
+    out, scores = model.beam_search(inputs, bos_indx=0, eos_indx=1,
+                                    source_mask=m1, beam_size=4, n_best=3)
+    assert out.size()[:2] == scores.size() == (1, 3)
+    assert torch.all(scores[:, :-1] >= scores[:, 1:])
+
+
+def test_exhaustive_beam_search_matches_brute_force():
+    torch.manual_seed(0)
+    vocab_size, max_length, n_best = 4, 3, 5
+    pad, eos, bos = 0, 1, 2
+    model = Transformer(vocab_size=vocab_size,
+                        max_length=max_length,
+                        num_layers=1,
+                        hidden_size=16,
+                        num_heads=2,
+                        inner_size=32,
+                        device='cpu')
+    model.eval()
+    with torch.no_grad():
+        # Likely [EOS] so that some hypotheses finish early
+        model.predict.bias[eos] += 2
+    source = torch.randint(1, vocab_size, (2, max_length))
+    mask = subsequent_mask(max_length).expand(vocab_size ** max_length, -1,
+                                              -1)
+    sequences = torch.cartesian_prod(*[torch.arange(vocab_size)] *
+                                     max_length)
+    for alpha in (0., .6):
+        # The beam holds every sequence, so it finds the exact n best
+        out, scores = model.beam_search(source, bos_indx=bos, eos_indx=eos,
+                                        pad_indx=pad,
+                                        beam_size=vocab_size ** max_length,
+                                        n_best=n_best, max_length=max_length,
+                                        length_penalty=alpha)
+        for i in range(source.size(0)):
+            target = torch.cat((torch.full_like(sequences[:, :1], bos),
+                                sequences[:, :-1]), dim=1)
+            with torch.no_grad():
+                log_probs = torch.log_softmax(
+                    model(source[i:i + 1].expand(len(sequences), -1),
+                          target, target_mask=mask), dim=-1)
+            log_probs = log_probs.gather(-1, sequences.unsqueeze(-1))[..., 0]
+            hypotheses = {}
+            for seq, lp in zip(sequences.tolist(), log_probs.tolist()):
+                length = seq.index(eos) + 1 if eos in seq else max_length
+                hypotheses[tuple(seq[:length])] = (
+                    sum(lp[:length]) / ((5. + length) / 6.) ** alpha)
+            expected = sorted(hypotheses.items(), key=lambda h: -h[1])
+            expected = expected[:n_best]
+            assert torch.allclose(scores[i],
+                                  torch.tensor([h[1] for h in expected]),
+                                  atol=1e-4)
+            for hyp, (seq, _) in zip(out[i].tolist(), expected):
+                assert tuple(hyp[:len(seq)]) == seq
+                assert all(t == pad for t in hyp[len(seq):])
+
+
+def test_layer_checkpointing_matches_gradients():
+    grads = []
+    for checkpoint_every in (None, 1, 2):
+        torch.manual_seed(0)
+        model = Transformer(vocab_size=len(vocab),
+                            max_length=len(sentence) - 1,
+                            num_layers=3,
+                            hidden_size=32,
+                            num_heads=4,
+                            inner_size=128,
+                            dropout=.3,
+                            checkpoint_every=checkpoint_every,
+                            device='cpu')
+        inputs, targets, m1, m2 = next(iter(train_loader))
+        model(inputs, targets, source_mask=m1, target_mask=m2).sum().backward()
+        grads.append([p.grad for p in model.parameters()])
+    for g in grads[1:]:
+        assert all(torch.allclose(a, b, atol=1e-5)
+                   for a, b in zip(grads[0], g))
+
+
+def test_reversible_encoder_matches_autograd():
+    torch.manual_seed(0)
+    encoder = ReversibleEncoder(num_layers=3, hidden_size=32, num_heads=4,
+                                inner_size=64, dropout=.3)
+    x = torch.randn(2, 7, 32, requires_grad=True)
+    mask = torch.ones(2, 1, 7)
+    mask[1, :, 5:] = 0
+    w = torch.randn(2, 7, 32)
+    torch.manual_seed(1)
+    (encoder(x, attention_mask=mask) * w).sum().backward()
+    grads = [x.grad] + [p.grad for p in encoder.parameters()]
+    encoder.zero_grad()
+    x.grad = None
+    # Same forward with regular autograd through the layers
+    torch.manual_seed(1)
+    x1, x2 = x, x
+    for layer in encoder.encoder:
+        x1, x2 = layer(x1, x2, attention_mask=mask)
+    (encoder.lnorm((x1 + x2) / 2) * w).sum().backward()
+    expected = [x.grad] + [p.grad for p in encoder.parameters()]
+    for g, e in zip(grads, expected):
+        assert torch.allclose(g, e, atol=1e-4)
+
+
+def test_shared_layers_load_from_separate_layers():
+    def transformer(shared_layers):
+        return Transformer(vocab_size=len(vocab),
+                           max_length=len(sentence) - 1,
+                           num_layers=3,
+                           hidden_size=32,
+                           num_heads=4,
+                           inner_size=128,
+                           shared_layers=shared_layers,
+                           embedding_size=8,
+                           device='cpu')
+    separate, shared = transformer(False), transformer(True)
+    encoder = shared.transformer_block.encoder.encoder
+    assert encoder[0] is encoder[2]
+    assert (sum(p.numel() for p in shared.parameters()) <
+            sum(p.numel() for p in separate.parameters()))
+    state_dict = separate.state_dict()
+    for prefix in ('transformer_block.encoder.encoder.',
+                   'transformer_block.decoder.decoder.'):
+        state_dict = share_layer_weights(state_dict, prefix, mode=1)
+    shared.load_state_dict(state_dict)
+    expected = separate.transformer_block.encoder.encoder[1]
+    for p, e in zip(encoder[2].parameters(), expected.parameters()):
+        assert torch.all(p == e)
+
+
+def test_output_mask_matches_ignore_index():
+    model = create_model(hidden_size=32)
+    model.eval()
+    inputs, targets, m1, m2 = next(iter(train_loader))
+    targets[:, -3:] = 0
+    output_mask = targets != 0
+    preds = model(inputs, targets, source_mask=m1, target_mask=m2)
+    masked = model(inputs, targets, source_mask=m1, target_mask=m2,
+                   output_mask=output_mask)
+    assert masked.size() == (int(output_mask.sum()), len(vocab))
+    expected = nn.CrossEntropyLoss(ignore_index=0)(
+        preds.view(-1, len(vocab)), targets.view(-1))
+    loss = nn.CrossEntropyLoss()(masked, targets[output_mask])
+    assert torch.allclose(loss, expected, atol=1e-6)
@@ -0,0 +1,19 @@
+import pytest
+import torch
+
+from slp.data.transforms import Truncate
+
+
+def test_truncate_modes():
+    tokens = list(range(10))
+    assert Truncate(4)(tokens) == [0, 1, 2, 3]
+    assert Truncate(4, mode='tail')(tokens) == [6, 7, 8, 9]
+    assert Truncate(5, mode='head+tail')(tokens) == [0, 1, 7, 8, 9]
+    assert Truncate(5, mode='head+tail', head_length=4)(tokens) == [
+        0, 1, 2, 3, 9]
+    # Short sequences are kept as is
+    assert Truncate(20, mode='tail')(tokens) == tokens
+    out = Truncate(4, mode='head+tail')(torch.arange(10))
+    assert torch.equal(out, torch.tensor([0, 1, 8, 9]))
+    with pytest.raises(ValueError):
+        Truncate(4, mode='middle')
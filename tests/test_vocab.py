@@ -0,0 +1,26 @@
+from slp.data.vocab import create_vocab, frequency_cutoffs
+
+
+def test_create_vocab_orders_extra_tokens_then_frequency():
+    corpus = [['c', 'a', 'b'], ['a', 'b', 'a'], ['d']]
+    vocab, counts = create_vocab(corpus, vocab_size=4,
+                                 extra_tokens=['[PAD]', '[UNK]'],
+                                 return_counts=True)
+    assert vocab == {'[PAD]': 0, '[UNK]': 1, 'a': 2, 'b': 3}
+    assert counts == [0, 0, 3, 2]
+
+
+def test_frequency_cutoffs():
+    counts = [50, 30, 10, 5, 3, 2]
+    assert frequency_cutoffs(counts, coverage=(.8, .95)) == [2, 4]
+    # Coverages reached at the same id give a single cutoff
+    assert frequency_cutoffs([90, 5, 5], coverage=(.8, .85)) == [1]
+    # No empty last cluster
+    assert frequency_cutoffs([1, 1], coverage=(.8,)) == []
+
+
+def test_frequency_cutoffs_from_create_vocab():
+    corpus = ['a'] * 8 + ['b'] * 4 + ['c'] * 2 + ['d', 'e']
+    _, counts = create_vocab(corpus, vocab_size=10, return_counts=True)
+    assert counts == sorted(counts, reverse=True)
+    assert frequency_cutoffs(counts, coverage=(.5, .85)) == [1, 3]
@@ -0,0 +1,132 @@
+"""CPU benchmarks for the attention modules in slp.modules.attention.
+Peak memory is measured (see peak_memory)
+
+Usage:
+    python tools/benchmark_attention.py fused_qkv
+    python tools/benchmark_attention.py chunked
+    python tools/benchmark_attention.py linear
+"""
+import argparse
+import multiprocessing
+import resource
+import time
+
+import torch
+
+from slp.modules.attention import LinearAttention, MultiheadAttentionParallel
+
+
+# (hidden_size, num_heads) used in examples/ and the Transformer defaults
+LAYER_SIZES = [(128, 4), (512, 8)]
+
+
+def bench(fn, *args, repeat=20, warmup=3):
+    """Mean wall time of fn(*args) in ms"""
+    for _ in range(warmup):
+        fn(*args)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(*args)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def _run_and_report_peak(queue, fn, args):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with torch.no_grad():
+        fn(*args)
+    queue.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)
+
+
+def peak_memory(fn, *args):
+    """Measured peak memory of fn(*args) in MB above the memory already in
+    use. torch allocates outside of the Python heap, so tracemalloc does
+    not see it. fn runs once in a forked process and the growth of its
+    peak resident set size is reported (ru_maxrss is in KB on Linux)
+    """
+    ctx = multiprocessing.get_context('fork')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_run_and_report_peak,
+                          args=(queue, fn, args))
+    process.start()
+    peak = queue.get()
+    process.join()
+    return peak / 2 ** 10
+
+
+def fused_qkv(batch_size=32, lengths=(64, 256)):
+    print(f'{"D":>5} {"H":>3} {"L":>5} {"separate":>10} '
+          f'{"fused":>10} {"speedup":>8}')
+    for hidden_size, num_heads in LAYER_SIZES:
+        separate = MultiheadAttentionParallel(
+            hidden_size, num_heads, dropout=0.).eval()
+        fused = MultiheadAttentionParallel(
+            hidden_size, num_heads, dropout=0., fused_qkv=True).eval()
+        fused.load_state_dict(separate.state_dict())
+        for length in lengths:
+            x = torch.randn(batch_size, length, hidden_size)
+            with torch.no_grad():
+                t_sep = bench(separate, x)
+                t_fused = bench(fused, x)
+            print(f'{hidden_size:>5} {num_heads:>3} {length:>5} '
+                  f'{t_sep:>8.2f}ms {t_fused:>8.2f}ms '
+                  f'{t_sep / t_fused:>7.2f}x')
+
+
+def chunked(batch_size=4, hidden_size=512, num_heads=8,
+            lengths=(512, 2048), chunk_size=128):
+    print(f'{"L":>5} {"dense":>10} {"chunked":>10} '
+          f'{"dense peak":>12} {"chunked peak":>13}')
+    dense = MultiheadAttentionParallel(
+        hidden_size, num_heads, dropout=0.).eval()
+    chunk = MultiheadAttentionParallel(
+        hidden_size, num_heads, dropout=0., attention_backend='chunked',
+        chunk_size=chunk_size).eval()
+    chunk.load_state_dict(dense.state_dict())
+    for length in lengths:
+        x = torch.randn(batch_size, length, hidden_size)
+        with torch.no_grad():
+            t_dense = bench(dense, x, repeat=3)
+            t_chunk = bench(chunk, x, repeat=3)
+        print(f'{length:>5} {t_dense:>8.2f}ms {t_chunk:>8.2f}ms '
+              f'{peak_memory(dense, x):>10.1f}MB '
+              f'{peak_memory(chunk, x):>11.1f}MB')
+
+
+def linear(batch_size=1, hidden_size=512, num_heads=8,
+           lengths=(256, 1024, 4096)):
+    print(f'{"L":>5} {"full":>10} {"linear":>10} {"causal":>10} '
+          f'{"full peak":>11} {"linear peak":>12} {"causal peak":>12}')
+    full = MultiheadAttentionParallel(
+        hidden_size, num_heads, dropout=0., fused_qkv=True).eval()
+    lin = LinearAttention(
+        hidden_size, num_heads, dropout=0., fused_qkv=True).eval()
+    causal = LinearAttention(
+        hidden_size, num_heads, dropout=0., fused_qkv=True,
+        causal=True).eval()
+    for length in lengths:
+        x = torch.randn(batch_size, length, hidden_size)
+        with torch.no_grad():
+            t_full = bench(full, x, repeat=2, warmup=1)
+            t_lin = bench(lin, x, repeat=2, warmup=1)
+            t_causal = bench(causal, x, repeat=2, warmup=1)
+        print(f'{length:>5} {t_full:>8.2f}ms {t_lin:>8.2f}ms '
+              f'{t_causal:>8.2f}ms {peak_memory(full, x):>9.1f}MB '
+              f'{peak_memory(lin, x):>10.1f}MB '
+              f'{peak_memory(causal, x):>10.1f}MB')
+
+
+BENCHMARKS = {
+    'fused_qkv': fused_qkv,
+    'chunked': chunked,
+    'linear': linear,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=list(BENCHMARKS.keys()))
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    BENCHMARKS[args.benchmark]()
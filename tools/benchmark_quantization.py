@@ -0,0 +1,87 @@
+"""CPU int8 quantization of the example models, with random weights and
+inputs of the example sizes. The metric is the agreement of the argmax
+predictions with the float model.
+
+Usage:
+    python tools/benchmark_quantization.py imdb
+    python tools/benchmark_quantization.py transformer_lm
+"""
+import argparse
+
+import numpy as np
+import torch
+
+from slp.modules.classifier import Classifier
+from slp.modules.quantization import (quantization_report, quantize_dynamic,
+                                      quantize_static)
+from slp.modules.rnn import WordRNN
+from slp.modules.transformer import Transformer
+from slp.modules.util import subsequent_mask
+
+
+def _compare(model, batches, forward_fn):
+    def agreement(m, batch):
+        with torch.no_grad():
+            expected = forward_fn(model, batch).argmax(-1)
+        return forward_fn(m, batch), expected
+
+    print(f'{"mode":>8} {"latency":>10} {"size":>10} {"agreement":>10}')
+    for mode in ('dynamic', 'static'):
+        if mode == 'dynamic':
+            quantized = quantize_dynamic(model)
+        else:
+            quantized = quantize_static(model, batches, forward_fn)
+        report = quantization_report(model, quantized, batches, agreement,
+                                     metric_fn=lambda p, t: (
+                                         (p.argmax(-1) == t).float().mean()
+                                         .item()))
+        if mode == 'dynamic':
+            r = report['float']
+            print(f'{"float":>8} {r["latency"]:>8.1f}ms '
+                  f'{r["size"]:>8.2f}MB {r["metric"]:>10.4f}')
+        r = report['int8']
+        print(f'{mode:>8} {r["latency"]:>8.1f}ms '
+              f'{r["size"]:>8.2f}MB {r["metric"]:>10.4f}')
+
+
+def imdb(vocab_size=20000, batch_size=32, length=256, num_batches=5):
+    embeddings = np.random.randn(vocab_size, 300).astype('float32')
+    model = Classifier(
+        WordRNN(256, embeddings, bidirectional=True, merge_bi='cat',
+                packed_sequence=True, attention=True),
+        512, 3).eval()
+    batches = []
+    for _ in range(num_batches):
+        lengths = torch.randint(length // 4, length + 1, (batch_size,))
+        inputs = torch.randint(1, vocab_size, (batch_size, length))
+        batches.append((inputs, lengths))
+    _compare(model, batches, lambda m, batch: m(*batch))
+
+
+def transformer_lm(vocab_size=5000, batch_size=128, length=64,
+                   num_batches=5):
+    model = Transformer(vocab_size=vocab_size, max_length=length,
+                        num_layers=2, hidden_size=128, num_heads=4,
+                        inner_size=512).eval()
+    mask = subsequent_mask(length).expand(batch_size, -1, -1)
+    batches = [(torch.randint(1, vocab_size, (batch_size, length)),
+                torch.randint(1, vocab_size, (batch_size, length)))
+               for _ in range(num_batches)]
+    _compare(model, batches,
+             lambda m, batch: m(batch[0], batch[1], mask[:, :1], mask))
+
+
+BENCHMARKS = {
+    'imdb': imdb,
+    'transformer_lm': transformer_lm,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=list(BENCHMARKS.keys()))
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    BENCHMARKS[args.benchmark]()
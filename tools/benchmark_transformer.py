@@ -0,0 +1,261 @@
+"""CPU benchmarks for the transformer layers in slp.modules.transformer
+
+Usage:
+    python tools/benchmark_transformer.py layer_norm
+    python tools/benchmark_transformer.py checkpointing
+    python tools/benchmark_transformer.py reversible
+    python tools/benchmark_transformer.py linear_cross_entropy
+    python tools/benchmark_transformer.py factorized
+    python tools/benchmark_transformer.py head_pruning
+    python tools/benchmark_transformer.py inference
+"""
+import argparse
+import multiprocessing
+import resource
+import time
+
+import torch
+import torch.nn.functional as F
+
+from benchmark_attention import bench, LAYER_SIZES
+from slp.modules.norm import LayerNorm
+from slp.modules import transformer
+from slp.modules.loss import linear_cross_entropy
+from slp.modules.factorized import factorize_linear
+from slp.modules.pruning import prune_heads
+from slp.modules.inference import optimize_for_inference
+from slp.modules.util import subsequent_mask
+
+
+def unfused_layer_norm(ln, x, residual):
+    """The residual, dropout and layer norm of the sublayers as separate
+    elementwise ops, as they were before LayerNorm used F.layer_norm
+    """
+    x = residual + F.dropout(x, p=ln.dropout, training=ln.training)
+    u = x.mean(-1, keepdim=True)
+    s = (x - u).pow(2).mean(-1, keepdim=True)
+    x = (x - u) / torch.sqrt(s + ln.variance_epsilon)
+    return ln.weight * x + ln.bias
+
+
+def layer_norm(batch_size=32, length=128, dropout=.1):
+    def backward(fn, *args):
+        fn(*args).sum().backward()
+
+    print(f'{"D":>5} {"pass":>9} {"unfused":>10} {"fused":>10} '
+          f'{"speedup":>8}')
+    for hidden_size, _ in LAYER_SIZES:
+        ln = LayerNorm(hidden_size, dropout=dropout)
+        x = torch.randn(batch_size, length, hidden_size, requires_grad=True)
+        residual = torch.randn(batch_size, length, hidden_size)
+        with torch.no_grad():
+            t_unfused = bench(unfused_layer_norm, ln, x, residual)
+            t_fused = bench(ln, x, residual)
+        print(f'{hidden_size:>5} {"forward":>9} {t_unfused:>8.2f}ms '
+              f'{t_fused:>8.2f}ms {t_unfused / t_fused:>7.2f}x')
+        t_unfused = bench(backward, unfused_layer_norm, ln, x, residual)
+        t_fused = bench(backward, ln, x, residual)
+        print(f'{hidden_size:>5} {"fwd+bwd":>9} {t_unfused:>8.2f}ms '
+              f'{t_fused:>8.2f}ms {t_unfused / t_fused:>7.2f}x')
+
+
+def _train_step(module, kwargs, batch_size, length, repeat=3):
+    """Runs in a fresh process, so that ru_maxrss only holds one config.
+    module is a class name in slp.modules.transformer. Returns the step
+    time in ms and the peak memory of the step in MB
+    """
+    hidden_size = kwargs['hidden_size']
+    kwargs = dict(kwargs, num_heads=8, inner_size=4 * hidden_size)
+    if module == 'Transformer':
+        kwargs.update(vocab_size=1000, max_length=length)
+        inputs = [torch.randint(1000, (batch_size, length)),
+                  torch.randint(1000, (batch_size, length))]
+    else:
+        inputs = [torch.randn(batch_size, length, hidden_size,
+                              requires_grad=True)]
+    model = getattr(transformer, module)(**kwargs)
+    w = None
+
+    def step():
+        nonlocal w
+        out = model(*inputs)
+        if w is None:
+            # Reduce with random weights. The sum of a LayerNorm output
+            # has zero gradient
+            w = torch.randn_like(out)
+        (out * w).sum().backward()
+
+    if torch.cuda.is_available():
+        model = model.cuda()
+        inputs = [x.cuda() for x in inputs]
+        step()
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            step()
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() - base
+    else:
+        # Allocate the gradients first, so that only activations count
+        for p in model.parameters():
+            p.grad = torch.zeros_like(p)
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        start = time.perf_counter()
+        for _ in range(repeat):
+            step()
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        peak -= base
+    step_time = (time.perf_counter() - start) / repeat * 1000
+    return step_time, peak / 2 ** 20
+
+
+def _run_in_process(fn, *args):
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1) as pool:
+        return pool.apply(fn, args)
+
+
+def checkpointing(num_layers=6, hidden_size=512, batch_size=8,
+                  length=256, every=(None, 1, 2, 3)):
+    print(f'{"checkpoint_every":>16} {"step":>10} {"peak memory":>12}')
+    for k in every:
+        step_time, peak = _run_in_process(
+            _train_step, 'Transformer',
+            {'num_layers': num_layers, 'hidden_size': hidden_size,
+             'checkpoint_every': k},
+            batch_size, length)
+        print(f'{str(k):>16} {step_time:>8.1f}ms {peak:>10.1f}MB')
+
+
+def reversible(hidden_size=512, batch_size=8, length=256,
+               depths=(2, 6, 12)):
+    print(f'{"layers":>6} {"encoder":>24} {"reversible":>24}')
+    for num_layers in depths:
+        row = f'{num_layers:>6}'
+        for module in ('Encoder', 'ReversibleEncoder'):
+            step_time, peak = _run_in_process(
+                _train_step, module,
+                {'num_layers': num_layers, 'hidden_size': hidden_size},
+                batch_size, length)
+            row += f' {step_time:>10.1f}ms {peak:>9.1f}MB'
+        print(row)
+
+
+def _loss_step(chunk_size, num_tokens, hidden_size, vocab_size, repeat=3):
+    """Returns the step time in ms and the peak memory of the step in MB.
+    chunk_size=None is the dense F.linear + F.cross_entropy
+    """
+    hidden = torch.randn(num_tokens, hidden_size, requires_grad=True)
+    weight = torch.randn(vocab_size, hidden_size, requires_grad=True)
+    bias = torch.zeros(vocab_size, requires_grad=True)
+    targets = torch.randint(vocab_size, (num_tokens,))
+    for p in (hidden, weight, bias):
+        p.grad = torch.zeros_like(p)
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    start = time.perf_counter()
+    for _ in range(repeat):
+        if chunk_size is None:
+            loss = F.cross_entropy(F.linear(hidden, weight, bias), targets)
+        else:
+            loss = linear_cross_entropy(hidden, weight, bias, targets,
+                                        chunk_size=chunk_size)
+        loss.backward()
+    step_time = (time.perf_counter() - start) / repeat * 1000
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - base
+    return step_time, peak / 2 ** 20
+
+
+def linear_cross_entropy_(num_tokens=4096, hidden_size=256,
+                          vocab_size=30000, chunks=(None, 2048, 512)):
+    print(f'{"chunk_size":>10} {"step":>10} {"peak memory":>12}')
+    for chunk_size in chunks:
+        step_time, peak = _run_in_process(
+            _loss_step, chunk_size, num_tokens, hidden_size, vocab_size)
+        print(f'{str(chunk_size):>10} {step_time:>8.1f}ms {peak:>10.1f}MB')
+
+
+def factorized(num_layers=2, hidden_size=512, batch_size=8, length=128,
+               ranks=(None, 256, 128, 64)):
+    """Encoder inference with the linear layers factorized at rank r"""
+    print(f'{"rank":>5} {"params":>10} {"forward":>10} {"speedup":>8}')
+    x = torch.randn(batch_size, length, hidden_size)
+    baseline = None
+    for rank in ranks:
+        encoder = transformer.Encoder(
+            num_layers=num_layers, hidden_size=hidden_size,
+            inner_size=4 * hidden_size, dropout=0.).eval()
+        if rank is not None:
+            factorize_linear(encoder, rank=rank)
+        params = sum(p.numel() for p in encoder.parameters())
+        with torch.no_grad():
+            t = bench(encoder, x, repeat=5)
+        baseline = baseline or t
+        print(f'{str(rank):>5} {params / 1e6:>9.2f}M {t:>8.1f}ms '
+              f'{baseline / t:>7.2f}x')
+
+
+def head_pruning(num_layers=2, hidden_size=512, num_heads=8, batch_size=8,
+                 length=128, kept=(8, 6, 4, 2)):
+    """Encoder inference with num_heads - k heads removed per layer"""
+    print(f'{"heads":>5} {"params":>10} {"forward":>10} {"speedup":>8}')
+    x = torch.randn(batch_size, length, hidden_size)
+    baseline = None
+    for k in kept:
+        encoder = transformer.Encoder(
+            num_layers=num_layers, hidden_size=hidden_size,
+            num_heads=num_heads, inner_size=4 * hidden_size,
+            dropout=0.).eval()
+        for layer in encoder.encoder:
+            prune_heads(layer.l1.sublayer, range(k, num_heads))
+        params = sum(p.numel() for p in encoder.parameters())
+        with torch.no_grad():
+            t = bench(encoder, x, repeat=5)
+        baseline = baseline or t
+        print(f'{k:>5} {params / 1e6:>9.2f}M {t:>8.1f}ms '
+              f'{baseline / t:>7.2f}x')
+
+
+def inference(vocab_size=5000, batch_size=32, length=64):
+    """Transformer forward in eval mode before and after
+    optimize_for_inference, with the examples/transformer_lm.py sizes
+    """
+    print(f'{"D":>5} {"eval":>10} {"optimized":>10} {"speedup":>8} '
+          f'{"max diff":>9}')
+    source = torch.randint(1, vocab_size, (batch_size, length))
+    mask = subsequent_mask(length).expand(batch_size, -1, -1)
+    for hidden_size, num_heads in LAYER_SIZES:
+        model = transformer.Transformer(
+            vocab_size=vocab_size, max_length=length, num_layers=2,
+            hidden_size=hidden_size, num_heads=num_heads,
+            inner_size=4 * hidden_size).eval()
+        optimized = optimize_for_inference(model, max_length=length)
+        args = (source, source, mask[:, :1], mask)
+        with torch.no_grad():
+            diff = (model(*args) - optimized(*args)).abs().max().item()
+            t_eval = bench(model, *args, repeat=5)
+            t_opt = bench(optimized, *args, repeat=5)
+        print(f'{hidden_size:>5} {t_eval:>8.1f}ms {t_opt:>8.1f}ms '
+              f'{t_eval / t_opt:>7.2f}x {diff:>9.1e}')
+
+
+BENCHMARKS = {
+    'layer_norm': layer_norm,
+    'checkpointing': checkpointing,
+    'reversible': reversible,
+    'linear_cross_entropy': linear_cross_entropy_,
+    'factorized': factorized,
+    'head_pruning': head_pruning,
+    'inference': inference,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=list(BENCHMARKS.keys()))
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    BENCHMARKS[args.benchmark]()